@@ -0,0 +1,83 @@
+"""
+Measures SSH handshakes per second against ServerInterface
+
+Each handshake runs over a socketpair: ServerInterface does the server side
+while a paramiko.Transport does the client side (KEX only, no auth).
+
+    python benchmarks/handshake.py [-n COUNT] [--key-type rsa|ecdsa|ed25519|default]
+"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from ssh_forward_proxy import ServerInterface
+
+def make_key(key_type, directory):
+    if key_type == 'default':
+        return None
+
+    path = os.path.join(directory, key_type)
+    if key_type == 'rsa':
+        paramiko.RSAKey.generate(2048).write_private_key_file(path)
+    elif key_type == 'ecdsa':
+        paramiko.ECDSAKey.generate().write_private_key_file(path)
+    elif key_type == 'ed25519':
+        data = ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.OpenSSH,
+            serialization.NoEncryption(),
+        )
+        with open(path, 'wb') as f:
+            f.write(data)
+    return path
+
+def handshake(server_key):
+    a, b = socket.socketpair()
+    server = []
+    thread = threading.Thread(target=lambda: server.append(ServerInterface(a, server_key=server_key)))
+    thread.start()
+
+    client = paramiko.Transport(b)
+    client.start_client()
+    thread.join()
+
+    client.close()
+    server[0].transport.close()
+
+def run(count, server_key):
+    # warm up
+    handshake(server_key)
+
+    start = time.time()
+    for i in range(count):
+        handshake(server_key)
+    return count / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure handshakes per second')
+    parser.add_argument('-n', dest='count', type=int, default=50, help='Number of handshakes')
+    parser.add_argument('--key-type', action='append', choices=['default', 'rsa', 'ecdsa', 'ed25519'],
+                        help='Server key types to measure (default: all)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    directory = tempfile.mkdtemp()
+    try:
+        for key_type in args.key_type or ['default', 'rsa', 'ecdsa', 'ed25519']:
+            rate = run(args.count, make_key(key_type, directory))
+            print('{:10} {:8.1f} handshakes/s'.format(key_type, rate))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,286 @@
+"""
+Load generator: how many concurrent sessions and handshakes per second
+one proxy sustains, all on this machine
+
+Starts an upstream SSH server (the Server of bin/simple-ssh-server.py) and
+a proxy in their own processes, then for each concurrency level and payload
+size runs that many paramiko clients at once, each making --sessions
+sessions one after the other on new connections. Each session runs
+`head -c SIZE /dev/zero` on the upstream and reads all of its output.
+
+    --mode server   clients connect to ProxyServer (ssh-forward-proxy.py server)
+                    and name the upstream in the __HOST__ environment variable
+    --mode relay    clients connect to the relay daemon (ssh-forward-proxy.py daemon)
+                    which runs a Proxy in relay mode for each connection
+
+Reports per level: connection setup time (connect, handshake, auth and exec)
+and time to first byte (exec to the first byte of output) percentiles, the
+aggregate MB/s and sessions/s over the whole level, and errors by type.
+
+    python benchmarks/loadgen.py [--mode server|relay] [--concurrency 1,10,50]
+        [--sizes 0,64K,1M] [--sessions N] [--client-processes N] [--json FILE]
+"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import argparse
+import logging
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paramiko
+
+from ssh_forward_proxy import (Server, ProxyServer, UpstreamPool, Pump, SessionLimiter,
+                               serve_forever, relay_session, parse_size)
+
+KEY = os.path.join(os.path.dirname(__file__), '..', 'tests', 'ssh-forward-proxy-test-key')
+USERNAME = 'loadgen'
+
+class Upstream(Server):
+    """
+    Server that also accepts any key, since the proxy authenticates to its remotes with one
+    """
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none,publickey'
+
+def listen(address):
+    """
+    returns a socket listening on @address, a port on localhost or a unix socket path
+    """
+
+    if isinstance(address, int):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', address))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    sock.listen(1000)
+    return sock
+
+def serve_upstream(sock):
+    logging.disable(logging.CRITICAL)
+    serve_forever(sock, worker=Upstream)
+
+def serve_proxy(sock, mode, options):
+    logging.disable(logging.CRITICAL)
+    serve_forever(
+        sock,
+        worker=ProxyServer if mode == 'server' else relay_session,
+        workers=options.workers,
+        limiter=SessionLimiter(options.max_sessions, max_queued=1000),
+        key_filename=KEY,
+        allow_agent=False,
+        look_for_keys=False,
+        host_key_check=False,
+        pump=Pump(options.pump_threads) if options.pump_threads else None,
+        pool=UpstreamPool() if options.pool else None,
+    )
+
+def open_transport(mode, address, upstream):
+    if mode == 'server':
+        sock = socket.create_connection(('127.0.0.1', address))
+        # as OpenSSH does, so small packets are not held back waiting for ACKs
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        sock.sendall('{} 127.0.0.1 {}\n'.format(upstream, USERNAME).encode('utf-8'))
+    transport = paramiko.Transport(sock)
+    transport.start_client(timeout=30)
+    transport.auth_none(USERNAME)
+    return transport
+
+def session(mode, address, upstream, size):
+    """
+    returns (setup seconds, time to first byte seconds, bytes received)
+    """
+
+    started = time.time()
+    transport = open_transport(mode, address, upstream)
+    try:
+        channel = transport.open_session(timeout=30)
+        channel.settimeout(60)
+        if mode == 'server':
+            channel.set_environment_variable(ProxyServer.HOST.decode('utf-8'),
+                                             '{}@127.0.0.1:{}'.format(USERNAME, upstream))
+        channel.exec_command('head -c {} /dev/zero'.format(size))
+        setup = time.time() - started
+
+        received = 0
+        first_byte = None
+        while True:
+            data = channel.recv(1024 * 1024)
+            if first_byte is None:
+                # or EOF, for empty payloads
+                first_byte = time.time() - started - setup
+            if not data:
+                break
+            received += len(data)
+        if received != size:
+            raise EOFError('Received {} of {} bytes'.format(received, size))
+        return setup, first_byte, received
+    finally:
+        transport.close()
+
+def run_clients(args):
+    """
+    runs @clients clients at once in this process, each making @sessions sessions
+    returns (samples, errors by type, start time, end time)
+    """
+
+    mode, address, upstream, clients, sessions, size = args
+    samples = []
+    errors = {}
+    lock = threading.Lock()
+
+    def client():
+        for i in range(sessions):
+            try:
+                sample = session(mode, address, upstream, size)
+            except Exception as e:
+                with lock:
+                    name = type(e).__name__
+                    errors[name] = errors.get(name, 0) + 1
+            else:
+                with lock:
+                    samples.append(sample)
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors, started, time.time()
+
+def percentile(values, p):
+    """
+    nearest-rank percentile of the sorted @values, or None if empty
+    """
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+def run_level(pool, mode, address, upstream, concurrency, sessions, size, processes):
+    # spread the clients over the processes as evenly as possible
+    shares = [concurrency // processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+    results = pool.map(run_clients, [(mode, address, upstream, share, sessions, size) for share in shares if share])
+
+    samples = []
+    errors = {}
+    for process_samples, process_errors, started, ended in results:
+        samples += process_samples
+        for name, count in process_errors.items():
+            errors[name] = errors.get(name, 0) + count
+    seconds = max(r[3] for r in results) - min(r[2] for r in results)
+
+    setup = sorted(s[0] for s in samples)
+    first_byte = sorted(s[1] for s in samples)
+    total = sum(s[2] for s in samples)
+    result = dict(
+        mode=mode,
+        concurrency=concurrency,
+        size=size,
+        sessions=len(samples),
+        errors=errors,
+        seconds=seconds,
+        mb_s=total / seconds / 1024 / 1024,
+        sessions_s=len(samples) / seconds,
+    )
+    for p in (50, 95, 99):
+        result['setup_p{}'.format(p)] = percentile(setup, p)
+        result['ttfb_p{}'.format(p)] = percentile(first_byte, p)
+    return result
+
+def milliseconds(value):
+    return '-' if value is None else '{:.1f}'.format(value * 1000)
+
+HEADER = '{:>6} {:>9} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9}  {}'.format(
+    'conc', 'size', 'ok', 'setup50', 'setup95', 'setup99', 'ttfb50', 'ttfb95', 'ttfb99', 'MB/s', 'sess/s', 'errors')
+
+def format_result(result):
+    return '{:>6} {:>9} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9.1f} {:>9.1f}  {}'.format(
+        result['concurrency'], result['size'], result['sessions'],
+        milliseconds(result['setup_p50']), milliseconds(result['setup_p95']), milliseconds(result['setup_p99']),
+        milliseconds(result['ttfb_p50']), milliseconds(result['ttfb_p95']), milliseconds(result['ttfb_p99']),
+        result['mb_s'], result['sessions_s'],
+        ' '.join('{}={}'.format(name, count) for name, count in sorted(result['errors'].items())) or '-')
+
+def parse_list(parse):
+    return lambda text: [parse(item) for item in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure concurrent sessions through the proxy')
+    parser.add_argument('--mode', choices=['server', 'relay'], default='server',
+                        help='ProxyServer with __HOST__, or the relay daemon (default: server)')
+    parser.add_argument('--concurrency', type=parse_list(int), default=[1, 10, 50],
+                        help='Concurrent clients, comma separated (default: 1,10,50)')
+    parser.add_argument('--sizes', type=parse_list(parse_size), default=[0, 64 * 1024, 1024 * 1024],
+                        help='Payload sizes with optional K, M or G suffix, comma separated (default: 0,64K,1M)')
+    parser.add_argument('--sessions', type=int, default=5, help='Sessions each client makes (default: 5)')
+    parser.add_argument('--client-processes', type=int, default=1,
+                        help='Processes to spread the clients over, so they are not limited to one core (default: 1)')
+    parser.add_argument('--pump-threads', type=int, default=0, help='Proxy --pump-threads (default: 0)')
+    parser.add_argument('--workers', type=int, help='Proxy --workers (default: none)')
+    parser.add_argument('--max-sessions', type=int, help='Proxy --max-sessions (default: unlimited)')
+    parser.add_argument('--pool', action='store_true', default=False, help='Pool the proxy\'s upstream connections')
+    parser.add_argument('--json', metavar='FILE', help='Save the results as JSON')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    directory = tempfile.mkdtemp()
+    # listening before the servers start, so clients can connect straight away
+    upstream_sock = listen(0)
+    upstream = upstream_sock.getsockname()[1]
+    proxy_sock = listen(0 if args.mode == 'server' else os.path.join(directory, 'relay.sock'))
+    address = proxy_sock.getsockname()
+    if args.mode == 'server':
+        address = address[1]
+
+    # forked before any threads are started in this process
+    context = multiprocessing.get_context('fork')
+    servers = [
+        context.Process(target=serve_upstream, args=(upstream_sock,)),
+        context.Process(target=serve_proxy, args=(proxy_sock, args.mode, args)),
+    ]
+    pool = context.Pool(args.client_processes)
+    try:
+        for server in servers:
+            server.daemon = True
+            server.start()
+        upstream_sock.close()
+        proxy_sock.close()
+
+        # warm up
+        pool.map(run_clients, [(args.mode, address, upstream, 1, 1, 0)])
+
+        results = []
+        print(HEADER)
+        for size in args.sizes:
+            for concurrency in args.concurrency:
+                result = run_level(pool, args.mode, address, upstream, concurrency, args.sessions, size,
+                                   args.client_processes)
+                results.append(result)
+                print(format_result(result))
+                sys.stdout.flush()
+    finally:
+        pool.terminate()
+        for server in servers:
+            server.terminate()
+        shutil.rmtree(directory)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=dict(vars(args)), results=results), f, indent=2, sort_keys=True)
@@ -0,0 +1,83 @@
+"""
+Measures handshakes per second and throughput for each crypto profile
+
+Each run is over a socketpair: ServerInterface (Server for throughput)
+applies the profile as its client_profile while a paramiko.Transport
+with the same profile is the client. Throughput is measured reading the output of a command that
+writes zeroes, so it is mostly the cost of the cipher and MAC.
+
+    python benchmarks/profiles.py [-n COUNT] [--size MB] [--profile NAME]
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paramiko
+
+from ssh_forward_proxy import ServerInterface, Server, CRYPTO_PROFILES
+
+def connect(profile, server_class):
+    a, b = socket.socketpair()
+    server = []
+    thread = threading.Thread(target=lambda: server.append(server_class(a, client_profile=profile)))
+    thread.daemon = True
+    thread.start()
+
+    client = paramiko.Transport(b)
+    CRYPTO_PROFILES[profile].apply(client)
+    client.start_client()
+    return client, thread, server
+
+def handshake(profile):
+    client, thread, server = connect(profile, ServerInterface)
+    thread.join()
+    client.close()
+    server[0].transport.close()
+
+def handshakes(profile, count):
+    # warm up
+    handshake(profile)
+
+    start = time.time()
+    for i in range(count):
+        handshake(profile)
+    return count / (time.time() - start)
+
+def throughput(profile, size):
+    client, thread, server = connect(profile, Server)
+    try:
+        client.auth_none('user')
+        channel = client.open_session()
+        channel.exec_command('head -c {} /dev/zero'.format(size))
+
+        received = 0
+        start = time.time()
+        while True:
+            data = channel.recv(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+        return received / (time.time() - start), client.remote_cipher
+    finally:
+        client.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure handshakes per second and throughput per crypto profile')
+    parser.add_argument('-n', dest='count', type=int, default=50, help='Number of handshakes')
+    parser.add_argument('--size', type=int, default=64, help='Payload size in MB (default: 64)')
+    parser.add_argument('--profile', action='append', choices=sorted(CRYPTO_PROFILES),
+                        help='Profiles to measure (default: all)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    for profile in args.profile or sorted(CRYPTO_PROFILES):
+        rate = handshakes(profile, args.count)
+        speed, cipher = throughput(profile, args.size * 1024 * 1024)
+        print('{:8} {:8.1f} handshakes/s {:8.1f} MB/s  ({})'.format(profile, rate, speed / 1024 / 1024, cipher))
@@ -0,0 +1,133 @@
+"""
+Compares relaying many concurrent sessions with one thread per session
+(pipe_streams) against the selectors based Pump
+
+Each session relays the output of `head -c SIZE /dev/zero` to a sink
+channel. Reports peak thread count, context switches and CPU time per
+relayed MB for each mode. Paramiko's own transport threads are not
+included since no real SSH connections are made.
+
+    python benchmarks/pump.py [--sessions N] [--size MB] [--pump-threads N]
+"""
+
+import os
+import sys
+import time
+import resource
+import threading
+import subprocess
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ssh_forward_proxy import Pump, Relay, ChannelStream, ProcessStream, MAX_CHUNK_SIZE
+
+class SinkChannel:
+    """
+    channel which never sends anything and discards what it receives
+    """
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.received = 0
+
+    def fileno(self):
+        return self.r
+
+    def recv(self, n):
+        return os.read(self.r, n)
+    recv_stderr = recv
+
+    def recv_ready(self):
+        return False
+    recv_stderr_ready = recv_ready
+
+    def sendall(self, data):
+        self.received += len(data)
+    sendall_stderr = sendall
+
+    def send(self, data):
+        self.received += len(data)
+        return len(data)
+    send_stderr = send
+
+    def send_ready(self):
+        return True
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+def start_session(size):
+    process = subprocess.Popen(
+        'head -c {} /dev/zero'.format(size), shell=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    channel = SinkChannel()
+    relay = Relay(ChannelStream(channel), ProcessStream(process), max_size=MAX_CHUNK_SIZE)
+    return process, channel, relay
+
+def finish_session(process, channel):
+    process.wait()
+    process.stdin.close()
+    process.stdout.close()
+    process.stderr.close()
+    channel.close()
+
+def run(mode, sessions, size, pump_threads):
+    done = threading.Semaphore(0)
+    started = [start_session(size) for i in range(sessions)]
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    pump = None
+    if mode == 'pump':
+        pump = Pump(pump_threads)
+        for process, channel, relay in started:
+            pump.add(relay, lambda completed: done.release())
+    else:
+        for process, channel, relay in started:
+            def target(relay=relay):
+                relay.run()
+                done.release()
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    peak_threads = threading.active_count()
+    for i in range(sessions):
+        done.acquire()
+
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    if pump:
+        pump.close()
+
+    relayed = sum(channel.received for process, channel, relay in started) / 1024.0 / 1024
+    for process, channel, relay in started:
+        finish_session(process, channel)
+
+    switches = (after.ru_nvcsw - before.ru_nvcsw) + (after.ru_nivcsw - before.ru_nivcsw)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return dict(
+        threads=peak_threads,
+        switches=switches,
+        cpu_ms_per_mb=cpu * 1000 / relayed,
+        mb_per_s=relayed / elapsed,
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare per-session threads with the Pump')
+    parser.add_argument('--sessions', type=int, default=200, help='Concurrent sessions (default: 200)')
+    parser.add_argument('--size', type=float, default=4, help='MB relayed per session (default: 4)')
+    parser.add_argument('--pump-threads', type=int, default=2, help='Pump threads (default: 2)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    size = int(args.size * 1024 * 1024)
+    print('{:8} {:>8} {:>10} {:>10} {:>8}'.format('mode', 'threads', 'ctx sw', 'cpu ms/MB', 'MB/s'))
+    for mode in ('thread', 'pump'):
+        result = run(mode, args.sessions, size, args.pump_threads)
+        print('{:8} {threads:8} {switches:10} {cpu_ms_per_mb:10.2f} {mb_per_s:8.1f}'.format(mode, **result))
@@ -0,0 +1,66 @@
+"""
+Microbenchmark for pipe_streams using the fakes in tests/fake_io.py
+
+Relays a payload from a fake remote channel's stdout to a fake client
+channel and reports throughput and the number of reads it took.
+
+    python benchmarks/relay.py [--size MB] [--chunk-size N] [--max-chunk-size N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tests import fake_io
+from ssh_forward_proxy import pipe_streams, ChannelStream, CHUNK_SIZE, MAX_CHUNK_SIZE
+
+def make_payload(directory, size):
+    path = os.path.join(directory, 'payload')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    empty = os.path.join(directory, 'empty')
+    open(empty, 'wb').close()
+    return path, empty
+
+def run(stdout, stderr, chunk_size, max_chunk_size):
+    # the client sends nothing but keeps its side open
+    client = fake_io.FakeInputChannel(cmd=['cat'])
+    remote = fake_io.FakeOutputChannel(stdout=stdout, stderr=stderr)
+
+    reads = [0]
+    recv = remote.recv
+    def counting_recv(n):
+        reads[0] += 1
+        return recv(n)
+    remote.recv = counting_recv
+
+    try:
+        start = time.time()
+        pipe_streams(ChannelStream(client), ChannelStream(remote), chunk_size, max_chunk_size)
+        elapsed = time.time() - start
+    finally:
+        fake_io.close_fake_io(client)
+        fake_io.close_fake_io(remote)
+
+    return len(client.stdout.getvalue()), elapsed, reads[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure pipe_streams throughput')
+    parser.add_argument('--size', type=int, default=64, help='Payload size in MB (default: 64)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--max-chunk-size', type=int, default=MAX_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        stdout, stderr = make_payload(directory, args.size * 1024 * 1024)
+        for name, max_size in (('fixed', args.chunk_size), ('adaptive', args.max_chunk_size)):
+            size, elapsed, reads = run(stdout, stderr, args.chunk_size, max_size)
+            print('{:10} {:8.1f} MB/s {:10} reads'.format(name, size / elapsed / 1024 / 1024, reads))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,64 @@
+"""
+Measures how long ssh_forward_proxy takes to import and the scripts take to start
+
+Import times come from `python -X importtime`; the slowest modules imported
+by the package are listed. Script startup is the wall time of `--help`.
+
+    python benchmarks/startup.py [-n COUNT] [--top N]
+"""
+
+import os
+import sys
+import time
+import subprocess
+import argparse
+
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+def import_times(module):
+    """
+    returns {module: cumulative seconds} for importing @module in a fresh interpreter
+    """
+
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                     stderr=subprocess.STDOUT, env=env).decode('utf-8')
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us) / 1e6
+    return times
+
+def startup_time(args):
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    start = time.time()
+    subprocess.check_call([sys.executable] + args, stdout=subprocess.DEVNULL, env=env)
+    return time.time() - start
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure import and startup time')
+    parser.add_argument('-n', dest='count', type=int, default=10, help='Number of runs')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+    args = parser.parse_args()
+
+    for module in ['ssh_forward_proxy', 'ssh_forward_proxy.server']:
+        runs = [import_times(module) for i in range(args.count)]
+        print('import {:28} {:7.1f} ms'.format(module, median([r[module] for r in runs]) * 1000))
+
+    slowest = sorted(runs[-1].items(), key=lambda item: -item[1])[:args.top]
+    for name, seconds in slowest:
+        print('    {:32} {:7.1f} ms'.format(name, seconds * 1000))
+
+    scripts = [
+        ['bin/ssh-forward-proxy.py', 'relay', '--help'],
+        ['bin/ssh-forward-proxy-client.py', '--help'],
+    ]
+    for script in scripts:
+        path = [os.path.join(ROOT_DIR, script[0])] + script[1:]
+        seconds = median([startup_time(path) for i in range(args.count)])
+        print('{:35} {:7.1f} ms'.format(' '.join(script), seconds * 1000))
@@ -0,0 +1,443 @@
+"""
+Micro-benchmarks for the stream layer: pipe_streams, Stream.pipe,
+ChannelStream, ProcessStream and StdSocket
+
+Each benchmark runs over a range of payload sizes and stdout/stderr mixes:
+
+    fake_relay      pipe_streams between the fake channels in tests/fake_io.py
+    process_relay   a process's stdout/stderr (real OS pipes) relayed to a sink channel
+    socket_relay    a channel backed by a socketpair relayed to a sink channel
+    pipe_call       Stream.pipe on an in-memory channel, for the cost of each call
+    stdsocket_recv  StdSocket.recv from a pipe as stdin, at paramiko's read sizes
+    stdsocket_send  StdSocket.send to a pipe as stdout
+
+and reports MB/s, microseconds per chunk (read) and, on Linux, read/write
+syscalls per MB (from /proc/self/io, so the other end of pipes run by this
+process is included, but socket calls are not). Results can be saved as JSON and compared with a
+previous run, e.g. from another commit:
+
+    python benchmarks/streams.py --json before.json
+    git checkout ...
+    python benchmarks/streams.py --compare before.json [--threshold 10]
+
+which exits with status 1 if anything got slower by more than the threshold
+(percent). Each case runs --repeat times and the best run is kept.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import select
+import tempfile
+import threading
+import subprocess
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tests import fake_io
+from ssh_forward_proxy import pipe_streams, Relay, ChannelStream, ProcessStream, StdSocket, ChunkSize, MAX_CHUNK_SIZE
+
+MB = 1024 * 1024
+
+# (name, fraction of the payload on stdout)
+MIXES = [('stdout', 1.0), ('mixed', 0.5), ('stderr', 0.0)]
+
+# whether a bigger value is better, for --compare
+METRICS = {'mb_s': True, 'us_per_chunk': False, 'syscalls_per_mb': False}
+
+def syscalls():
+    """
+    returns the number of read and write syscalls this process has made, or None
+    """
+
+    try:
+        with open('/proc/self/io') as f:
+            counts = dict(line.split(': ') for line in f.read().splitlines())
+    except (IOError, OSError, ValueError):
+        return None
+    return int(counts['syscr']) + int(counts['syscw'])
+
+class Measurement:
+    """
+    times the code in a with block and counts its syscalls
+    """
+
+    def __enter__(self):
+        self.syscalls = syscalls()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+        after = syscalls()
+        if self.syscalls is not None and after is not None:
+            self.syscalls = after - self.syscalls
+        else:
+            self.syscalls = None
+
+    def result(self, size, chunks):
+        return dict(
+            mb_s=size / self.elapsed / MB,
+            us_per_chunk=self.elapsed / max(chunks, 1) * 1e6,
+            syscalls_per_mb=self.syscalls / (size / MB) if self.syscalls is not None else None,
+        )
+
+class SinkChannel:
+    """
+    channel which never sends anything and discards what it receives
+    """
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.received = 0
+
+    def fileno(self):
+        return self.r
+
+    def recv(self, n):
+        return b''
+    recv_stderr = recv
+
+    def recv_ready(self):
+        return False
+    recv_stderr_ready = recv_ready
+
+    def send_ready(self):
+        return True
+
+    def send(self, data):
+        self.received += len(data)
+        return len(data)
+    send_stderr = sendall = sendall_stderr = send
+
+    def shutdown_write(self):
+        pass
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+class CountingChannel:
+    """
+    wraps a channel to count its reads
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.reads = 0
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def recv(self, n):
+        self.reads += 1
+        return self.channel.recv(n)
+
+    def recv_stderr(self, n):
+        self.reads += 1
+        return self.channel.recv_stderr(n)
+
+def write_payload(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+def fake_relay(directory, size, mix):
+    stdout = os.path.join(directory, 'stdout')
+    stderr = os.path.join(directory, 'stderr')
+    write_payload(stdout, int(size * mix))
+    write_payload(stderr, size - int(size * mix))
+
+    # the client sends nothing but keeps its side open
+    client = fake_io.FakeInputChannel(cmd=['cat'])
+    remote = CountingChannel(fake_io.FakeOutputChannel(stdout=stdout, stderr=stderr))
+    try:
+        with Measurement() as measurement:
+            pipe_streams(ChannelStream(client), ChannelStream(remote), max_size=MAX_CHUNK_SIZE)
+        assert len(client.stdout.getvalue()) + len(client.stderr.getvalue()) == size
+    finally:
+        fake_io.close_fake_io(client)
+        fake_io.close_fake_io(remote)
+    return measurement.result(size, remote.reads)
+
+def process_relay(directory, size, mix):
+    stdout = int(size * mix)
+    command = 'head -c {} /dev/zero; head -c {} /dev/zero >&2'.format(stdout, size - stdout)
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    channel = SinkChannel()
+    output = ProcessStream(process)
+    reads = [0]
+    read = output.read
+    def counting_read(key, n):
+        reads[0] += 1
+        return read(key, n)
+    output.read = counting_read
+
+    try:
+        with Measurement() as measurement:
+            pipe_streams(ChannelStream(channel), output, max_size=MAX_CHUNK_SIZE)
+        assert channel.received == size
+    finally:
+        process.wait()
+        for f in (process.stdin, process.stdout, process.stderr):
+            f.close()
+        channel.close()
+    return measurement.result(size, reads[0])
+
+class SocketChannel:
+    """
+    channel reading stdout from a socket, with no stderr
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def recv_stderr(self, n):
+        return b''
+
+    def recv_ready(self):
+        # like a paramiko channel, ready at EOF too
+        r, w, x = select.select([self.sock], [], [], 0)
+        return bool(r)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def send_ready(self):
+        return True
+
+    def send(self, data):
+        return self.sock.send(data)
+    send_stderr = send
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+    sendall_stderr = sendall
+
+    def shutdown_write(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    @property
+    def closed(self):
+        return False
+
+def socket_relay(directory, size, mix):
+    a, b = socket.socketpair()
+    def write():
+        data = b'\0' * MB
+        sent = 0
+        while sent < size:
+            sent += b.send(data[:size - sent])
+        b.close()
+    thread = threading.Thread(target=write)
+    thread.start()
+
+    channel = SinkChannel()
+    remote = CountingChannel(SocketChannel(a))
+    try:
+        with Measurement() as measurement:
+            pipe_streams(ChannelStream(channel), ChannelStream(remote), max_size=MAX_CHUNK_SIZE)
+        assert channel.received == size
+    finally:
+        thread.join()
+        a.close()
+        channel.close()
+    return measurement.result(size, remote.reads)
+
+class MemoryChannel(SinkChannel):
+    """
+    channel whose stdout has @size bytes ready, @chunk bytes at a time
+    """
+
+    def __init__(self, size, chunk):
+        SinkChannel.__init__(self)
+        self.left = size
+        self.data = b'\0' * chunk
+
+    def recv_ready(self):
+        return self.left > 0
+
+    def recv(self, n):
+        data = self.data[:min(n, self.left)]
+        self.left -= len(data)
+        return data
+
+def pipe_call(directory, size, chunk):
+    channel = MemoryChannel(size, chunk)
+    stream = ChannelStream(channel)
+    sink = SinkChannel()
+    other = ChannelStream(sink)
+    calls = 0
+    try:
+        with Measurement() as measurement:
+            while stream.pipe(stream.STDOUT, None, other, chunk):
+                calls += 1
+    finally:
+        channel.close()
+        sink.close()
+    return measurement.result(size, calls)
+
+def with_std_pipes(function):
+    """
+    runs @function with sys.stdin and sys.stdout replaced by pipes
+    returns (result, stdin write end, stdout read end)
+    """
+
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    saved = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = os.fdopen(stdin_r, 'rb'), os.fdopen(stdout_w, 'wb')
+    try:
+        return function(stdin_w, stdout_r)
+    finally:
+        sys.stdin.close()
+        sys.stdout.close()
+        os.close(stdin_w)
+        os.close(stdout_r)
+        sys.stdin, sys.stdout = saved
+
+def stdsocket_recv(directory, size, count):
+    def run(stdin_w, stdout_r):
+        def write():
+            data = b'\0' * MB
+            written = 0
+            while written < size:
+                written += os.write(stdin_w, data[:size - written])
+        thread = threading.Thread(target=write)
+        thread.start()
+
+        sock = StdSocket()
+        received = calls = 0
+        with Measurement() as measurement:
+            while received < size:
+                received += len(sock.recv(min(count, size - received)))
+                calls += 1
+        thread.join()
+        return measurement.result(size, calls)
+    return with_std_pipes(run)
+
+def stdsocket_send(directory, size, count):
+    def run(stdin_w, stdout_r):
+        def read():
+            received = 0
+            while received < size:
+                received += len(os.read(stdout_r, MB))
+        thread = threading.Thread(target=read)
+        thread.start()
+
+        sock = StdSocket()
+        data = b'\0' * count
+        sent = calls = 0
+        with Measurement() as measurement:
+            while sent < size:
+                sent += sock.send(data[:size - sent])
+                calls += 1
+            thread.join()
+        return measurement.result(size, calls)
+    return with_std_pipes(run)
+
+def cases(sizes):
+    """
+    yields (benchmark name, function, size, parameter name, parameter)
+    """
+
+    for size in sizes:
+        for name, mix in MIXES:
+            yield 'fake_relay', fake_relay, size, name, mix
+        for name, mix in MIXES:
+            yield 'process_relay', process_relay, size, name, mix
+        yield 'socket_relay', socket_relay, size, 'stdout', 1.0
+    # per call costs don't depend on the payload size
+    size = max(sizes)
+    for chunk in (64, 1024, 32 * 1024):
+        yield 'pipe_call', pipe_call, size, 'chunk={}'.format(chunk), chunk
+    # paramiko reads a packet's first block, then the rest of it
+    for count in (16, 32 * 1024):
+        yield 'stdsocket_recv', stdsocket_recv, size, 'recv={}'.format(count), count
+    yield 'stdsocket_send', stdsocket_send, size, 'send=32768', 32 * 1024
+
+def case_key(name, size, label):
+    return '{} size={} {}'.format(name, size, label)
+
+def run(sizes, repeat):
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, function, size, label, parameter in cases(sizes):
+            runs = [function(directory, size, parameter) for i in range(repeat)]
+            best = max(runs, key=lambda result: result['mb_s'])
+            key = case_key(name, size, label)
+            results[key] = best
+            print(format_result(key, best))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def format_result(key, result):
+    syscalls = result['syscalls_per_mb']
+    return '{:45} {:9.1f} MB/s {:9.2f} us/chunk {:>9} syscalls/MB'.format(
+        key, result['mb_s'], result['us_per_chunk'], '-' if syscalls is None else '{:.1f}'.format(syscalls))
+
+def compare(results, baseline, threshold):
+    """
+    prints how @results changed from @baseline, returns the number of regressions
+    """
+
+    regressions = 0
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            old, new = baseline[key].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions += 1
+                print('REGRESSION {:45} {:16} {:10.2f} -> {:10.2f} ({:+.1f}%)'.format(key, metric, old, new, change))
+    return regressions
+
+def parse_sizes(text):
+    return [int(float(size) * MB) for size in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stream layer')
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('0.0625,1,16'),
+                        help='Payload sizes in MB, comma separated (default: 0.0625,1,16)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each case, the best is kept (default: 3)')
+    parser.add_argument('--json', metavar='FILE', help='Save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='Compare with results saved with --json')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Percent change that counts as a regression (default: 10)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = run(args.sizes, args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(
+                python=sys.version.split()[0],
+                platform=sys.platform,
+                results=results,
+            ), f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        print('{} regression(s)'.format(regressions))
+        sys.exit(1 if regressions else 0)
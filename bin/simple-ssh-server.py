@@ -9,7 +9,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Launch a really simple SSH server')
     parser.add_argument('port', nargs='?', default=ssh.SSH_PORT, type=int, help='Port (default {})'.format(ssh.SSH_PORT))
     parser.add_argument('host', nargs='?', default='', help='Host')
-    parser.add_argument('--server-key', help='Host key for the server')
+    parser.add_argument('--server-key', action='append', help='Host key for the server (RSA, ECDSA or Ed25519; may be given more than once)')
 
     args = parser.parse_args()
 
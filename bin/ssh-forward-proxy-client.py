@@ -0,0 +1,75 @@
+import os
+import sys
+import errno
+import socket
+import select
+import argparse
+
+# only the standard library is used so that this starts quickly;
+# the relay daemon does all the SSH work
+
+CHUNK_SIZE = 64 * 1024
+
+# tells ssh-forward-proxy.py not to hand over to the daemon again
+NO_DAEMON = 'SSH_FORWARD_PROXY_NO_DAEMON'
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def splice(sock, stdin=0, stdout=1):
+    """
+    copies @stdin to @sock and @sock to @stdout until the daemon closes @sock
+    """
+
+    inputs = [stdin, sock]
+    while sock in inputs:
+        try:
+            r, w, x = select.select(inputs, [], [])
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+
+        if stdin in r:
+            data = os.read(stdin, CHUNK_SIZE)
+            if data:
+                sock.sendall(data)
+            else:
+                # pass the EOF on but keep reading the daemon's output
+                sock.shutdown(socket.SHUT_WR)
+                inputs.remove(stdin)
+
+        if sock in r:
+            data = sock.recv(CHUNK_SIZE)
+            if data:
+                write_all(stdout, data)
+            else:
+                inputs.remove(sock)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Proxy SSH traffic on STDIN to the remote through a running relay daemon')
+    parser.add_argument('socket', help='Unix socket of the relay daemon')
+    parser.add_argument('port', type=int, help='Remote port')
+    parser.add_argument('host', help='Remote host')
+    parser.add_argument('user', help='Username')
+    parser.add_argument('fallback', nargs=argparse.REMAINDER,
+                        help='Command to run instead if the daemon is not running, e.g. the ssh-forward-proxy.py relay command')
+
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+    except socket.error as e:
+        if args.fallback:
+            # nothing has been read from stdin yet, so the fallback gets all of it
+            sock.close()
+            os.environ[NO_DAEMON] = '1'
+            os.execv(args.fallback[0], args.fallback)
+        sys.stderr.write('Could not connect to relay daemon on {}: {}\n'.format(args.socket, e))
+        sys.exit(255)
+
+    sock.sendall('{} {} {}\n'.format(args.port, args.host, args.user).encode('utf-8'))
+    splice(sock)
+    sock.close()
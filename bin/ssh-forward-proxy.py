@@ -1,18 +1,82 @@
+import os
+import sys
 import logging
 import argparse
 
-logging.basicConfig(level=logging.INFO)
-
+# cheap: the parts that need paramiko are only imported when used
 import ssh_forward_proxy as ssh
 
+# set by ssh-forward-proxy-client.py when it runs this again because the daemon is not running
+NO_DAEMON = 'SSH_FORWARD_PROXY_NO_DAEMON'
+
+def parse_tuning(text):
+    try:
+        return ssh.Tuning.parse(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_host_tuning(text):
+    host, _, options = text.partition('=')
+    return host, parse_tuning(options)
+
+def add_server_arguments(sub):
+    sub.add_argument('--pool-max-sessions', type=int, default=ssh.UpstreamPool.max_sessions,
+                     help='Max concurrent sessions on one pooled remote connection (default: {})'.format(ssh.UpstreamPool.max_sessions))
+    sub.add_argument('--pool-idle-timeout', type=float, default=ssh.UpstreamPool.idle_timeout,
+                     help='Seconds before an idle pooled remote connection is closed (default: {})'.format(ssh.UpstreamPool.idle_timeout))
+    sub.add_argument('--max-sessions', type=int,
+                     help='Max concurrent sessions; further connections wait in a queue (default: unlimited)')
+    sub.add_argument('--max-queued', type=int, default=100,
+                     help='Max connections waiting for a session; further connections are refused (default: 100)')
+    sub.add_argument('--queue-timeout', type=float, default=30,
+                     help='Seconds a connection may wait for a session (default: 30)')
+    sub.add_argument('--backlog', type=int, default=100,
+                     help='Listen backlog (default: 100)')
+    sub.add_argument('--workers', type=int,
+                     help='Spread connections over this many worker processes; limits apply per worker (default: no workers)')
+    sub.add_argument('--pump-threads', type=int, default=0,
+                     help='Threads relaying data for all sessions; 0 relays each session in its own thread (default: 0)')
+    sub.add_argument('--metrics', metavar='ADDRESS',
+                     help='Serve Prometheus metrics over HTTP on this port, host:port or unix socket path (default: off)')
+    sub.add_argument('--admin-socket', metavar='PATH',
+                     help='Answer thread dump and profiling commands on this unix socket (default: off)')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Forward all SSH requests to remote but authenticating as the proxy')
     parser.add_argument('-i', dest='identity_file',
                         help='Path to identity file (same as ssh -i)')
     parser.add_argument('--no-host-key-check', action='store_true', default=False,
                         help="Same as StrictHostKeyCheck=no option for SSH")
-    parser.add_argument('--server-key',
-                        help='Host key for the server')
+    parser.add_argument('--known-hosts', metavar='FILE',
+                        help='known_hosts file for remote host keys (default: ~/.ssh/known_hosts)')
+    parser.add_argument('--server-key', action='append',
+                        help='Host key for the server (RSA, ECDSA or Ed25519; may be given more than once)')
+    parser.add_argument('--chunk-size', type=int, default=ssh.CHUNK_SIZE,
+                        help='Smallest read size when relaying data (default: {})'.format(ssh.CHUNK_SIZE))
+    parser.add_argument('--max-chunk-size', type=int, default=ssh.MAX_CHUNK_SIZE,
+                        help='Largest read size when relaying bulk data (default: {})'.format(ssh.MAX_CHUNK_SIZE))
+    parser.add_argument('--client-tuning', metavar='OPTIONS', type=parse_tuning,
+                        help='Window, packet and rekey sizes for client connections, e.g. window_size=16M,rekey_bytes=4G')
+    parser.add_argument('--upstream-tuning', metavar='OPTIONS', type=parse_tuning,
+                        help='Window, packet and rekey sizes for remote connections')
+    parser.add_argument('--host-tuning', metavar='HOST=OPTIONS', type=parse_host_tuning, action='append', default=[],
+                        help='--upstream-tuning for one remote (host or host:port; may be given more than once)')
+    parser.add_argument('--auto-tune', action='store_true', default=False,
+                        help='Grow remote connection windows to fit the measured round trip time and throughput')
+    parser.add_argument('--client-profile', choices=sorted(ssh.CRYPTO_PROFILES),
+                        help='Ciphers, key exchanges and MACs to offer clients (default: compat)')
+    parser.add_argument('--upstream-profile', choices=sorted(ssh.CRYPTO_PROFILES),
+                        help='Ciphers, key exchanges and MACs to offer remotes (default: compat)')
+    parser.add_argument('--client-compression', choices=ssh.Compression.MODES,
+                        help='zlib compression for client connections if the client asks for it (default: off)')
+    parser.add_argument('--upstream-compression', choices=ssh.Compression.MODES,
+                        help='zlib compression for remote connections if the remote allows it (default: off)')
+    parser.add_argument('--compression-level', type=int, default=ssh.Compression.level, choices=range(10),
+                        metavar='0-9', help='zlib compression level (default: {})'.format(ssh.Compression.level))
+    parser.add_argument('--trace-file', metavar='FILE',
+                        help='Append a trace of the phases of each session to this file as OpenTelemetry JSON (default: off)')
+    parser.add_argument('--sample-latency', metavar='N', type=int, default=0,
+                        help='Time the latency relaying adds to one in every N reads, for the logs and metrics (default: 0, off)')
     subparsers = parser.add_subparsers(dest='command')
     subparsers.required = True
 
@@ -20,23 +84,69 @@ if __name__ == '__main__':
     sub.add_argument('port', type=int, help='Remote port')
     sub.add_argument('host', help='Remote host')
     sub.add_argument('user', help='Username')
+    sub.add_argument('--no-prefetch', action='store_true', default=False,
+                     help='Wait for the client handshake before connecting to the remote')
+    sub.add_argument('--daemon', metavar='SOCKET',
+                     help='Relay through the relay daemon on this unix socket if it is running')
 
     sub = subparsers.add_parser('server', help='Run a standalone SSH server that forwards traffic to the remote')
     sub.add_argument('port', nargs='?', default=ssh.SSH_PORT, type=int,
                      help='Port to run server on (default: {})'.format(ssh.SSH_PORT))
     sub.add_argument('host', nargs='?', default='',
                      help='Host to bind server to')
+    add_server_arguments(sub)
+
+    sub = subparsers.add_parser('daemon', help='Run a relay daemon on a unix socket for ssh-forward-proxy-client.py')
+    sub.add_argument('socket', help='Path of the unix socket to listen on')
+    add_server_arguments(sub)
 
     args = parser.parse_args()
 
     kwargs = dict(
         key_filename = args.identity_file,
         host_key_check = not args.no_host_key_check,
+        known_hosts = args.known_hosts,
         server_key = args.server_key,
+        chunk_size = args.chunk_size,
+        max_chunk_size = args.max_chunk_size,
+        client_tuning = args.client_tuning,
+        client_profile = args.client_profile,
     )
+    if args.client_compression:
+        kwargs['client_compression'] = ssh.Compression(args.client_compression, args.compression_level)
+    if args.upstream_compression:
+        kwargs['upstream_compression'] = ssh.Compression(args.upstream_compression, args.compression_level)
+    if args.upstream_profile:
+        kwargs['upstream_profile'] = args.upstream_profile
+    if args.upstream_tuning or args.host_tuning or args.auto_tune:
+        kwargs['upstream_tuning'] = ssh.UpstreamTuning(args.upstream_tuning, dict(args.host_tuning), auto=args.auto_tune)
+    if args.sample_latency:
+        ssh.get_relay_latency().enable(args.sample_latency)
+    if args.trace_file:
+        ssh.get_tracer().export_to(args.trace_file)
     if args.command == 'relay':
+        # no test connection to the daemon, which would count as a (broken) relay;
+        # the client runs this again without the daemon if it cannot connect
+        if args.daemon and os.path.exists(args.daemon) and not os.environ.get(NO_DAEMON):
+            client = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ssh-forward-proxy-client.py')
+            fallback = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+            os.execv(sys.executable, [sys.executable, client, args.daemon, str(args.port), args.host, args.user] + fallback)
+
         # no logging in relay since stderr is piped to SSH client
         logging.disable(level=logging.CRITICAL)
-        ssh.Proxy(username=args.user, host=args.host, port=args.port, **kwargs)
-    elif args.command == 'server':
-        ssh.run_server(args.host, args.port, worker=ssh.ProxyServer, **kwargs)
+        ssh.Proxy(username=args.user, host=args.host, port=args.port, prefetch=not args.no_prefetch, **kwargs)
+    else:
+        logging.basicConfig(level=logging.INFO)
+        kwargs.update(
+            pool = ssh.UpstreamPool(max_sessions=args.pool_max_sessions, idle_timeout=args.pool_idle_timeout),
+            pump = ssh.Pump(args.pump_threads) if args.pump_threads else None,
+            limiter = ssh.SessionLimiter(args.max_sessions, args.max_queued, args.queue_timeout),
+            backlog = args.backlog,
+            workers = args.workers,
+            metrics = ssh.MetricsServer(args.metrics) if args.metrics else None,
+            admin = ssh.AdminServer(args.admin_socket) if args.admin_socket else None,
+        )
+        if args.command == 'server':
+            ssh.run_server(args.host, args.port, worker=ssh.ProxyServer, **kwargs)
+        elif args.command == 'daemon':
+            ssh.run_daemon(args.socket, **kwargs)
@@ -14,11 +14,14 @@ setup(
     author = 'Cheney Lin',
     author_email = 'lincheney@gmail.com',
     packages = ['ssh_forward_proxy'],
-    scripts = ['bin/ssh-forward-proxy.py'],
+    scripts = ['bin/ssh-forward-proxy.py', 'bin/ssh-forward-proxy-client.py'],
 
     package_data = {'ssh_forward_proxy': ['server-key']},
 
-    install_requires = ['paramiko'],
+    # PKey.from_type_string and SSHClient.connect(transport_factory=...)
+    install_requires = ['paramiko>=3.2'],
+    # module __getattr__ for the lazy imports
+    python_requires = '>=3.7',
 
     tests_require = tests_require,
     test_suite = "tests",
@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+import logging
+
+import paramiko
+
+from .keys import load_key
+
+# tried by SSHClient when look_for_keys is set
+DEFAULT_IDENTITIES = ['~/.ssh/id_rsa', '~/.ssh/id_ecdsa', '~/.ssh/id_ed25519']
+
+def locked_sign(key, lock):
+    sign = key.sign_ssh_data
+    def sign_ssh_data(*args, **kwargs):
+        with lock:
+            return sign(*args, **kwargs)
+    key.sign_ssh_data = sign_ssh_data
+    return key
+
+class Identities:
+    """
+    Keys for authenticating to remotes, shared by all connections: identity
+    files are decrypted once (and again when they change) and the SSH agent
+    is asked for its keys over one connection, renewed every agent_max_age seconds.
+
+    The key that last worked for each (user, host, port) is tried first
+    so a remote that accepts e.g. the 10th agent key costs one attempt, not 10.
+    """
+
+    agent_max_age = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.agent = None
+        self.agent_keys = []
+        self.agent_time = 0
+        self.last_key = {}
+        self.connects = 0
+        self.attempts = 0
+
+    def load_file(self, path):
+        """
+        returns the key in the identity file at @path, or None if it cannot be loaded
+        """
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        with self.lock:
+            cached = self.files.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            key = load_key(path)
+        except (IOError, OSError, paramiko.SSHException) as e:
+            logging.error('Failed to load identity file %s: %s', path, e)
+            key = None
+        with self.lock:
+            self.files[path] = (mtime, key)
+        return key
+
+    def get_agent_keys(self):
+        with self.lock:
+            if self.agent is not None and time.time() - self.agent_time < self.agent_max_age:
+                return self.agent_keys
+
+        # the old connection is left to be garbage collected
+        # since other connections may still be using its keys
+        agent = paramiko.Agent()
+        # the agent connection is shared, so one request at a time
+        agent_lock = threading.Lock()
+        keys = [locked_sign(key, agent_lock) for key in agent.get_keys()]
+        with self.lock:
+            self.agent, self.agent_keys, self.agent_time = agent, keys, time.time()
+        return keys
+
+    def reset_agent(self):
+        """
+        reconnects to the agent next time, e.g. after it failed to sign
+        """
+
+        with self.lock:
+            self.agent_time = 0
+
+    def get(self, remote, key_filename=None, allow_agent=True, look_for_keys=True):
+        """
+        returns the keys to try for @remote in the order SSHClient would
+        (identity files, agent, default identity files), the last one to work first
+        """
+
+        if isinstance(key_filename, str):
+            key_filename = [key_filename]
+
+        keys = [self.load_file(p) for p in key_filename or ()]
+        if allow_agent:
+            try:
+                keys += self.get_agent_keys()
+            except paramiko.SSHException as e:
+                logging.error('Failed to get keys from the SSH agent: %s', e)
+        if look_for_keys:
+            keys += [self.load_file(os.path.expanduser(p)) for p in DEFAULT_IDENTITIES]
+
+        with self.lock:
+            last = self.last_key.get(remote)
+
+        ordered = []
+        seen = set()
+        for key in keys:
+            if key is None or key.asbytes() in seen:
+                continue
+            seen.add(key.asbytes())
+            if key.asbytes() == last:
+                ordered.insert(0, key)
+            else:
+                ordered.append(key)
+        return ordered
+
+    def connect(self, client, host, port, username, key_filename=None, allow_agent=True, look_for_keys=True, **kwargs):
+        """
+        connects @client like SSHClient.connect() but with the shared keys
+        returns the number of keys tried
+        """
+
+        remote = (username, host, port)
+        keys = self.get(remote, key_filename, allow_agent, look_for_keys)
+        if not keys:
+            # e.g. password authentication
+            client.connect(host, port, username=username, key_filename=key_filename,
+                           allow_agent=allow_agent, look_for_keys=look_for_keys, **kwargs)
+            return 0
+
+        attempts = 0
+        error = None
+        for key in keys:
+            attempts += 1
+            try:
+                if attempts == 1:
+                    client.connect(host, port, username=username, pkey=key,
+                                   allow_agent=False, look_for_keys=False, **kwargs)
+                else:
+                    # more keys on the same connection
+                    client.get_transport().auth_publickey(username, key)
+                break
+            except paramiko.AuthenticationException as e:
+                error = e
+            except paramiko.SSHException:
+                if isinstance(key, paramiko.AgentKey):
+                    # e.g. the agent went away
+                    self.reset_agent()
+                self.record(attempts)
+                raise
+        else:
+            self.record(attempts)
+            raise error
+
+        self.record(attempts)
+        with self.lock:
+            self.last_key[remote] = key.asbytes()
+        logging.info('Authenticated as %s@%s:%s after %d attempt(s)', username, host, port, attempts)
+        return attempts
+
+    def record(self, attempts):
+        with self.lock:
+            self.connects += 1
+            self.attempts += attempts
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                connects=self.connects,
+                attempts=self.attempts,
+                remotes=len(self.last_key),
+            )
+
+_identities = Identities()
+
+def get_identities():
+    return _identities
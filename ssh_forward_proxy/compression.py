@@ -0,0 +1,159 @@
+import zlib
+import struct
+import threading
+import logging
+
+from .util import monotonic
+
+# largest deflate stored block
+MAX_STORED_BLOCK = 0xffff
+
+def stored_blocks(data):
+    """
+    returns @data as deflate stored (uncompressed) blocks, which can follow
+    a full flush anywhere in a zlib stream
+    """
+
+    out = []
+    for i in range(0, len(data), MAX_STORED_BLOCK):
+        block = data[i:i + MAX_STORED_BLOCK]
+        out.append(b'\x00' + struct.pack('<HH', len(block), len(block) ^ 0xffff) + block)
+    return b''.join(out)
+
+class Compressor:
+    """
+    Compresses outgoing packets for one transport, like paramiko's ZlibCompressor
+
+    If its Compression is adaptive, every sample_size bytes it checks that
+    compressing saves at least min_saving of them, and if not sends the next
+    retry_bytes as stored blocks, which cost no more than a copy, before trying again.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.z = zlib.compressobj(compression.level)
+        self.enabled = True
+        self.sample_in = self.sample_out = 0
+        self.skipped = 0
+
+    def __call__(self, data):
+        compression = self.compression
+        if not self.enabled:
+            self.skipped += len(data)
+            if self.skipped < compression.retry_bytes:
+                out = stored_blocks(data)
+                compression.record_out(len(data), len(out), 0)
+                return out
+            self.enabled = True
+
+        started = monotonic()
+        # a full flush leaves nothing for later packets to refer back to,
+        # so stored blocks can be sent in between
+        out = self.z.compress(data) + self.z.flush(zlib.Z_FULL_FLUSH)
+        compression.record_out(len(data), len(out), monotonic() - started)
+
+        if compression.adaptive:
+            self.sample_in += len(data)
+            self.sample_out += len(out)
+            if self.sample_in >= compression.sample_size:
+                if self.sample_out > self.sample_in * (1 - compression.min_saving):
+                    logging.debug('Compression saved %d of %d bytes, pausing it',
+                                  self.sample_in - self.sample_out, self.sample_in)
+                    self.enabled = False
+                    self.skipped = 0
+                    compression.record_paused()
+                self.sample_in = self.sample_out = 0
+        return out
+
+class Decompressor:
+    def __init__(self, compression):
+        self.compression = compression
+        self.z = zlib.decompressobj()
+
+    def __call__(self, data):
+        out = self.z.decompress(data)
+        self.compression.record_in(len(data), len(out))
+        return out
+
+class Compression:
+    """
+    zlib compression for the SSH transports of one leg of the proxy,
+    with byte counters for all of them
+
+    @mode is "off", "on" or "adaptive" (see Compressor). The other end
+    has to agree to compression for it to be used, e.g. ssh -C.
+    """
+
+    MODES = ('off', 'on', 'adaptive')
+
+    level = 6
+    sample_size = 1024 * 1024
+    min_saving = 0.1
+    retry_bytes = 64 * 1024 * 1024
+
+    def __init__(self, mode='on', level=None):
+        if mode not in self.MODES:
+            raise ValueError('Unknown compression mode: {!r}'.format(mode))
+        self.mode = mode
+        if level is not None:
+            self.level = level
+        self.lock = threading.Lock()
+        self.raw_out = self.compressed_out = 0
+        self.raw_in = self.compressed_in = 0
+        self.cpu_time = 0
+        self.paused = 0
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    @property
+    def adaptive(self):
+        return self.mode == 'adaptive'
+
+    def apply(self, transport):
+        """
+        offers compression on the paramiko Transport @transport (for SSHClient,
+        pass compress=enabled to connect() instead) and counts its bytes
+        """
+
+        transport.use_compression(self.enabled)
+        # paramiko has no public way to choose the compressor
+        transport._compression_info = dict(transport._compression_info)
+        for name in ('zlib', 'zlib@openssh.com'):
+            transport._compression_info[name] = (lambda: Compressor(self), lambda: Decompressor(self))
+        return transport
+
+    def transport_factory(self, factory):
+        """
+        wraps the Transport @factory (see SSHClient.connect) to count its bytes
+        """
+
+        return lambda sock, **kwargs: self.apply(factory(sock, **kwargs))
+
+    def record_out(self, raw, compressed, cpu_time):
+        with self.lock:
+            self.raw_out += raw
+            self.compressed_out += compressed
+            self.cpu_time += cpu_time
+
+    def record_in(self, compressed, raw):
+        with self.lock:
+            self.compressed_in += compressed
+            self.raw_in += raw
+
+    def record_paused(self):
+        with self.lock:
+            self.paused += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                mode=self.mode,
+                raw_out=self.raw_out,
+                compressed_out=self.compressed_out,
+                raw_in=self.raw_in,
+                compressed_in=self.compressed_in,
+                cpu_time=self.cpu_time,
+                paused=self.paused,
+            )
@@ -0,0 +1,86 @@
+class CryptoProfile:
+    """
+    Preferred ciphers, key exchanges, MACs and host key types for an SSH
+    transport, most preferred first; None leaves paramiko's defaults
+
+    Algorithms this version of paramiko does not support are left out.
+    """
+
+    FIELDS = (
+        # (attribute, SecurityOptions attribute)
+        ('ciphers', 'ciphers'),
+        ('kex', 'kex'),
+        ('macs', 'digests'),
+        ('key_types', 'key_types'),
+    )
+
+    def __init__(self, name, ciphers=None, kex=None, macs=None, key_types=None):
+        self.name = name
+        self.ciphers = ciphers
+        self.kex = kex
+        self.macs = macs
+        self.key_types = key_types
+
+    def apply(self, transport):
+        """
+        sets the preferences of the paramiko Transport @transport before it negotiates
+        """
+
+        options = transport.get_security_options()
+        for field, option in self.FIELDS:
+            preferred = getattr(self, field)
+            if preferred is None:
+                continue
+            supported = getattr(options, option)
+            preferred = [name for name in preferred if name in supported]
+            if not preferred:
+                raise ValueError('None of the {} in profile {} are supported'.format(field, self.name))
+            setattr(options, option, preferred)
+        return transport
+
+    def transport_factory(self, factory):
+        """
+        wraps the Transport @factory (see SSHClient.connect) to apply this profile
+        """
+
+        return lambda sock, **kwargs: self.apply(factory(sock, **kwargs))
+
+    def __repr__(self):
+        return 'CryptoProfile({!r})'.format(self.name)
+
+CRYPTO_PROFILES = dict((profile.name, profile) for profile in [
+    # AES-GCM relays about 1.7 times as fast as AES-CTR with HMAC in paramiko
+    # (one pass for encryption and MAC, with AES-NI) and curve25519 is the
+    # cheapest KEX. The client's order decides, and OpenSSH prefers CTR to GCM,
+    # so nothing else is offered: clients must support AES-GCM (OpenSSH 6.2+)
+    CryptoProfile(
+        'fast',
+        ciphers=['aes128-gcm@openssh.com', 'aes256-gcm@openssh.com'],
+        kex=['curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256'],
+        macs=['hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256'],
+    ),
+    # everything paramiko supports, for old servers and clients
+    CryptoProfile('compat'),
+    # no CBC, SHA-1 or MD5 and only encrypt-then-MAC
+    CryptoProfile(
+        'strict',
+        ciphers=['aes256-gcm@openssh.com', 'aes128-gcm@openssh.com', 'aes256-ctr', 'aes192-ctr', 'aes128-ctr'],
+        kex=['curve25519-sha256@libssh.org', 'ecdh-sha2-nistp521', 'ecdh-sha2-nistp384', 'ecdh-sha2-nistp256',
+             'diffie-hellman-group16-sha512', 'diffie-hellman-group-exchange-sha256'],
+        macs=['hmac-sha2-512-etm@openssh.com', 'hmac-sha2-256-etm@openssh.com'],
+        key_types=['ssh-ed25519', 'ecdsa-sha2-nistp521', 'ecdsa-sha2-nistp384', 'ecdsa-sha2-nistp256',
+                   'rsa-sha2-512', 'rsa-sha2-256'],
+    ),
+])
+
+def get_crypto_profile(profile):
+    """
+    returns the CryptoProfile named @profile (or @profile itself if it is one)
+    """
+
+    if profile is None or isinstance(profile, CryptoProfile):
+        return profile
+    try:
+        return CRYPTO_PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown crypto profile: {!r}'.format(profile))
@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import threading
+import traceback
+import logging
+
+from .util import monotonic
+
+def label_thread(**labels):
+    """
+    adds @labels (e.g. the session id and remote host) to the current thread in dump_threads()
+    they are kept on the thread object, so they go away with it
+    """
+
+    thread = threading.current_thread()
+    thread.labels = dict(getattr(thread, 'labels', None) or {}, **labels)
+
+def thread_description(thread):
+    labels = getattr(thread, 'labels', None) or {}
+    return ' '.join([thread.name] + ['{}={}'.format(key, value) for key, value in sorted(labels.items())])
+
+def dump_threads():
+    """
+    returns the stack of every thread, each headed by its name and labels
+    """
+
+    threads = dict((thread.ident, thread) for thread in threading.enumerate())
+    lines = []
+    for ident, frame in sorted(sys._current_frames().items()):
+        thread = threads.get(ident)
+        lines.append('Thread {} ({}):'.format(thread_description(thread) if thread else '?', ident))
+        lines += [line.rstrip('\n') for line in traceback.format_stack(frame)]
+        lines.append('')
+    return '\n'.join(lines)
+
+def log_threads(signum=None, frame=None):
+    # a signal handler, so the process carries on afterwards
+    logging.warning('Thread dump (pid %d):\n%s', os.getpid(), dump_threads())
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads every interval seconds, counting
+    each stack in the collapsed format of flamegraph.pl (thread name, then
+    each function from the outermost, separated by semicolons)
+
+    The samples are of wall clock time, so threads waiting in select() or
+    recv() are counted too; the busy stacks are the ones that are not waiting.
+    Only one profile runs at a time.
+    """
+
+    interval = 0.005
+    max_seconds = 600
+
+    def __init__(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        self.lock = threading.Lock()
+
+    def run(self, seconds):
+        """
+        samples for @seconds then returns {collapsed stack: samples}
+        raises RuntimeError if a profile is already running
+        """
+
+        if not self.lock.acquire(False):
+            raise RuntimeError('A profile is already running')
+        try:
+            counts = {}
+            me = threading.get_ident()
+            deadline = monotonic() + min(seconds, self.max_seconds)
+            while monotonic() < deadline:
+                names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    key = ';'.join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+                time.sleep(self.interval)
+            return counts
+        finally:
+            self.lock.release()
+
+def collapsed_stacks(counts):
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(counts.items()))
+
+_profiler = SamplingProfiler()
+
+def get_profiler():
+    return _profiler
+
+# command: help
+ADMIN_COMMANDS = [
+    ('threads', 'stack of every thread, labelled with its session and remote'),
+    ('profile [SECONDS]', 'sample all threads for SECONDS (default 10) and return collapsed stacks for flamegraph.pl'),
+    ('help', 'this list'),
+]
+
+def admin_command(line):
+    """
+    returns the reply to the admin socket command @line
+    """
+
+    args = line.split()
+    if not args:
+        return ''
+    if args[0] == 'threads':
+        return dump_threads()
+    if args[0] == 'profile':
+        try:
+            seconds = float(args[1]) if len(args) > 1 else 10
+        except ValueError:
+            return 'Invalid number of seconds: {}\n'.format(args[1])
+        logging.info('Profiling for %g seconds', seconds)
+        try:
+            return collapsed_stacks(get_profiler().run(seconds))
+        except RuntimeError as e:
+            return '{}\n'.format(e)
+    if args[0] == 'help':
+        return ''.join('{:20} {}\n'.format(command, help) for command, help in ADMIN_COMMANDS)
+    return 'Unknown command: {} (try help)\n'.format(args[0])
+
+class AdminServer:
+    """
+    Answers commands (see ADMIN_COMMANDS) on the unix socket @path, one
+    command per connection, each in its own thread so a long profile does
+    not hold up the server or other commands
+
+    Like MetricsServer, it is started on first use in each process; worker
+    processes listen on @path with their worker number appended (.0, .1, ...).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.server = None
+        self.pid = None
+
+    def start(self, slot=None):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            path = self.path if slot is None else '{}.{}'.format(self.path, slot)
+            self.server = make_admin_server(path)
+            self.pid = os.getpid()
+
+        thread = threading.Thread(target=self.server.serve_forever, name='admin')
+        thread.daemon = True
+        thread.start()
+        logging.info('Admin socket on %s', self.server.server_address)
+
+    @property
+    def server_address(self):
+        return self.server.server_address if self.server else None
+
+    def close(self):
+        with self.lock:
+            server, self.server, self.pid = self.server, None, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            try:
+                os.unlink(server.server_address)
+            except OSError:
+                pass
+
+def make_admin_server(path):
+    # only imported by the processes with an admin socket
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline(1024).decode('utf-8', 'replace')
+            self.wfile.write(admin_command(line).encode('utf-8'))
+
+    if os.path.exists(path):
+        # left behind by a previous run
+        os.unlink(path)
+    # only the user running the server may use it
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    return server
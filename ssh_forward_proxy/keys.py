@@ -0,0 +1,307 @@
+import os
+import io
+import atexit
+import base64
+import binascii
+import threading
+import time
+import logging
+import pkgutil
+
+import paramiko
+
+from .util import SSH_PORT
+
+# tried in order when loading a key file of unknown type
+KEY_CLASSES = [paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey]
+
+def load_key(filename=None, file_obj=None):
+    """
+    loads a private key of any supported type (Ed25519, ECDSA or RSA)
+    """
+
+    if file_obj is not None:
+        data = file_obj.read()
+    else:
+        with open(filename) as f:
+            data = f.read()
+
+    error = None
+    for cls in KEY_CLASSES:
+        try:
+            return cls.from_private_key(io.StringIO(data))
+        except (paramiko.SSHException, ValueError) as e:
+            error = e
+    raise paramiko.SSHException('Unable to load server key {}: {}'.format(filename or '', error))
+
+def default_server_key():
+    data = pkgutil.get_data(__name__, 'server-key').decode('ascii')
+    return paramiko.RSAKey(file_obj=io.StringIO(data))
+
+class ServerKeys:
+    """
+    Host keys for the server, loaded once and shared by all sessions.
+    Key files are reloaded when they change on disk (checked at most every
+    check_interval seconds) or when reload() is called (e.g. on SIGHUP).
+    """
+
+    check_interval = 1
+
+    def __init__(self, filenames=None):
+        self.filenames = tuple(filenames or ())
+        self.lock = threading.Lock()
+        self.keys = []
+        self.mtimes = None
+        self.last_check = 0
+        self.reload()
+
+    def get_mtimes(self):
+        return [os.stat(f).st_mtime for f in self.filenames]
+
+    def reload(self):
+        with self.lock:
+            mtimes = self.get_mtimes()
+            if self.filenames:
+                keys = [load_key(f) for f in self.filenames]
+            else:
+                keys = [default_server_key()]
+            self.keys, self.mtimes = keys, mtimes
+            self.last_check = time.time()
+        logging.debug('Loaded server keys: %s', ', '.join(k.get_name() for k in keys))
+
+    def check(self):
+        now = time.time()
+        if not self.filenames or now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            if self.get_mtimes() != self.mtimes:
+                logging.info('Server keys changed, reloading')
+                self.reload()
+        except (OSError, IOError, paramiko.SSHException) as e:
+            # keep using the old keys
+            logging.error('Failed to reload server keys: %s', e)
+
+    def get(self):
+        self.check()
+        return self.keys
+
+_server_keys = {}
+_server_keys_lock = threading.Lock()
+
+def get_server_keys(server_key=None):
+    """
+    returns the shared ServerKeys for @server_key, which may be None (use the
+    default key), a filename, a list of filenames or a ServerKeys
+    """
+
+    if isinstance(server_key, ServerKeys):
+        return server_key
+    if server_key is None:
+        server_key = ()
+    elif isinstance(server_key, str):
+        server_key = (server_key,)
+    server_key = tuple(server_key)
+
+    with _server_keys_lock:
+        if server_key not in _server_keys:
+            _server_keys[server_key] = ServerKeys(server_key)
+        return _server_keys[server_key]
+
+def reload_server_keys(*args):
+    """
+    reloads all loaded server keys; usable as a signal handler
+    """
+
+    with _server_keys_lock:
+        keys = list(_server_keys.values())
+    for k in keys:
+        try:
+            k.reload()
+        except (OSError, IOError, paramiko.SSHException) as e:
+            logging.error('Failed to reload server keys: %s', e)
+
+def known_host_name(host, port):
+    """
+    the name for @host in known_hosts files: [host]:port if not on the standard port
+    """
+
+    if port == SSH_PORT:
+        return host
+    return '[{}]:{}'.format(host, port)
+
+class KnownHosts:
+    """
+    Host keys for remotes from a known_hosts file, loaded once and shared by
+    all connections instead of every connection parsing the whole file.
+
+    Plain hostnames are indexed. Hashed ones (HashKnownHosts) each have their
+    own salt so can only be checked one by one; the result of looking a host
+    up is kept until the file is reloaded. Key data is only decoded for hosts
+    that are looked up. Like ServerKeys, the file is reloaded when it changes.
+
+    Keys learned for new hosts are appended to the file in batches,
+    at most every flush_interval seconds.
+    """
+
+    check_interval = 1
+    flush_interval = 5
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.expanduser('~/.ssh/known_hosts')
+        self.lock = threading.Lock()
+        # held while reading or writing the file, so a reload never installs
+        # what it read from before a flush along with the mtime from after it
+        self.file_lock = threading.Lock()
+        self.names = {}
+        self.hashed = []
+        self.cache = {}
+        self.pending = []
+        self.flush_timer = None
+        self.mtime = None
+        self.last_check = 0
+        self.reload()
+        # don't lose the last batch
+        atexit.register(self.flush)
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        with self.file_lock:
+            names = {}
+            hashed = []
+            mtime = self.get_mtime()
+            if mtime is not None:
+                with open(self.filename) as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) < 3 or fields[0].startswith('#') or fields[0].startswith('@'):
+                            # @cert-authority and @revoked are not supported (nor are they by paramiko)
+                            continue
+                        entry = (fields[1], fields[2])
+                        for name in fields[0].split(','):
+                            if name.startswith('|1|'):
+                                hashed.append((name, entry))
+                            else:
+                                names.setdefault(name, []).append(entry)
+
+            with self.lock:
+                self.names, self.hashed, self.cache = names, hashed, {}
+                self.mtime = mtime
+                self.last_check = time.time()
+                # learned but not written yet
+                for name, key in self.pending:
+                    names.setdefault(name, []).append((key.get_name(), key.get_base64()))
+        logging.debug('Loaded %d known hosts from %s', len(names) + len(hashed), self.filename)
+
+    def check(self):
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            if self.get_mtime() != self.mtime:
+                logging.info('%s changed, reloading', self.filename)
+                self.reload()
+        except (OSError, IOError) as e:
+            logging.error('Failed to reload %s: %s', self.filename, e)
+
+    def lookup(self, name):
+        """
+        returns a list of the keys for the host @name (see known_host_name)
+        """
+
+        self.check()
+        with self.lock:
+            keys = self.cache.get(name)
+            if keys is not None:
+                return keys
+            entries = list(self.names.get(name, ()))
+            hashed = self.hashed
+
+        for hashed_name, entry in hashed:
+            if paramiko.HostKeys.hash_host(name, hashed_name) == hashed_name:
+                entries.append(entry)
+
+        keys = []
+        for keytype, data in entries:
+            try:
+                keys.append(paramiko.PKey.from_type_string(keytype, base64.b64decode(data)))
+            except (paramiko.SSHException, ValueError, binascii.Error) as e:
+                logging.debug('Ignoring %s key for %s: %s', keytype, name, e)
+
+        with self.lock:
+            self.cache[name] = keys
+        return keys
+
+    def add(self, name, key):
+        """
+        trusts @key for the host @name from now on and saves it to the file with the next batch
+        """
+
+        with self.lock:
+            self.names.setdefault(name, []).append((key.get_name(), key.get_base64()))
+            self.cache.pop(name, None)
+            self.pending.append((name, key))
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        """
+        appends the keys learned since the last flush to the file
+        """
+
+        with self.file_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                timer, self.flush_timer = self.flush_timer, None
+            if timer:
+                timer.cancel()
+            if not pending:
+                return
+
+            lines = ''.join('{} {} {}\n'.format(name, key.get_name(), key.get_base64()) for name, key in pending)
+            try:
+                with open(self.filename, 'a') as f:
+                    f.write(lines)
+            except (OSError, IOError) as e:
+                logging.error('Failed to save host keys to %s: %s', self.filename, e)
+                return
+
+            with self.lock:
+                # our own write, no need to reload
+                self.mtime = self.get_mtime()
+        logging.info('Saved %d host keys to %s', len(pending), self.filename)
+
+class KnownHostsPolicy(paramiko.MissingHostKeyPolicy):
+    """
+    Accepts host keys for unknown remotes like paramiko's AutoAddPolicy,
+    adding them to the shared KnownHosts
+    """
+
+    def __init__(self, known_hosts):
+        self.known_hosts = known_hosts
+
+    def missing_host_key(self, client, hostname, key):
+        logging.info('Adding %s host key for %s', key.get_name(), hostname)
+        client.get_host_keys().add(hostname, key.get_name(), key)
+        self.known_hosts.add(hostname, key)
+
+_known_hosts = {}
+_known_hosts_lock = threading.Lock()
+
+def get_known_hosts(filename=None):
+    """
+    returns the shared KnownHosts for @filename (default ~/.ssh/known_hosts)
+    """
+
+    with _known_hosts_lock:
+        if filename not in _known_hosts:
+            _known_hosts[filename] = KnownHosts(filename)
+        return _known_hosts[filename]
@@ -0,0 +1,133 @@
+import math
+import threading
+import logging
+
+from .util import monotonic
+
+# latency percentiles reported by LatencyHistogram.stats()
+LATENCY_PERCENTILES = [50, 90, 99, 99.9]
+
+class LatencyHistogram:
+    """
+    Counts of latencies in HDR-style buckets: each doubling from lowest
+    seconds up is split into sub_buckets equal buckets, so percentiles are
+    within 1/sub_buckets of the real values whether they are microseconds
+    or seconds, with a few hundred buckets at most
+    """
+
+    lowest = 1e-6
+    sub_buckets = 16
+
+    def __init__(self, lowest=None, sub_buckets=None):
+        if lowest is not None:
+            self.lowest = lowest
+        if sub_buckets is not None:
+            self.sub_buckets = sub_buckets
+        self.lock = threading.Lock()
+        # bucket index: count
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def index(self, value):
+        # value / lowest = mantissa * 2 ** exponent with mantissa in [0.5, 1)
+        mantissa, exponent = math.frexp(max(value, self.lowest) / self.lowest)
+        return exponent * self.sub_buckets + int((mantissa * 2 - 1) * self.sub_buckets)
+
+    def upper_bound(self, index):
+        exponent, sub_bucket = divmod(index, self.sub_buckets)
+        return math.ldexp(0.5 + 0.5 * (sub_bucket + 1) / self.sub_buckets, exponent) * self.lowest
+
+    def record(self, value):
+        index = self.index(value)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """
+        returns the upper bound of the bucket holding the @p th percentile, or 0 if empty
+        """
+
+        with self.lock:
+            counts = sorted(self.counts.items())
+            rank = p / 100.0 * self.count
+            seen = 0
+            for index, count in counts:
+                seen += count
+                if seen >= rank:
+                    return min(self.upper_bound(index), self.max)
+            return 0
+
+    def stats(self):
+        stats = dict(('p{:g}'.format(p).replace('.', '_'), self.percentile(p)) for p in LATENCY_PERCENTILES)
+        with self.lock:
+            stats.update(count=self.count, mean=self.sum / self.count if self.count else 0, max=self.max)
+        return stats
+
+class RelayLatency:
+    """
+    Samples the latency relaying adds to the data of each direction: the time
+    from a stream being ready to read to the last of the bytes read being
+    written to the other side, for one in every sample_every readiness events
+    (0, the default, samples none)
+
+    Unsampled reads cost one counter increment. The percentiles are logged
+    every log_interval seconds while samples come in.
+    """
+
+    sample_every = 0
+    log_interval = 60
+
+    def __init__(self, sample_every=None):
+        if sample_every is not None:
+            self.sample_every = sample_every
+        self.upstream = LatencyHistogram()
+        self.downstream = LatencyHistogram()
+        # not locked: the pump threads only race to decide which events are sampled
+        self.events = 0
+        self.logged_at = monotonic()
+
+    def enable(self, sample_every):
+        self.sample_every = sample_every
+
+    def sample(self):
+        """
+        whether to time this readiness event
+        """
+
+        if not self.sample_every:
+            return False
+        self.events += 1
+        return self.events % self.sample_every == 0
+
+    def record(self, direction, seconds):
+        getattr(self, direction).record(seconds)
+        now = monotonic()
+        if now - self.logged_at >= self.log_interval:
+            self.logged_at = now
+            logging.info('Relay latency: %s', self.summary())
+
+    def summary(self):
+        parts = []
+        for direction in ('upstream', 'downstream'):
+            stats = getattr(self, direction).stats()
+            parts.append('{} n={} p50={:.3f}ms p99={:.3f}ms max={:.3f}ms'.format(
+                direction, stats['count'], stats['p50'] * 1000, stats['p99'] * 1000, stats['max'] * 1000))
+        return ', '.join(parts)
+
+    def stats(self):
+        stats = {}
+        for direction in ('upstream', 'downstream'):
+            for key, value in getattr(self, direction).stats().items():
+                stats['{}_{}'.format(direction, key)] = value
+        return stats
+
+_relay_latency = RelayLatency()
+
+def get_relay_latency():
+    return _relay_latency
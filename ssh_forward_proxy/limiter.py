@@ -0,0 +1,77 @@
+import threading
+import time
+
+class SessionLimiter:
+    """
+    Admission control for run_server
+
+    At most max_sessions sessions run at once and at most max_queued more
+    connections wait (for up to queue_timeout seconds) for one to finish.
+    Connections beyond that are rejected as soon as they are accepted,
+    before any SSH handshake.
+    None means no limit.
+    """
+
+    def __init__(self, max_sessions=None, max_queued=0, queue_timeout=None):
+        self.max_sessions = max_sessions
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total = 0
+
+    def admit(self):
+        """
+        called on accept(); returns False if the connection should be rejected
+        """
+
+        with self.condition:
+            if self.max_sessions is not None and self.active + self.queued >= self.max_sessions + self.max_queued:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            return True
+
+    def start(self):
+        """
+        waits for a free session slot for an admitted connection
+        returns False if none came up within queue_timeout
+        """
+
+        deadline = None
+        if self.queue_timeout is not None:
+            deadline = time.time() + self.queue_timeout
+
+        with self.condition:
+            try:
+                while self.max_sessions is not None and self.active >= self.max_sessions:
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            self.rejected += 1
+                            return False
+                    self.condition.wait(timeout)
+
+                self.active += 1
+                self.total += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def finish(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                active=self.active,
+                queued=self.queued,
+                rejected=self.rejected,
+                total=self.total,
+            )
@@ -0,0 +1,336 @@
+import os
+import bisect
+import socket
+import threading
+import logging
+import weakref
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_PREFIX = 'ssh_forward_proxy_'
+
+# relay buffer: (stream, direction)
+RELAY_STREAMS = [('stdin', 'upstream'), ('stdout', 'downstream'), ('stderr', 'downstream')]
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+class Counter:
+    """
+    A value per combination of @labels which only goes up
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = METRIC_PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        """
+        returns [(name, label values, extra labels, value)]
+        """
+
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self, samples=None):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for name, key, extra, value in self.samples() if samples is None else samples:
+            lines.append('{}{} {}'.format(name, format_labels(self.labels, key, extra), format_value(value)))
+        return lines
+
+class Gauge(Counter):
+    """
+    A value per combination of @labels which goes up and down
+    """
+
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Counter):
+    """
+    Counts of observations no greater than each of @buckets, per combination of @labels
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Counter.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # a count per bucket, +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        """
+        returns the number of observations
+        """
+
+        with self.lock:
+            return sum(self.values.get(self.key(labels), [0])[:-1])
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in sorted(self.values.items())]
+
+        samples = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append((self.name + '_bucket', key, [('le', format_value(float(bound)))], total))
+            samples.append((self.name + '_sum', key, (), counts[-1]))
+            samples.append((self.name + '_count', key, (), total))
+        return samples
+
+class Metrics:
+    """
+    The counters of one process, rendered in the Prometheus text format
+
+    Relayed bytes cost nothing on the data path: each Relay already counts
+    the bytes through its buffers, so live relays are summed when the metrics
+    are rendered and their totals are added to the counter once they finish.
+
+    Components with their own stats() (the connection limiter, upstream pool,
+    pump etc.) are added with add_stats() and read when rendered too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = Counter('sessions_total', 'Sessions (exec requests and forwards) started')
+        self.active_sessions = Gauge('sessions_active', 'Sessions in progress')
+        self.relayed_bytes = Counter('relayed_bytes_total', 'Bytes relayed, by stream', ['stream', 'direction', 'host'])
+        self.handshake_seconds = Histogram('handshake_seconds', 'Client SSH handshake time')
+        self.handshake_failures = Counter('handshake_failures_total', 'Client SSH handshakes that failed')
+        self.upstream_sessions = Counter('upstream_sessions_total', 'Sessions relayed to each remote', ['host'])
+        self.upstream_connect_seconds = Histogram('upstream_connect_seconds',
+                                                  'Time to connect and authenticate to a remote', ['host'])
+        self.upstream_connect_failures = Counter('upstream_connect_failures_total',
+                                                 'Failed connections to a remote, other than authentication', ['host'])
+        self.upstream_auth_failures = Counter('upstream_auth_failures_total',
+                                              'Failed authentications to a remote', ['host'])
+        self.metrics = [
+            self.sessions, self.active_sessions, self.relayed_bytes,
+            self.handshake_seconds, self.handshake_failures,
+            self.upstream_sessions, self.upstream_connect_seconds,
+            self.upstream_connect_failures, self.upstream_auth_failures,
+        ]
+        # relay: host
+        self.relays = weakref.WeakKeyDictionary()
+        # name: (pid, stats function, names of counters)
+        self.stats = {}
+
+    def session_started(self):
+        self.sessions.inc()
+        self.active_sessions.inc()
+
+    def session_finished(self):
+        self.active_sessions.dec()
+
+    def relay_started(self, relay, host=''):
+        with self.lock:
+            self.relays[relay] = host
+
+    def relay_finished(self, relay):
+        with self.lock:
+            host = self.relays.pop(relay, None)
+        if host is None:
+            return
+        for stream, direction in RELAY_STREAMS:
+            self.relayed_bytes.inc(getattr(relay, stream).total, stream=stream, direction=direction, host=host)
+
+    def add_stats(self, name, stats, counters=()):
+        """
+        renders each number in the dict returned by @stats() as ssh_forward_proxy_@name_KEY,
+        a counter if KEY is in @counters and a gauge otherwise
+
+        only in this process: forked workers have their own
+        """
+
+        with self.lock:
+            self.stats[name] = (os.getpid(), stats, set(counters))
+
+    def relayed_samples(self):
+        with self.lock:
+            live = list(self.relays.items())
+        values = dict((key, value) for name, key, extra, value in self.relayed_bytes.samples())
+        for relay, host in live:
+            for stream, direction in RELAY_STREAMS:
+                key = (stream, direction, host)
+                values[key] = values.get(key, 0) + getattr(relay, stream).total
+        return [(self.relayed_bytes.name, key, (), value) for key, value in sorted(values.items())]
+
+    def stats_lines(self):
+        with self.lock:
+            stats = sorted(self.stats.items())
+
+        lines = []
+        for name, (pid, function, counters) in stats:
+            if pid != os.getpid():
+                continue
+            try:
+                values = function()
+            except Exception:
+                logging.exception('Failed to get %s stats', name)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if key not in counters:
+                    metric = Gauge('{}_{}'.format(name, key), '{} stats: {}'.format(name, key))
+                elif key == 'total':
+                    metric = Counter('{}_total'.format(name), '{} stats: {}'.format(name, key))
+                else:
+                    metric = Counter('{}_{}_total'.format(name, key), '{} stats: {}'.format(name, key))
+                lines += metric.render([(metric.name, (), (), value)])
+        return lines
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render(self.relayed_samples() if metric is self.relayed_bytes else None)
+        lines += self.stats_lines()
+        return '\n'.join(lines) + '\n'
+
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+class MetricsServer:
+    """
+    Serves get_metrics() over HTTP for Prometheus to scrape, on @address:
+    a port on localhost, host:port, or the path of a unix socket
+
+    Like Pump, it is started on first use in each process. Worker processes
+    started by run_server(workers=N) each serve their own metrics, on the
+    port after the main process's plus their worker number (or on
+    the unix socket's path with .N appended).
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.server = None
+        self.pid = None
+
+    def parse_address(self, slot=None):
+        """
+        returns (family, address) of the socket for worker @slot (None for the main process)
+        """
+
+        if '/' in self.address:
+            path = self.address if slot is None else '{}.{}'.format(self.address, slot)
+            return socket.AF_UNIX, path
+        host, _, port = self.address.rpartition(':')
+        port = int(port)
+        if slot is not None and port:
+            port += 1 + slot
+        return socket.AF_INET, (host or '127.0.0.1', port)
+
+    def start(self, slot=None):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.server = make_http_server(*self.parse_address(slot))
+            self.pid = os.getpid()
+
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        logging.info('Serving metrics on %s', self.server.server_address)
+
+    @property
+    def server_address(self):
+        return self.server.server_address if self.server else None
+
+    def close(self):
+        with self.lock:
+            server, self.server, self.pid = self.server, None, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            if server.address_family == socket.AF_UNIX:
+                try:
+                    os.unlink(server.server_address)
+                except OSError:
+                    pass
+
+def make_http_server(family, address):
+    # only imported by the processes serving metrics
+    import socketserver
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = get_metrics().render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # unix socket clients have no address
+            return str(self.client_address or 'local')
+
+        def log_message(self, format, *args):
+            logging.debug('Metrics request: ' + format, *args)
+
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            # left behind by a previous run
+            os.unlink(address)
+        # only the user running the server may read the metrics
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        finally:
+            os.umask(umask)
+    else:
+        server = socketserver.ThreadingTCPServer(address, Handler, bind_and_activate=False)
+        server.allow_reuse_address = True
+        server.server_bind()
+        server.server_activate()
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,216 @@
+import os
+import threading
+import logging
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+class PumpThread(threading.Thread):
+    """
+    Services the relays assigned to it with a single selector
+
+    Each relay's streams are registered for reading while it wants to read
+    them and for writing while it has data waiting for them. Channels have
+    no file to wait on for window space, so relays with writes blocked on a
+    channel are retried every poll_interval seconds.
+    """
+
+    poll_interval = 0.01
+
+    def __init__(self, name, selector):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.selector = selector()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.relays = 0
+        self.running = True
+        # relay: {stream: events registered}
+        self.registered = {}
+        # sessions with writes to retry
+        self.polling = set()
+
+        # written to when relays are added so select() wakes up
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    @property
+    def labels(self):
+        # for dump_threads(): the sessions relayed by this thread are labelled on their own threads
+        return dict(relays=self.relays)
+
+    def add(self, relay, callback):
+        with self.lock:
+            self.pending.append((relay, callback))
+            self.relays += 1
+        os.write(self.wakeup_w, b'x')
+
+    def stop(self):
+        self.running = False
+        os.write(self.wakeup_w, b'x')
+
+    def register(self):
+        os.read(self.wakeup_r, 4096)
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        for relay, callback in pending:
+            session = (relay, callback)
+            try:
+                self.sync(session)
+            except Exception as e:
+                logging.error('Failed to register relay: %s', e)
+                self.finish(session, False)
+
+    def sync(self, session):
+        """
+        registers the streams of @session for the events its relay is waiting for
+        """
+
+        relay = session[0]
+        wanted = {}
+        for stream in relay.streams:
+            wanted[stream] = selectors.EVENT_READ
+        for stream in relay.write_streams:
+            wanted[stream] = wanted.get(stream, 0) | selectors.EVENT_WRITE
+
+        registered = self.registered.setdefault(relay, {})
+        for stream in list(registered):
+            if stream not in wanted:
+                self.unregister(stream)
+                del registered[stream]
+        for stream, events in wanted.items():
+            if stream not in registered:
+                self.selector.register(stream, events, session)
+            elif registered[stream] != events:
+                self.selector.modify(stream, events, session)
+            registered[stream] = events
+
+        if relay.polling:
+            self.polling.add(session)
+        else:
+            self.polling.discard(session)
+
+    def unregister(self, stream):
+        try:
+            self.selector.unregister(stream)
+        except (KeyError, ValueError):
+            pass
+
+    def update(self, session):
+        if session[0].done:
+            self.finish(session, True)
+        else:
+            self.sync(session)
+
+    def finish(self, session, completed):
+        relay, callback = session
+        for stream in self.registered.pop(relay, {}):
+            self.unregister(stream)
+        self.polling.discard(session)
+
+        with self.lock:
+            self.relays -= 1
+        try:
+            callback(completed)
+        except Exception:
+            logging.exception('Error finishing relay')
+
+    def step(self, session, func, *args):
+        try:
+            func(*args)
+            self.update(session)
+        except Exception:
+            logging.exception('Error relaying data')
+            session[0].done = True
+            self.finish(session, False)
+
+    def run(self):
+        while self.running:
+            timeout = self.poll_interval if self.polling else None
+            for key, events in self.selector.select(timeout):
+                session = key.data
+                if session is None:
+                    self.register()
+                    continue
+
+                relay = session[0]
+                if relay.done:
+                    # already finished by another of its streams
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.step(session, relay.handle, key.fileobj)
+                else:
+                    self.step(session, relay.flush)
+
+            for session in list(self.polling):
+                if not session[0].done:
+                    self.step(session, session[0].flush)
+
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+class Pump:
+    """
+    Relays the streams of many sessions with a small number of threads,
+    each multiplexing its sessions with selectors (epoll on Linux)
+    instead of one thread blocking in pipe_streams per session
+
+    Threads are started on first use in each process, so a Pump made before
+    forking worker processes works in each of them.
+    """
+
+    def __init__(self, threads=2, selector=None):
+        self.num_threads = threads
+        self.selector = selector or selectors.DefaultSelector
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.threads = []
+            for i in range(self.num_threads):
+                thread = PumpThread('pump-{}'.format(i), self.selector)
+                thread.start()
+                self.threads.append(thread)
+            self.pid = os.getpid()
+
+    def add(self, relay, callback):
+        """
+        relays @relay on the least busy thread and calls @callback(completed)
+        from that thread once it is done
+        completed is False if the relay stopped because of an error
+        """
+
+        self.start()
+        thread = min(self.threads, key=lambda t: t.relays)
+        thread.add(relay, callback)
+
+    def close(self):
+        """
+        stops the pump threads; relays still in progress are abandoned
+        """
+
+        with self.lock:
+            if self.pid != os.getpid():
+                # the threads belong to the parent of a forked process
+                threads = []
+            else:
+                threads = self.threads
+            self.threads, self.pid = [], None
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
+            thread.join()
+
+    def stats(self):
+        return dict(
+            threads=self.num_threads,
+            relays=sum(t.relays for t in self.threads),
+        )
@@ -0,0 +1,212 @@
+import os
+import socket
+import selectors
+import errno
+import threading
+import logging
+
+from .util import monotonic, split_mirrors
+
+class Resolver:
+    """
+    Caches getaddrinfo() results for ttl seconds, and failures for
+    negative_ttl seconds, so a slow resolver is only waited on once in a while
+    (getaddrinfo() does not tell us the records' real TTLs)
+    """
+
+    ttl = 60
+    negative_ttl = 5
+
+    def __init__(self, ttl=None, negative_ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        """
+        returns getaddrinfo() results for TCP connections to @host:@port
+        """
+
+        key = (host, port)
+        now = monotonic()
+        with self.lock:
+            expires, result = self.cache.get(key, (0, None))
+            if expires > now:
+                self.hits += 1
+            else:
+                self.misses += 1
+                result = None
+
+        if result is None:
+            try:
+                result = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                ttl = self.ttl
+            except socket.gaierror as e:
+                result = e
+                ttl = self.negative_ttl
+            with self.lock:
+                self.cache[key] = (monotonic() + ttl, result)
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.cache))
+
+def interleave(addresses):
+    """
+    orders getaddrinfo() results alternating between address families (RFC 8305 section 4)
+    """
+
+    families = []
+    by_family = {}
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+        by_family.setdefault(address[0], []).append(address)
+
+    ordered = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+def connect_fastest(addresses, delay=0.25, timeout=None):
+    """
+    connects to one of @addresses (getaddrinfo() results) RFC 8305 style:
+    another attempt is started every @delay seconds, or as soon as one fails,
+    and the first to connect is returned while the rest are abandoned
+    """
+
+    addresses = interleave(addresses)
+    deadline = monotonic() + timeout if timeout is not None else None
+    # not select(), which fails for fds of 1024 and above in a busy server
+    selector = selectors.DefaultSelector()
+    connecting = []
+    error = None
+    next_attempt = 0
+
+    try:
+        while addresses or connecting:
+            now = monotonic()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out')
+
+            if addresses and (not connecting or now >= next_attempt):
+                family, type, proto, canonname, address = addresses.pop(0)
+                sock = socket.socket(family, type, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(address)
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    connecting.append(sock)
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_attempt = now + delay
+                else:
+                    error = socket.error(err, os.strerror(err))
+                    sock.close()
+                continue
+
+            wait = [t - now for t in (next_attempt if addresses else None, deadline) if t is not None]
+            for key, events in selector.select(max(0, min(wait)) if wait else None):
+                sock = key.fileobj
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                connecting.remove(sock)
+                selector.unregister(sock)
+                if not err:
+                    sock.setblocking(True)
+                    return sock
+                error = socket.error(err, os.strerror(err))
+                sock.close()
+                # try the next address straight away
+                next_attempt = 0
+    finally:
+        for sock in connecting:
+            sock.close()
+        selector.close()
+
+    raise error or socket.error('No addresses to connect to')
+
+class Mirrors:
+    """
+    Connect times to remotes, as a moving average, so the
+    fastest of several mirrors of a remote can be tried first
+
+    Remotes that have not been measured are tried first so they get measured;
+    remotes that failed are tried last for retry_after seconds.
+    """
+
+    # weight of the newest measurement
+    alpha = 0.3
+    retry_after = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.failed_at = {}
+
+    def order(self, remotes):
+        now = monotonic()
+        with self.lock:
+            def score(remote):
+                failed = remote in self.failed_at and now - self.failed_at[remote] < self.retry_after
+                return (failed, self.latency.get(remote, 0))
+            return sorted(remotes, key=score)
+
+    def record(self, remote, seconds):
+        with self.lock:
+            self.failed_at.pop(remote, None)
+            latency = self.latency.get(remote)
+            if latency is None:
+                self.latency[remote] = seconds
+            else:
+                self.latency[remote] = latency + self.alpha * (seconds - latency)
+
+    def failed(self, remote):
+        with self.lock:
+            self.failed_at[remote] = monotonic()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.latency)
+
+_resolver = Resolver()
+_mirrors = Mirrors()
+
+def get_resolver():
+    return _resolver
+
+def get_mirrors():
+    return _mirrors
+
+def open_connection(host, port, timeout=None, resolver=None, mirrors=None):
+    """
+    connects to @host, which may be a list of mirrors (see split_mirrors),
+    trying the fastest mirror first
+    returns (host, port, socket) for the mirror connected to
+    """
+
+    resolver = resolver or _resolver
+    mirrors = mirrors or _mirrors
+
+    error = None
+    for host, port in mirrors.order(split_mirrors(host, port)):
+        try:
+            addresses = resolver.resolve(host, port)
+            started = monotonic()
+            sock = connect_fastest(addresses, timeout=timeout)
+        except (socket.error, socket.gaierror) as e:
+            logging.info('Could not connect to %s:%s: %s', host, port, e)
+            mirrors.failed((host, port))
+            error = e
+            continue
+        mirrors.record((host, port), monotonic() - started)
+        return host, port, sock
+    raise error
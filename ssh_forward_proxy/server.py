@@ -0,0 +1,936 @@
+import os
+import sys
+import socket
+import threading
+import subprocess
+import errno
+import signal
+import time
+
+import paramiko
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+
+from .util import *
+from .stream import *
+from .latency import *
+from .upstream import *
+from .keys import *
+from .auth import *
+from .limiter import *
+from .workers import *
+from .resolver import *
+from .tuning import *
+from .crypto import *
+from .compression import *
+from .metrics import *
+from .trace import *
+from .debug import *
+
+class Forward:
+    """
+    A direct-tcpip channel (ssh -L or -W) the client opened as @chanid
+    to reach @destination, an (address, port) pair, on behalf of @origin
+    """
+
+    def __init__(self, chanid, origin, destination):
+        self.chanid = chanid
+        self.origin = origin
+        self.destination = destination
+
+    def __repr__(self):
+        return 'forward to {}:{}'.format(*self.destination)
+
+def remote_name(kwargs):
+    """
+    returns the remote in the connect_to_remote() arguments @kwargs as host:port, for the metrics
+    """
+
+    return '{}:{}'.format(kwargs.get('host'), kwargs.get('port'))
+
+class ServerInterface(paramiko.ServerInterface):
+    timeout = 10
+    # close a client connection with no sessions after this many seconds
+    idle_timeout = 600
+    # seconds between checks that the client is still connected
+    poll_interval = 1
+    chunk_size = CHUNK_SIZE
+    max_chunk_size = MAX_CHUNK_SIZE
+    # relay sessions on this Pump; None relays in the session's own thread
+    pump = None
+    # Tuning for the client's transport; None leaves paramiko's defaults
+    client_tuning = None
+    # CryptoProfile (or its name) for the client's transport
+    client_profile = None
+    # Compression for the client's transport; None leaves it off
+    client_compression = None
+    # ConnectionTrace of the client connection, made by __init__ unless a subclass made it first
+    trace = None
+
+    def __init__(self, socket, server_key=None, chunk_size=None, max_chunk_size=None, pump=None,
+                 client_tuning=None, client_profile=None, client_compression=None):
+        paramiko.ServerInterface.__init__(self)
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if max_chunk_size is not None:
+            self.max_chunk_size = max_chunk_size
+        if pump is not None:
+            self.pump = pump
+        if client_tuning is not None:
+            self.client_tuning = client_tuning
+        if client_profile is not None:
+            self.client_profile = client_profile
+        if client_compression is not None:
+            self.client_compression = client_compression
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.done_callbacks = []
+        if self.trace is None:
+            self.trace = ConnectionTrace()
+        label_thread(connection=self.trace.id)
+        # SessionTrace by channel, or by chanid for forwards not yet accepted
+        self.session_traces = {}
+        self.sessions = 0
+        self.serving = True
+        self.threads = []
+
+        self.transport = paramiko.Transport(socket)
+        # the transport's thread does the encryption, so it is worth labelling in thread dumps
+        self.transport.labels = dict(connection=self.trace.id)
+        if self.client_tuning is not None:
+            self.client_tuning.apply(self.transport)
+        if self.client_profile is not None:
+            get_crypto_profile(self.client_profile).apply(self.transport)
+        if self.client_compression is not None:
+            self.client_compression.apply(self.transport)
+        for key in get_server_keys(server_key).get():
+            self.transport.add_server_key(key)
+        started = monotonic()
+        try:
+            self.transport.start_server(server=self)
+        except Exception:
+            get_metrics().handshake_failures.inc()
+            raise
+        get_metrics().handshake_seconds.observe(monotonic() - started)
+        self.trace.mark('handshake')
+
+    def relay(self, input, output, callback, relay_class=Relay, host=''):
+        """
+        relays between the @input and @output streams then calls @callback(completed)
+        completed is False if relaying stopped because of an error
+        @host is the remote the bytes relayed are counted against in the metrics
+
+        with a pump this returns straight away and the pump calls @callback
+        otherwise this blocks until the relay is done
+        """
+
+        relay = relay_class(input, output, self.chunk_size, self.max_chunk_size)
+        get_metrics().relay_started(relay, host)
+        if host:
+            get_metrics().upstream_sessions.inc(host=host)
+        trace = self.session_trace(input.channel) if isinstance(input, ChannelStream) else None
+        if trace is not None:
+            trace.mark('relay_start')
+        def finish(completed):
+            try:
+                get_metrics().relay_finished(relay)
+                if trace is not None:
+                    trace.add_relay(relay)
+                self.relay_finished(relay)
+            finally:
+                callback(completed)
+
+        if self.pump is not None:
+            self.pump.add(relay, finish)
+            return
+
+        completed = False
+        try:
+            relay.run()
+            completed = True
+        finally:
+            finish(completed)
+
+    def relay_finished(self, relay):
+        """
+        called with each Relay once it is over, before its callback
+        """
+
+    def close(self):
+        """
+        closes the client transport, ending the session
+        """
+
+        self.transport.close()
+        with self.lock:
+            callbacks, self.done_callbacks = self.done_callbacks, None
+        for callback in callbacks or ():
+            callback()
+        if callbacks is not None:
+            stats = self.compression_stats()
+            if stats:
+                logging.debug('Compression totals: %r', stats)
+
+    def compression_stats(self):
+        """
+        returns the counters of the Compression of each leg, by leg
+        """
+
+        if self.client_compression is None:
+            return {}
+        return dict(client=self.client_compression.stats())
+
+    def add_done_callback(self, callback):
+        """
+        calls @callback() once the session is closed (straight away if it already is)
+        """
+
+        with self.lock:
+            if self.done_callbacks is not None:
+                self.done_callbacks.append(callback)
+                return
+        callback()
+
+    def get_command(self):
+        """
+        waits for the client's first exec or forward request
+        a client that only forwards may never send another one, so once
+        a forward has started this goes on to wait as next_command() does
+        """
+
+        deadline = time.time() + self.timeout
+        try:
+            while True:
+                try:
+                    return self.queue.get(True, max(0, min(self.poll_interval, deadline - time.time())))
+                except queue.Empty:
+                    self.poll()
+
+                with self.lock:
+                    busy = self.sessions
+                if busy:
+                    return self.next_command()
+                if time.time() >= deadline:
+                    logging.error('Client passed no commands')
+                    self.close()
+                    return None, None
+        except Exception as e:
+            self.close()
+            raise e
+
+    def next_command(self):
+        """
+        waits for another exec or forward request on the same client connection
+        returns (None, None) once the client disconnects or has been idle for idle_timeout
+        """
+
+        idle_since = time.time()
+        while self.transport.is_active():
+            try:
+                return self.queue.get(True, self.poll_interval)
+            except queue.Empty:
+                self.poll()
+
+            with self.lock:
+                busy = self.sessions
+            if busy:
+                idle_since = time.time()
+            elif self.idle_timeout is not None and time.time() - idle_since >= self.idle_timeout:
+                logging.info('Client connection idle for %ds, closing', self.idle_timeout)
+                break
+        return None, None
+
+    def poll(self):
+        """
+        called every poll_interval while waiting for commands
+        """
+
+    def serve(self):
+        """
+        runs handle_command(channel, command) in its own thread for every exec request
+        so a client can run many sessions, one after another or at once, over one connection
+        forwarded connections are sessions too, with a Forward for their command
+
+        returns once the client has gone and its sessions have finished or been handed to the pump
+        """
+
+        client, command = self.get_command()
+        while client or command:
+            if isinstance(command, Forward):
+                client = self.accept_channel(command.chanid)
+            if client:
+                self.start_session(client, command)
+            else:
+                logging.error('Client did not open the channel for %r', command)
+            client, command = self.next_command()
+
+        for thread in self.threads:
+            thread.join()
+        with self.lock:
+            self.serving = False
+            idle = not self.sessions
+        if idle:
+            self.close()
+
+    def accept_channel(self, chanid):
+        """
+        returns the Channel paramiko made for @chanid once its open request was accepted
+        """
+
+        while True:
+            channel = self.transport.accept(self.timeout)
+            if channel is None or channel.get_id() == chanid:
+                return channel
+            # a session channel, which arrives with its exec request instead
+
+    def session_trace(self, channel):
+        """
+        returns the SessionTrace of the session on @channel (or of the forward with that chanid)
+        """
+
+        if self.trace is None:
+            # the connection is not set up, so the trace is not kept
+            return SessionTrace(None)
+        with self.lock:
+            trace = self.session_traces.get(channel)
+            if trace is None:
+                trace = self.session_traces[channel] = SessionTrace(self.trace)
+            return trace
+
+    def mark_connection(self, phase):
+        if self.trace is not None:
+            self.trace.mark(phase)
+
+    def trace_exit_status(self, channel, status):
+        trace = self.session_trace(channel)
+        trace.mark('exit_status')
+        trace.attributes['exit_status'] = status
+
+    def start_session(self, channel, command):
+        with self.lock:
+            self.sessions += 1
+            if isinstance(command, Forward) and command.chanid in self.session_traces:
+                self.session_traces[channel] = self.session_traces.pop(command.chanid)
+        get_metrics().session_started()
+        thread = threading.Thread(target=self.run_command, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+
+    def run_command(self, channel, command):
+        label_thread(connection=self.trace.id, session=self.session_trace(channel).id)
+        try:
+            self.handle_command(channel, command)
+        except Exception:
+            logging.exception('Error running %r', command)
+
+    def handle_command(self, channel, command):
+        """
+        runs the session for an exec request (or Forward); must call end_session() once it is over
+        """
+
+        raise NotImplementedError
+
+    def end_session(self, channel=None):
+        """
+        called when a session started by serve() is over
+        the client connection is closed once the client has gone and all its sessions are over
+        the trace of the session on @channel, if given, is emitted
+        """
+
+        get_metrics().session_finished()
+        with self.lock:
+            self.sessions -= 1
+            last = not self.serving and not self.sessions
+            trace = self.session_traces.pop(channel, None) if channel is not None else None
+        if trace is not None:
+            trace.mark('end')
+            try:
+                get_tracer().emit(trace)
+            except Exception:
+                logging.exception('Failed to emit session trace')
+        if last:
+            self.close()
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        trace = self.session_trace(channel)
+        trace.mark('exec')
+        trace.attributes['command'] = command[:200].decode('utf-8', 'replace') if isinstance(command, bytes) else command
+        self.queue.put((channel, command))
+        return True
+
+class Proxy(ServerInterface):
+    # connect to the remote while the client handshake is still going
+    prefetch = True
+
+    def __init__(self, socket=None, username=None, server_key=None, pool=None,
+                 chunk_size=None, max_chunk_size=None, pump=None, prefetch=None,
+                 client_tuning=None, client_profile=None, client_compression=None, **kwargs):
+        self.username = username
+        self.pool = pool
+        if prefetch is not None:
+            self.prefetch = prefetch
+
+        # prefetched connections by channel; None for the whole client connection
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.connect_kwargs = dict(kwargs, username=username)
+        if kwargs.get('host'):
+            # the remote is already known (relay mode); the trace starts before connecting to it
+            self.trace = ConnectionTrace()
+            self.prefetch_remote(None, **self.connect_kwargs)
+
+        try:
+            ServerInterface.__init__(self, socket or StdSocket(), server_key=server_key,
+                                     chunk_size=chunk_size, max_chunk_size=max_chunk_size, pump=pump,
+                                     client_tuning=client_tuning, client_profile=client_profile,
+                                     client_compression=client_compression)
+            self.serve()
+        finally:
+            # unused if there were no commands or a relay failed early
+            self.cancel_pending()
+
+    def handle_command(self, channel, command):
+        if isinstance(command, Forward):
+            self.forward_to_remote(channel, command)
+        else:
+            self.relay_to_remote(channel, command, **dict(self.connect_kwargs, username=self.username))
+
+    def forward_kwargs(self):
+        """
+        returns the connect_to_remote() arguments for forwarded connections
+        or None if the remote is not known
+        """
+
+        if not self.connect_kwargs.get('host'):
+            return None
+        return dict(self.connect_kwargs, username=self.username)
+
+    def prefetch_remote(self, channel, **kwargs):
+        """
+        starts connecting to the remote for @channel in the background
+        """
+
+        if not self.prefetch:
+            return
+        pending = PendingConnection(self.connect_upstream, **kwargs)
+        with self.lock:
+            pending, self.pending[channel] = self.pending.get(channel), pending
+        if pending:
+            pending.cancel()
+
+    def poll(self):
+        # e.g. a channel that set __HOST__ (see ProxyServer) then closed without an exec request
+        with self.lock:
+            closed = [channel for channel in self.pending if channel is not None and channel.closed]
+            pending = [self.pending.pop(channel) for channel in closed]
+        for connection in pending:
+            connection.cancel()
+
+    def cancel_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for connection in pending.values():
+            connection.cancel()
+
+    def relay_to_remote(self, client, command, **kwargs):
+        connection = remote = None
+        trace = self.session_trace(client)
+        trace.attributes['host'] = remote_name(kwargs)
+        label_thread(host=remote_name(kwargs))
+        try:
+            connection, remote = self.open_remote_session(client, **kwargs)
+            trace.add_upstream(connection.client)
+            remote.exec_command(command)
+            trace.mark('upstream_exec')
+        except Exception:
+            self.finish_relay(client, connection, remote, False)
+            raise
+
+        callback = lambda completed: self.finish_relay(client, connection, remote, completed)
+        self.relay(ChannelStream(client), ChannelStream(remote), callback, host=remote_name(kwargs))
+
+    def forward_to_remote(self, client, forward):
+        """
+        relays the client's direct-tcpip channel through a direct-tcpip channel
+        opened by the remote (on a pooled connection if there is a pool)
+        """
+
+        connection = remote = None
+        kwargs = self.forward_kwargs()
+        trace = self.session_trace(client)
+        trace.attributes.update(host=remote_name(kwargs), destination='{}:{}'.format(*forward.destination))
+        label_thread(host=remote_name(kwargs))
+        try:
+            connection, remote = self.open_remote_session(
+                client, forward=(forward.destination, forward.origin), **kwargs)
+            trace.add_upstream(connection.client)
+        except Exception:
+            self.finish_relay(client, connection, remote, False)
+            raise
+
+        # forwarded connections have no exit status to pass on
+        callback = lambda completed: self.finish_relay(client, connection, remote, False)
+        self.relay(ChannelStream(client), ChannelStream(remote), callback, relay_class=TunnelRelay,
+                   host=remote_name(kwargs))
+
+    def connect_upstream(self, **kwargs):
+        """
+        returns a connection to the remote, from the pool if there is one
+        """
+
+        if self.pool is not None:
+            return self.pool.acquire(self.connect_to_remote, **kwargs)
+        return Connection(self.connect_to_remote(**kwargs))
+
+    def open_remote_session(self, channel, forward=None, **kwargs):
+        """
+        returns (connection, channel) for a new session on the remote for the client's @channel
+        (or a forwarded connection, see open_channel)
+        using a connection prefetched for it (or for the client connection)
+        if it was made with the same arguments
+        """
+
+        with self.lock:
+            pending = self.pending.pop(channel, None) or self.pending.pop(None, None)
+        if pending and pending.kwargs != kwargs:
+            # e.g. the client logged in as a different user
+            pending.cancel()
+        elif pending:
+            connection = pending.result()
+            try:
+                return connection, connection.open_session(forward)
+            except Exception as e:
+                logging.info('Prefetched connection failed (%s), reconnecting', e)
+                connection.close()
+
+        if self.pool is not None:
+            return self.pool.open_session(self.connect_to_remote, forward, **kwargs)
+
+        connection = self.connect_upstream(**kwargs)
+        try:
+            return connection, connection.open_session(forward)
+        except Exception:
+            connection.close()
+            raise
+
+    def compression_stats(self):
+        stats = ServerInterface.compression_stats(self)
+        compression = self.connect_kwargs.get('upstream_compression')
+        if compression is not None:
+            stats['upstream'] = compression.stats()
+        return stats
+
+    def relay_finished(self, relay):
+        tuning = self.connect_kwargs.get('upstream_tuning')
+        if tuning is None:
+            return
+        # the window we advertise only limits data coming from the remote
+        stats = relay.stats()
+        try:
+            tuning.record(relay.output.channel.get_transport(),
+                          stats['stdout_bytes'] + stats['stderr_bytes'], stats['seconds'])
+        except Exception:
+            logging.exception('Failed to tune the remote connection')
+
+    def finish_relay(self, client, connection, remote, completed):
+        try:
+            if completed and remote.exit_status_ready():
+                status = remote.recv_exit_status()
+                client.send_exit_status(status)
+                self.trace_exit_status(client, status)
+        finally:
+            client.close()
+            if remote:
+                remote.close()
+            if connection:
+                connection.close()
+            self.end_session(client)
+
+    @staticmethod
+    def connect_to_remote(host, port, username, host_key_check=True, known_hosts=None,
+                          upstream_tuning=None, upstream_profile=None, upstream_compression=None, **kwargs):
+        remote = remote_name(dict(host=host, port=port))
+        started = monotonic()
+        try:
+            # host may list several mirrors, the fastest to connect to is used
+            host, port, kwargs['sock'] = open_connection(host, port, timeout=kwargs.get('timeout'))
+            connected = monotonic()
+            if upstream_tuning is not None:
+                kwargs['transport_factory'] = upstream_tuning.transport_factory(host, port)
+            if upstream_profile is not None:
+                factory = kwargs.get('transport_factory', paramiko.Transport)
+                kwargs['transport_factory'] = get_crypto_profile(upstream_profile).transport_factory(factory)
+            if upstream_compression is not None:
+                factory = kwargs.get('transport_factory', paramiko.Transport)
+                kwargs['transport_factory'] = upstream_compression.transport_factory(factory)
+                kwargs['compress'] = upstream_compression.enabled
+            client = paramiko.SSHClient()
+            if host_key_check:
+                known_hosts = get_known_hosts(known_hosts)
+                name = known_host_name(host, port)
+                for key in known_hosts.lookup(name):
+                    client.get_host_keys().add(name, key.get_name(), key)
+                client.set_missing_host_key_policy(KnownHostsPolicy(known_hosts))
+            else:
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+            logging.info('Connecting to ssh host %s@%s:%s ...', username, host, port)
+            get_identities().connect(client, host, port, username, **kwargs)
+        except paramiko.AuthenticationException:
+            get_metrics().upstream_auth_failures.inc(host=remote)
+            raise
+        except Exception:
+            get_metrics().upstream_connect_failures.inc(host=remote)
+            raise
+        get_metrics().upstream_connect_seconds.observe(monotonic() - started, host=remote)
+        # for the SessionTrace of the session this is for (see SessionTrace.add_upstream)
+        client.trace_phases = [('upstream_start', started), ('upstream_tcp', connected), ('upstream_auth', monotonic())]
+        client.get_transport().labels = dict(host=remote)
+        return client
+
+    def check_auth_none(self, username):
+        self.username = username
+        self.mark_connection('auth')
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        # connecting upstream here would hold up the client's transport thread,
+        # so the channel is accepted first and closed if the remote refuses it
+        if self.forward_kwargs() is None:
+            logging.error('Cannot forward to %s:%d, the remote is not known', *destination)
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self.session_trace(chanid).mark('exec')
+        self.queue.put((None, Forward(chanid, origin, destination)))
+        return paramiko.OPEN_SUCCEEDED
+
+class ProxyServer(Proxy):
+    HOST = b'__HOST__'
+
+    def __init__(self, *args, **kwargs):
+        self.env = {}
+        Proxy.__init__(self, *args, **kwargs)
+
+    def check_channel_env_request(self, channel, key, value):
+        # each session channel has its own environment
+        self.env.setdefault(channel, {})[key] = value
+        self.session_trace(channel).mark('env')
+        if key == self.HOST:
+            # the exec request follows, so start connecting while it is on its way
+            try:
+                username, host, port = parse_host_string(value.decode('utf-8'))
+            except ValueError as e:
+                logging.error('Invalid %s: %s', self.HOST, e)
+            else:
+                self.prefetch_remote(channel, **dict(self.connect_kwargs, username=username, host=host, port=port))
+        return True
+
+    def poll(self):
+        Proxy.poll(self)
+        for channel in list(self.env):
+            if channel.closed:
+                self.env.pop(channel, None)
+
+    def forward_kwargs(self):
+        # forwards have no environment, so the client names the remote
+        # in its login instead, e.g. ssh -W db:5432 user@remote@proxy
+        if '@' not in (self.username or ''):
+            return None
+        username, host, port = parse_host_string(self.username)
+        return dict(self.connect_kwargs, username=username, host=host, port=port)
+
+    def relay_to_remote(self, client, command, **kwargs):
+        host = self.env.pop(client, {}).get(self.HOST)
+        if not host:
+            logging.error('Client did not give %s', self.HOST)
+            self.finish_relay(client, None, None, False)
+            return
+        username, host, port = parse_host_string(host.decode('utf-8'))
+        kwargs.update(username=username, host=host, port=port)
+        return super(ProxyServer, self).relay_to_remote(client, command, **kwargs)
+
+class Server(ServerInterface):
+    def __init__(self, socket, **kwargs):
+        ServerInterface.__init__(self, socket, **kwargs)
+        self.serve()
+
+    def handle_command(self, client, command):
+        logging.info('Executing %r', command)
+        process = None
+        try:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                shell=True,
+            )
+        except Exception:
+            self.finish_process(client, process, False)
+            raise
+
+        callback = lambda completed: self.finish_process(client, process, completed)
+        self.relay(ChannelStream(client), ProcessStream(process), callback)
+
+    def finish_process(self, client, process, completed):
+        try:
+            if completed and not client.closed:
+                status = process.wait()
+                client.send_exit_status(status)
+                self.trace_exit_status(client, status)
+        finally:
+            self.kill_process(process)
+            client.close()
+            self.end_session(client)
+
+    def check_auth_none(self, username):
+        self.mark_connection('auth')
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def kill_process(self, process):
+        if process:
+            process.stdout.close()
+            process.stdin.close()
+            process.stderr.close()
+            if process.poll() is None:
+                process.kill()
+
+def run_session(worker, client, limiter, **kwargs):
+    """
+    runs @worker on the accepted @client socket once @limiter has a free slot
+    """
+
+    accepted = monotonic()
+    if not limiter.start():
+        logging.warning('Timed out waiting for a free session, closing connection')
+        client.close()
+        return
+
+    # for the worker's ConnectionTrace
+    set_pending_phases([('accept', accepted), ('admitted', monotonic())])
+    session = None
+    try:
+        session = worker(client, **kwargs)
+    finally:
+        # sessions relayed by a pump outlive the worker call
+        if hasattr(session, 'add_done_callback'):
+            session.add_done_callback(limiter.finish)
+        else:
+            limiter.finish()
+
+def handle_connection(client, worker, limiter, **kwargs):
+    """
+    starts a session for an accepted connection unless @limiter rejects it
+    """
+
+    if not limiter.admit():
+        # refuse now rather than after an expensive handshake
+        client.close()
+        logging.warning('Too many connections, rejected one (active=%(active)d queued=%(queued)d rejected=%(rejected)d)',
+                        limiter.stats())
+        return
+    logging.info('Got a connection! (active=%(active)d queued=%(queued)d rejected=%(rejected)d)', limiter.stats())
+
+    thread = threading.Thread(target=run_session, args=(worker, client, limiter), kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+
+def add_server_stats(limiter, pool=None, pump=None, **kwargs):
+    """
+    adds the stats of the server's components to get_metrics()
+    """
+
+    metrics = get_metrics()
+    metrics.add_stats('connections', limiter.stats, counters=('rejected', 'total'))
+    metrics.add_stats('resolver', get_resolver().stats, counters=('hits', 'misses'))
+    metrics.add_stats('identities', get_identities().stats, counters=('connects', 'attempts'))
+    if pool is not None:
+        metrics.add_stats('pool', pool.stats, counters=('hits', 'misses', 'evictions'))
+    if pump is not None:
+        metrics.add_stats('pump', pump.stats)
+    if get_relay_latency().sample_every:
+        metrics.add_stats('relay_latency', get_relay_latency().stats, counters=('upstream_count', 'downstream_count'))
+
+def serve_worker(channel, limiter, worker=Server, metrics=None, admin=None, **kwargs):
+    """
+    runs in a worker process started by run_server(workers=N),
+    serving the connections the supervisor passes over @channel
+    """
+
+    if metrics is not None:
+        add_server_stats(limiter, **kwargs)
+        metrics.start(limiter.slot)
+    if admin is not None:
+        admin.start(limiter.slot)
+
+    try:
+        signal.signal(signal.SIGHUP, reload_server_keys)
+        signal.signal(signal.SIGUSR1, log_threads)
+    except AttributeError:
+        pass
+
+    while True:
+        fd = recv_fd(channel)
+        if fd is None:
+            # supervisor has gone away
+            break
+        client = socket.socket(fileno=fd)
+        handle_connection(client, worker, limiter, **kwargs)
+
+def relay_session(client, **kwargs):
+    """
+    runs a Proxy for a connection to the relay daemon
+
+    the client first sends a line with the port, host and user to relay to
+    (see bin/ssh-forward-proxy-client.py) followed by the SSH traffic
+    """
+
+    # don't let a client that sends nothing hold a session forever
+    client.settimeout(ServerInterface.timeout)
+    try:
+        port, host, username = read_line(client).decode('utf-8').split(' ')
+        port = int(port)
+    except (ValueError, socket.error) as e:
+        logging.error('Invalid relay header (%s), closing connection', e)
+        client.close()
+        return
+    client.settimeout(None)
+    return Proxy(client, username=username, host=host, port=port, **kwargs)
+
+def serve_forever(sock, worker=Server, limiter=None, workers=None, metrics=None, admin=None, **kwargs):
+    """
+    runs @worker(socket, **kwargs) for each connection accepted on the listening @sock
+
+    with @workers, connections are spread over that many worker processes
+    (and @limiter applies to each of them)
+    with a MetricsServer as @metrics, the metrics of each process are served on it
+    with an AdminServer as @admin, each process answers admin commands on it
+
+    SIGUSR1 logs the stack of every thread (of every worker process too)
+    """
+
+    if limiter is None:
+        limiter = SessionLimiter()
+    if 'server_key' in kwargs:
+        # load the keys once up front rather than in every session
+        kwargs['server_key'] = get_server_keys(kwargs['server_key'])
+    try:
+        signal.signal(signal.SIGHUP, reload_server_keys)
+        signal.signal(signal.SIGUSR1, log_threads)
+    except (AttributeError, ValueError):
+        # no SIGHUP on this platform or not in the main thread
+        pass
+
+    try:
+        logging.info('Server started')
+        if workers:
+            serve = lambda channel, limiter: serve_worker(channel, limiter, worker, metrics, admin, **kwargs)
+            supervisor = Supervisor(sock, workers, serve, limiter)
+            if metrics is not None:
+                get_metrics().add_stats('workers', supervisor.stats, counters=('rejected', 'total', 'restarts'))
+                metrics.start()
+            signal.signal(signal.SIGHUP, supervisor.forward_signal)
+            signal.signal(signal.SIGUSR1, lambda *args: (log_threads(), supervisor.forward_signal(*args)))
+            if admin is not None:
+                admin.start()
+            signal.signal(signal.SIGTERM, lambda *args: supervisor.stop())
+            supervisor.run()
+            return
+
+        if metrics is not None:
+            add_server_stats(limiter, **kwargs)
+            metrics.start()
+        if admin is not None:
+            admin.start()
+        while True:
+            logging.debug('accept()')
+            client, address = sock.accept()
+            handle_connection(client, worker, limiter, **kwargs)
+    except KeyboardInterrupt:
+        # stop server on ctrl+c
+        pass
+    finally:
+        sock.close()
+
+def run_server(host, port, worker=Server, backlog=100, **kwargs):
+    """
+    runs an SSH server on @host:@port, running @worker(socket, **kwargs) for each connection
+    see serve_forever() for the other arguments
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    logging.debug('bind()')
+    sock.bind((host, port))
+
+    logging.debug('listen()')
+    sock.listen(backlog)
+
+    serve_forever(sock, worker, **kwargs)
+
+def run_daemon(path, worker=relay_session, backlog=100, **kwargs):
+    """
+    runs the relay daemon on the unix socket @path
+
+    it serves the same sessions as `ssh-forward-proxy.py relay` but stays up
+    between them, so keys and (with a pool) upstream connections stay warm
+    see serve_forever() for the other arguments
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        try:
+            sock.connect(path)
+        except socket.error:
+            # left behind by a daemon that is no longer running
+            os.unlink(path)
+        else:
+            sock.close()
+            raise RuntimeError('Relay daemon already running on {}'.format(path))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # only the user running the daemon may connect to it
+    umask = os.umask(0o177)
+    try:
+        logging.debug('bind()')
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+
+    logging.debug('listen()')
+    sock.listen(backlog)
+
+    def stop(*args):
+        raise KeyboardInterrupt
+    try:
+        # stop cleanly on kill so the socket is removed
+        old_handler = signal.signal(signal.SIGTERM, stop)
+    except ValueError:
+        # not in the main thread
+        old_handler = None
+
+    try:
+        serve_forever(sock, worker, **kwargs)
+    finally:
+        if old_handler is not None:
+            signal.signal(signal.SIGTERM, old_handler)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
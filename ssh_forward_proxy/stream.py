@@ -6,6 +6,9 @@ import errno
 
 import logging
 
+from .util import monotonic
+from .latency import get_relay_latency
+
 try:
     BrokenPipeError
 except NameError:
@@ -49,16 +52,91 @@ class StdSocket:
         sys.stdin.close()
         sys.stdout.close()
 
+CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 256 * 1024
+
+class ChunkSize:
+    """
+    Read size for one stream: doubles (up to max_size) while reads keep
+    filling the buffer and drops straight back down when they don't,
+    so bulk transfers use few large reads and interactive traffic small ones
+    """
+
+    def __init__(self, min_size=CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = min_size
+
+    def update(self, n):
+        if n >= self.size:
+            self.size = min(self.size * 2, self.max_size)
+        else:
+            while self.size > self.min_size and n <= self.size // 2:
+                self.size //= 2
+
 class Stream:
     STDOUT = 0
     STDERR = 1
 
+    # whether ready() is exact, so reading again will not block
+    can_drain = False
+    # most reads per drain() so one busy stream cannot starve the others
+    max_drain_reads = 16
+    # file to select() on until send() can write; None if it can only be retried
+    write_stream = None
+
     def pipe(self, key, stream, other, size):
         output = (self.ready(key, stream) and self.read(key, size))
         if output:
             other.write(key, output)
         return output
 
+    def drain(self, key, stream, other, chunk, limit=None):
+        """
+        pipes until nothing more is ready (or @limit bytes), adjusting the ChunkSize @chunk
+        returns the number of bytes piped, or the result of pipe() if none
+        """
+
+        total = 0
+        output = False
+        for i in range(self.max_drain_reads if self.can_drain else 1):
+            size = chunk.size if limit is None else min(chunk.size, limit - total)
+            if size <= 0:
+                break
+            output = self.pipe(key, stream, other, size)
+            if not output:
+                break
+            total += len(output)
+            chunk.update(len(output))
+        return total or output
+
+    def keys(self, stream):
+        """
+        the outputs (STDOUT, STDERR) that can be read when @stream is readable
+        """
+
+        return [self.STDOUT, self.STDERR]
+
+    def send(self, key, buf):
+        """
+        writes as much of @buf as can be written without blocking
+        returns the number of bytes written
+        """
+
+        raise NotImplementedError
+
+    def shutdown_write(self):
+        """
+        tells the other end nothing more will be written (EOF) while still reading from it
+        """
+
+    def is_closed(self):
+        """
+        whether the other end has gone completely, rather than just sent EOF
+        """
+
+        return False
+
 class ProcessStream(Stream):
     def __init__(self, process):
         self.stdin = process.stdin
@@ -73,17 +151,43 @@ class ProcessStream(Stream):
     def write(self, key, buf):
         return ignore_broken_pipe(os.write, self.stdin.fileno(), buf)
 
+    def send(self, key, buf):
+        fd = self.stdin.fileno()
+        if os.get_blocking(fd):
+            os.set_blocking(fd, False)
+        try:
+            written = ignore_broken_pipe(os.write, fd, buf)
+        except BlockingIOError:
+            return 0
+        # the process has stopped reading, so there is nowhere for the rest to go
+        return len(buf) if written is None else written
+
+    @property
+    def write_stream(self):
+        return self.stdin
+
     def ready(self, key, stream):
         return stream is self.streams[key]
 
+    def keys(self, stream):
+        return [self.streams.index(stream)]
+
+    def shutdown_write(self):
+        try:
+            self.stdin.close()
+        except (IOError, OSError):
+            pass
+
 
 class ChannelStream(Stream):
+    can_drain = True
+
     def __init__(self, channel):
         self.channel = channel
         self.streams = [channel]
         self.func_map = [
-            [self.channel.recv, self.channel.sendall, self.channel.recv_ready],
-            [self.channel.recv_stderr, self.channel.sendall_stderr, self.channel.recv_stderr_ready],
+            [self.channel.recv, self.channel.sendall, self.channel.recv_ready, self.channel.send],
+            [self.channel.recv_stderr, self.channel.sendall_stderr, self.channel.recv_stderr_ready, self.channel.send_stderr],
         ]
 
     def read(self, key, n):
@@ -92,25 +196,312 @@ class ChannelStream(Stream):
     def write(self, key, buf):
         return self.func_map[key][1](buf)
 
+    def send(self, key, buf):
+        # send_ready() is True once the channel has closed, but send() then raises
+        if self.channel.closed:
+            # the other end has gone, so there is nowhere for the rest to go
+            return len(buf)
+        # a channel has no file to wait on until the remote opens its window
+        # (this only covers the window: send() still blocks during a rekey or on a full TCP buffer)
+        if not self.channel.send_ready():
+            return 0
+        try:
+            return self.func_map[key][3](buf)
+        except socket.error:
+            if self.channel.closed:
+                return len(buf)
+            raise
+
     def ready(self, key, stream):
         return self.func_map[key][2]()
 
+    def shutdown_write(self):
+        self.channel.shutdown_write()
+
+    def is_closed(self):
+        return self.channel.closed
+
+
+class Buffer:
+    """
+    Data read from one stream waiting to be sent on to the @key output of @sink
+    so that a slow reader only holds up its own direction
+    """
+
+    def __init__(self, sink, key, shutdown=False):
+        self.sink = sink
+        self.key = key
+        # whether to send the sink EOF once this is at EOF and empty
+        self.shutdown = shutdown
+        self.data = bytearray()
+        self.eof = False
+        self.closed = False
+        # not read into until it has drained down to the low watermark
+        self.paused = False
+        self.stalled_since = None
+        # seconds spent with data the sink would not take
+        self.stall_time = 0
+        # bytes read into this
+        self.total = 0
+        # monotonic() time of the first byte
+        self.first_at = None
+        # (bytes read up to, monotonic() time) of a read being timed by RelayLatency
+        self.sample = None
+
+    def write(self, key, buf):
+        # Stream.drain() pipes into this
+        if not self.total:
+            self.first_at = monotonic()
+        self.data += buf
+        self.total += len(buf)
+
+    def flush(self, size):
+        """
+        sends as much as the sink takes without blocking, @size bytes at a time
+        """
+
+        while self.data:
+            sent = self.sink.send(self.key, bytes(self.data[:size]))
+            if not sent:
+                if self.stalled_since is None:
+                    self.stalled_since = monotonic()
+                return
+            del self.data[:sent]
+
+        if self.stalled_since is not None:
+            self.stall_time += monotonic() - self.stalled_since
+            self.stalled_since = None
+        if self.eof and self.shutdown and not self.closed:
+            self.closed = True
+            self.sink.shutdown_write()
+
+    def is_done(self):
+        return self.eof and not self.data
+
+    def discard(self):
+        """
+        drops the data waiting for a sink that has gone, and anything read after it
+        """
+
+        del self.data[:]
+        self.eof = True
+        # no EOF to send either
+        self.closed = True
+
+    @property
+    def sent(self):
+        return self.total - len(self.data)
+
+class Relay:
+    """
+    Relays data between the @input and @output streams of one session
+
+    Each direction (stdin, stdout and stderr) is buffered on its own and only
+    written when its peer will take it, so a client reading stdout slowly
+    does not hold up stdin. A direction stops being read once high_water bytes
+    are waiting and starts again when they have drained down to low_water;
+    the session never buffers more than max_buffered bytes in all.
+
+    EOF from the input is passed on to the output, which is still relayed
+    until it closes too (e.g. a command reading stdin to the end before replying)
+
+    The latency added to each direction is sampled into get_relay_latency() when enabled
+    """
+
+    high_water = 1024 * 1024
+    low_water = 256 * 1024
+    max_buffered = 2 * 1024 * 1024
+    # largest single write
+    send_size = 64 * 1024
+    # seconds between retries of writes to streams without a write_stream (channels out of window)
+    poll_interval = 0.01
+
+    def __init__(self, input, output, size=CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        self.input = input
+        self.output = output
+        self.stdin = Buffer(output, Stream.STDOUT, shutdown=True)
+        self.stdout = Buffer(input, Stream.STDOUT)
+        self.stderr = Buffer(input, Stream.STDERR)
+        self.buffers = [self.stdin, self.stdout, self.stderr]
+        self.stdin_chunk = ChunkSize(size, max_size)
+        self.stdout_chunk = ChunkSize(size, max_size)
+        self.stderr_chunk = ChunkSize(size, max_size)
+        # streams which are not at EOF
+        self.open_streams = input.streams + output.streams
+        self.started = monotonic()
+        # monotonic() times each side's streams all reached EOF
+        self.input_eof_at = None
+        self.output_eof_at = None
+        self.done = False
+        self.latency = get_relay_latency()
+
+    def readers(self, stream):
+        """
+        (source, key, buffer, chunk) for each output read when @stream is readable
+        """
+
+        if stream in self.input.streams:
+            return [(self.input, Stream.STDOUT, self.stdin, self.stdin_chunk)]
+        chunks = [self.stdout_chunk, self.stderr_chunk]
+        outputs = [self.stdout, self.stderr]
+        return [(self.output, key, outputs[key], chunks[key]) for key in self.output.keys(stream)]
+
+    @property
+    def streams(self):
+        """
+        streams to select() on for reading
+        """
+
+        return [s for s in self.open_streams if not any(r[2].paused for r in self.readers(s))]
+
+    @property
+    def write_streams(self):
+        """
+        streams to select() on for writing
+        """
+
+        streams = []
+        for buffer in self.buffers:
+            stream = buffer.sink.write_stream
+            if buffer.data and stream is not None and stream not in streams:
+                streams.append(stream)
+        return streams
+
+    @property
+    def polling(self):
+        """
+        whether there are writes to retry every poll_interval
+        """
+
+        return any(b.data and b.sink.write_stream is None for b in self.buffers)
+
+    def buffered(self):
+        return sum(len(b.data) for b in self.buffers)
+
+    def handle(self, stream):
+        """
+        pipes data from @stream, which select() reported as readable,
+        and sends whatever can be sent
+        returns True once the relay is over
+        """
+
+        if stream in self.streams:
+            ready_at = monotonic() if self.latency.sample() else None
+            read = False
+            for source, key, buffer, chunk in self.readers(stream):
+                limit = min(self.high_water - len(buffer.data), self.max_buffered - self.buffered())
+                if limit <= 0:
+                    read = True
+                elif source.drain(key, stream, buffer, chunk, limit):
+                    read = True
+                    if ready_at is not None and buffer.sample is None:
+                        buffer.sample = (buffer.total, ready_at)
+            if not read:
+                self.stream_eof(stream)
+
+        return self.flush()
+
+    def flush(self):
+        """
+        sends whatever can be sent without blocking
+        returns True once the relay is over
+        """
+
+        if self.done:
+            return True
+        for buffer in self.buffers:
+            buffer.flush(self.send_size)
+            if buffer.sample is not None and buffer.sent >= buffer.sample[0]:
+                self.latency.record('upstream' if buffer is self.stdin else 'downstream',
+                                    monotonic() - buffer.sample[1])
+                buffer.sample = None
+
+        buffered = self.buffered()
+        for buffer in self.buffers:
+            if buffer.paused:
+                buffer.paused = len(buffer.data) > self.low_water or buffered >= self.max_buffered
+            else:
+                buffer.paused = len(buffer.data) >= self.high_water or buffered >= self.max_buffered
+
+        if self.is_finished():
+            self.done = True
+        return self.done
+
+    def stream_eof(self, stream):
+        self.open_streams.remove(stream)
+        if stream in self.input.streams:
+            if not any(s in self.open_streams for s in self.input.streams):
+                logging.debug('Input streams closed')
+                self.input_eof_at = monotonic()
+                self.input_eof()
+        elif not any(s in self.open_streams for s in self.output.streams):
+            logging.debug('Output streams closed')
+            self.output_eof_at = monotonic()
+            self.output_eof()
+
+    def input_eof(self):
+        if self.input.is_closed():
+            # nowhere to send the rest of the output
+            self.done = True
+        self.stdin.eof = True
+
+    def output_eof(self):
+        if self.output.is_closed():
+            # e.g. a command that exits without reading all of its stdin
+            self.stdin.discard()
+        self.stdout.eof = self.stderr.eof = True
+
+    def is_finished(self):
+        # the session is over once the command's output ends and has been sent
+        return self.stdout.is_done() and self.stderr.is_done()
+
+    def stats(self):
+        return dict(
+            seconds=monotonic() - self.started,
+            buffered=self.buffered(),
+            stdin_bytes=self.stdin.total,
+            stdout_bytes=self.stdout.total,
+            stderr_bytes=self.stderr.total,
+            stdin_stall=self.stdin.stall_time,
+            stdout_stall=self.stdout.stall_time,
+            stderr_stall=self.stderr.stall_time,
+        )
+
+    def run(self):
+        while not self.done:
+            timeout = self.poll_interval if self.polling else None
+            r, w, x = select.select(self.streams, self.write_streams, [], timeout)
+            for stream in r:
+                self.handle(stream)
+            self.flush()
+        logging.debug('Relay finished: %r', self.stats())
+
+class TunnelRelay(Relay):
+    """
+    Relays a forwarded TCP connection, where either end may send EOF first:
+    each direction is shut down on its own and the relay is over once both
+    have (or either end closes completely)
+    """
+
+    def __init__(self, input, output, size=CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+        # mostly bulk transfers, so start with the largest reads
+        Relay.__init__(self, input, output, max_size, max_size)
+        self.stdout.shutdown = True
+        # tunnels have no stderr
+        self.stderr.eof = True
+
+    def input_eof(self):
+        if self.input.is_closed() or self.output.is_closed():
+            self.done = True
+        self.stdin.eof = True
+
+    def output_eof(self):
+        if self.input.is_closed() or self.output.is_closed():
+            self.done = True
+        self.stdout.eof = True
+
+    def is_finished(self):
+        return all(b.is_done() for b in self.buffers)
 
-def pipe_streams(input, output, size=1024):
-    done = False
-    while not done:
-        r, w, x = select.select(input.streams + output.streams, [], [])
-
-        for stream in r:
-            if stream in output.streams:
-                stdout = output.pipe(Stream.STDOUT, stream, input, size)
-                stderr = output.pipe(Stream.STDERR, stream, input, size)
-                if not (stdout or stderr):
-                    logging.debug('Output streams closed')
-                    done = True
-
-            if stream in input.streams:
-                stdin = input.pipe(Stream.STDOUT, stream, output, size)
-                if not stdin:
-                    logging.debug('Input streams closed')
-                    done = True
+def pipe_streams(input, output, size=CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    Relay(input, output, size, max_size).run()
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import binascii
+import threading
+import logging
+
+from .util import monotonic
+
+# phases of a span: (span name, first phase, last phase)
+# the first phase that was recorded of each list is used
+TRACE_SPANS = [
+    ('queue', ['accept'], ['admitted']),
+    ('client_handshake', ['admitted', 'accept'], ['handshake']),
+    ('upstream_connect', ['upstream_start'], ['upstream_auth']),
+    ('relay', ['relay_start'], ['relay_done']),
+]
+
+def random_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+# phases recorded by run_session() before the worker makes its ConnectionTrace
+_pending = threading.local()
+
+def set_pending_phases(phases):
+    """
+    passes @phases ([(phase, monotonic time)]) to the next ConnectionTrace made in this thread
+    """
+
+    _pending.phases = phases
+
+class ConnectionTrace:
+    """
+    Timestamps of the phases of a client connection (accept, handshake, auth)
+    shared by the SessionTraces of its sessions
+    """
+
+    def __init__(self):
+        self.id = random_id(16)
+        # to turn monotonic() times into wall clock times
+        self.offset = time.time() - monotonic()
+        self.phases = getattr(_pending, 'phases', None) or [('accept', monotonic())]
+        _pending.phases = None
+
+    def mark(self, phase):
+        self.phases.append((phase, monotonic()))
+
+    @property
+    def started(self):
+        return self.phases[0][1]
+
+class SessionTrace:
+    """
+    Timestamps of the phases of one session (exec request or forward) on @connection,
+    from the client's env and exec requests to the remote connection, the first byte
+    each way, EOF and the exit status
+
+    Each phase is only recorded the first time.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.id = random_id(8)
+        self.phases = {}
+        self.attributes = {}
+
+    def mark(self, phase, when=None):
+        if phase not in self.phases:
+            self.phases[phase] = monotonic() if when is None else when
+
+    def add_upstream(self, client):
+        """
+        records the phases of connecting to the remote as @client (see Proxy.connect_to_remote)
+        the first session on a connection claims them, so the sessions after it
+        on the same pooled connection are marked upstream_reused
+        """
+
+        if self.connection is None:
+            return
+        phases = client.__dict__.pop('trace_phases', None)
+        if not phases:
+            self.attributes['upstream_reused'] = True
+            return
+        for phase, when in phases:
+            self.mark(phase, when)
+
+    def add_relay(self, relay):
+        """
+        records the first byte each way, EOF and the byte counts of @relay once it is over
+        """
+
+        for name in ('stdin', 'stdout', 'stderr'):
+            buffer = getattr(relay, name)
+            if buffer.first_at is not None:
+                self.mark('first_' + name, buffer.first_at)
+            self.attributes[name + '_bytes'] = buffer.total
+        for phase in ('input_eof', 'output_eof'):
+            when = getattr(relay, phase + '_at')
+            if when is not None:
+                self.mark(phase, when)
+        self.mark('relay_done')
+
+    def all_phases(self):
+        """
+        returns [(phase, monotonic time)] of the connection and the session, in order
+        """
+
+        return sorted(self.connection.phases + list(self.phases.items()), key=lambda p: p[1])
+
+    def record(self):
+        """
+        returns the trace as a dict, with the phases in seconds since the client connected
+        """
+
+        started = self.connection.started
+        return dict(
+            connection=self.connection.id,
+            session=self.id,
+            start=started + self.connection.offset,
+            phases=dict((phase, round(when - started, 6)) for phase, when in self.all_phases()),
+            attributes=self.attributes,
+        )
+
+    def spans(self):
+        """
+        returns the trace as OpenTelemetry spans (OTLP JSON): one for the session,
+        with an event for each phase, and one for each part of it in TRACE_SPANS
+        """
+
+        def nanoseconds(when):
+            return str(int((when + self.connection.offset) * 1e9))
+
+        phases = self.all_phases()
+        times = dict(reversed(phases))
+        root = dict(
+            traceId=self.connection.id,
+            spanId=self.id,
+            name='session',
+            kind=2,
+            startTimeUnixNano=nanoseconds(phases[0][1]),
+            endTimeUnixNano=nanoseconds(phases[-1][1]),
+            attributes=[otel_attribute(key, value) for key, value in sorted(self.attributes.items())],
+            events=[dict(name=phase, timeUnixNano=nanoseconds(when)) for phase, when in phases],
+        )
+        spans = [root]
+        for name, starts, ends in TRACE_SPANS:
+            start = next((times[p] for p in starts if p in times), None)
+            end = next((times[p] for p in ends if p in times), None)
+            if start is None or end is None:
+                continue
+            spans.append(dict(
+                traceId=self.connection.id,
+                spanId=random_id(8),
+                parentSpanId=self.id,
+                name=name,
+                kind=1,
+                startTimeUnixNano=nanoseconds(start),
+                endTimeUnixNano=nanoseconds(end),
+            ))
+        return spans
+
+def otel_attribute(key, value):
+    if isinstance(value, bool):
+        return dict(key=key, value=dict(boolValue=value))
+    if isinstance(value, int):
+        return dict(key=key, value=dict(intValue=str(value)))
+    if isinstance(value, float):
+        return dict(key=key, value=dict(doubleValue=value))
+    return dict(key=key, value=dict(stringValue=str(value)))
+
+class Tracer:
+    """
+    Logs the record of each finished SessionTrace as JSON and, after
+    export_to(path), appends it to @path as OTLP JSON (one export request per
+    line, as the OpenTelemetry collector's file exporter writes them)
+    """
+
+    service_name = 'ssh-forward-proxy'
+
+    def __init__(self):
+        self.path = None
+
+    def export_to(self, path):
+        self.path = path
+
+    def emit(self, trace):
+        logging.info('Session trace: %s', json.dumps(trace.record(), sort_keys=True, default=str))
+        if self.path is None:
+            return
+        request = dict(resourceSpans=[dict(
+            resource=dict(attributes=[otel_attribute('service.name', self.service_name)]),
+            scopeSpans=[dict(scope=dict(name='ssh_forward_proxy'), spans=trace.spans())],
+        )])
+        line = (json.dumps(request, default=str) + '\n').encode('utf-8')
+        try:
+            # one write in append mode, so lines from several worker processes don't mix
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.error('Failed to export session trace to %s: %s', self.path, e)
+
+_tracer = Tracer()
+
+def get_tracer():
+    return _tracer
@@ -0,0 +1,167 @@
+import threading
+import weakref
+import logging
+
+from .util import parse_size
+from .resolver import get_mirrors
+
+# paramiko's defaults
+DEFAULT_WINDOW_SIZE = 2 * 1024 * 1024
+DEFAULT_MAX_PACKET_SIZE = 32 * 1024
+
+class Tuning:
+    """
+    Channel window, max packet size and rekey limits for the SSH transports
+    of one leg of the proxy; None leaves paramiko's default
+
+    The window is how much the other end may send on a channel before
+    waiting for us to acknowledge it, so one channel moves at most
+    window_size bytes per round trip. paramiko rekeys after 512MB (or 2**29
+    packets) in either direction and stops sending until the new keys are in.
+    """
+
+    window_size = None
+    max_packet_size = None
+    rekey_bytes = None
+    rekey_packets = None
+
+    FIELDS = ('window_size', 'max_packet_size', 'rekey_bytes', 'rekey_packets')
+
+    def __init__(self, window_size=None, max_packet_size=None, rekey_bytes=None, rekey_packets=None):
+        if window_size is not None:
+            if not 32 * 1024 <= window_size < 2 ** 32:
+                raise ValueError('Window size must be between 32KB and 4GB')
+            self.window_size = window_size
+        if max_packet_size is not None:
+            if not 4 * 1024 <= max_packet_size <= 256 * 1024:
+                raise ValueError('Max packet size must be between 4KB and 256KB')
+            self.max_packet_size = max_packet_size
+        if rekey_bytes is not None:
+            self.rekey_bytes = rekey_bytes
+        if rekey_packets is not None:
+            self.rekey_packets = rekey_packets
+
+    @classmethod
+    def parse(cls, text):
+        """
+        makes a Tuning from @text, e.g. "window_size=16M,max_packet_size=32K,rekey_bytes=4G"
+        """
+
+        kwargs = {}
+        for item in text.split(','):
+            name, _, value = item.partition('=')
+            name = name.strip().replace('-', '_')
+            if name not in cls.FIELDS:
+                raise ValueError('Unknown tuning option: {!r}'.format(name))
+            kwargs[name] = parse_size(value)
+        return cls(**kwargs)
+
+    def copy(self, **kwargs):
+        values = dict((name, getattr(self, name)) for name in self.FIELDS)
+        values.update(kwargs)
+        return Tuning(**values)
+
+    def apply(self, transport):
+        """
+        sets the limits on the paramiko Transport @transport,
+        before it opens or accepts the channels they are for
+        """
+
+        if self.window_size is not None:
+            transport.default_window_size = self.window_size
+        if self.max_packet_size is not None:
+            transport.default_max_packet_size = self.max_packet_size
+        packetizer = transport.packetizer
+        if self.rekey_bytes is not None:
+            packetizer.REKEY_BYTES = packetizer.REKEY_BYTES_OVERFLOW_MAX = self.rekey_bytes
+        if self.rekey_packets is not None:
+            packetizer.REKEY_PACKETS = packetizer.REKEY_PACKETS_OVERFLOW_MAX = self.rekey_packets
+        return transport
+
+    def __repr__(self):
+        return 'Tuning({})'.format(', '.join('{}={}'.format(name, getattr(self, name))
+                                             for name in self.FIELDS if getattr(self, name) is not None))
+
+class UpstreamTuning:
+    """
+    Tuning for connections to remotes: @default, overridden by @hosts
+    keyed by "host" or "host:port"
+
+    With @auto the window for each remote grows to twice the bandwidth-delay
+    product measured from finished transfers (bytes from the remote over the
+    session's time) and the connect time to the remote as the round trip time.
+    A window that limits a transfer caps it at window/RTT, so each large
+    transfer doubles the window until it no longer does, up to max_window_size.
+    """
+
+    max_window_size = 64 * 1024 * 1024
+    # smaller transfers say more about latency than the link's bandwidth
+    min_sample = 1024 * 1024
+
+    def __init__(self, default=None, hosts=None, auto=False, max_window_size=None):
+        self.default = default or Tuning()
+        self.hosts = dict(hosts or {})
+        self.auto = auto
+        if max_window_size is not None:
+            self.max_window_size = max_window_size
+        self.lock = threading.Lock()
+        # (host, port): auto-tuned window
+        self.windows = {}
+        # transports we made: (host, port)
+        self.remotes = weakref.WeakKeyDictionary()
+
+    def get(self, host, port):
+        """
+        returns the Tuning for connections to @host:@port
+        """
+
+        tuning = self.hosts.get('{}:{}'.format(host, port)) or self.hosts.get(host) or self.default
+        with self.lock:
+            window = self.windows.get((host, port))
+        if window and window > (tuning.window_size or DEFAULT_WINDOW_SIZE):
+            tuning = tuning.copy(window_size=window)
+        return tuning
+
+    def transport_factory(self, host, port):
+        """
+        returns a function for SSHClient.connect(transport_factory=...)
+        that makes tuned transports to @host:@port
+        """
+
+        tuning = self.get(host, port)
+        def make_transport(sock, **kwargs):
+            import paramiko
+            transport = tuning.apply(paramiko.Transport(sock, **kwargs))
+            with self.lock:
+                self.remotes[transport] = (host, port)
+            return transport
+        return make_transport
+
+    def record(self, transport, nbytes, seconds):
+        """
+        auto-tunes the window for the remote of @transport after a session
+        received @nbytes from it in @seconds
+        """
+
+        if not self.auto or nbytes < self.min_sample or seconds <= 0:
+            return
+        with self.lock:
+            remote = self.remotes.get(transport)
+        rtt = get_mirrors().stats().get(remote)
+        if not rtt:
+            return
+
+        window = min(self.max_window_size, int(2 * rtt * nbytes / seconds))
+        with self.lock:
+            if window <= self.windows.get(remote, 0):
+                return
+            self.windows[remote] = window
+        if window > transport.default_window_size:
+            # for the next sessions on this (pooled) connection too
+            transport.default_window_size = window
+            logging.info('Window for %s:%s tuned to %d bytes (%.1fMB/s, %.0fms)',
+                         remote[0], remote[1], window, nbytes / seconds / 1e6, rtt * 1000)
+
+    def stats(self):
+        with self.lock:
+            return dict(('{}:{}'.format(*remote), window) for remote, window in self.windows.items())
@@ -0,0 +1,312 @@
+import threading
+import time
+import logging
+
+from .util import monotonic
+
+def open_channel(transport, forward=None):
+    """
+    opens a session channel on @transport, or a direct-tcpip channel
+    if @forward is given as (destination, origin) address pairs
+    """
+
+    if forward:
+        destination, origin = forward
+        return transport.open_channel('direct-tcpip', destination, origin)
+    return transport.open_session()
+
+class PooledConnection:
+    """
+    An authenticated upstream SSHClient shared between sessions.
+    Sessions are channels opened on its transport.
+    """
+
+    def __init__(self, pool, key, client):
+        self.pool = pool
+        self.key = key
+        self.client = client
+        self.sessions = 0
+        # lowered if the remote refuses more sessions than the pool allows
+        self.max_sessions = None
+        self.last_used = time.time()
+        self.broken = False
+        self.discarded = False
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return bool(not self.broken and transport and transport.is_active() and transport.is_authenticated())
+
+    def is_full(self, max_sessions):
+        if self.max_sessions is not None:
+            max_sessions = min(max_sessions, self.max_sessions)
+        return self.sessions >= max_sessions
+
+    def open_session(self, forward=None):
+        from paramiko import ChannelException
+
+        try:
+            return open_channel(self.client.get_transport(), forward)
+        except ChannelException:
+            if forward:
+                # the remote could not reach the destination
+                raise
+            # the remote refused the channel (e.g. its MaxSessions is lower than ours)
+            # but the sessions already open on it are fine
+            open_sessions = self.sessions - 1
+            if open_sessions > 0:
+                logging.info('Remote refused a session, limiting its connection to %d sessions', open_sessions)
+                self.max_sessions = open_sessions
+            else:
+                self.broken = True
+            raise
+        except Exception:
+            # don't hand this connection out again
+            self.broken = True
+            raise
+
+    def close(self):
+        self.pool.release(self)
+
+class UpstreamPool:
+    """
+    Process-wide pool of authenticated upstream connections keyed
+    by the arguments given to connect_to_remote (user, host, port, identity etc.)
+
+    Each connection is shared by at most max_sessions sessions at once
+    (OpenSSH's default MaxSessions is 10) and is closed after being
+    idle for idle_timeout seconds, by a timer so that this happens
+    even if no more sessions come along.
+    """
+
+    max_sessions = 10
+    idle_timeout = 300
+
+    def __init__(self, max_sessions=None, idle_timeout=None):
+        if max_sessions is not None:
+            self.max_sessions = max_sessions
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # closes idle connections once they time out
+        self.timer = None
+
+    @staticmethod
+    def make_key(kwargs):
+        def freeze(value):
+            if isinstance(value, list):
+                return tuple(value)
+            return value
+        return tuple(sorted((k, freeze(v)) for k, v in kwargs.items()))
+
+    def acquire(self, connect, **kwargs):
+        """
+        returns a PooledConnection for the given connect_to_remote() arguments,
+        reusing an existing one if it is healthy and not full
+        """
+
+        key = self.make_key(kwargs)
+        with self.lock:
+            self.evict_idle()
+            for conn in self.connections.get(key, []):
+                if not conn.is_full(self.max_sessions) and conn.is_active():
+                    conn.sessions += 1
+                    self.hits += 1
+                    return conn
+            self.misses += 1
+
+        # connect outside the lock so other hosts are not held up
+        conn = PooledConnection(self, key, connect(**kwargs))
+        conn.sessions = 1
+        with self.lock:
+            self.connections.setdefault(key, []).append(conn)
+        return conn
+
+    def open_session(self, connect, forward=None, **kwargs):
+        """
+        returns (connection, channel) for a new session (or forwarded connection,
+        see open_channel) on a pooled connection
+        a connection which turns out to be dead is discarded and we retry once
+        """
+
+        conn = self.acquire(connect, **kwargs)
+        try:
+            return conn, conn.open_session(forward)
+        except Exception as e:
+            self.release(conn)
+            if forward and not conn.broken:
+                # another connection would not reach the destination either
+                raise
+            logging.info('Pooled connection failed (%s), reconnecting', e)
+
+        conn = self.acquire(connect, **kwargs)
+        try:
+            return conn, conn.open_session(forward)
+        except Exception:
+            self.release(conn)
+            raise
+
+    def release(self, conn):
+        with self.lock:
+            conn.sessions -= 1
+            conn.last_used = time.time()
+            if conn.discarded or not conn.is_active():
+                self.discard(conn)
+            self.evict_idle()
+            self.schedule_eviction()
+
+    def discard(self, conn, force=False):
+        """
+        stops handing out @conn and closes it once its last session is released
+        """
+
+        conns = self.connections.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+            if not conns:
+                del self.connections[conn.key]
+        conn.discarded = True
+        if force or conn.sessions <= 0:
+            conn.client.close()
+
+    def evict_idle(self):
+        deadline = time.time() - self.idle_timeout
+        for conns in list(self.connections.values()):
+            for conn in list(conns):
+                if conn.sessions <= 0 and conn.last_used < deadline:
+                    logging.debug('Closing idle upstream connection')
+                    self.evictions += 1
+                    self.discard(conn)
+
+    def schedule_eviction(self):
+        """
+        starts the timer for the next idle connection to time out, if it is not running
+        must be called with the lock held
+        """
+
+        # a timer from before a fork is not running in the child
+        if self.timer is not None and self.timer.is_alive():
+            return
+        idle = [c.last_used for conns in self.connections.values() for c in conns if c.sessions <= 0]
+        if not idle:
+            return
+        # a little late, so the connection has definitely timed out
+        delay = max(0, min(idle) + self.idle_timeout - time.time()) + 0.1
+        self.timer = threading.Timer(delay, self.evict_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def evict_timer(self):
+        with self.lock:
+            self.timer = None
+            self.evict_idle()
+            self.schedule_eviction()
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            for conns in list(self.connections.values()):
+                for conn in list(conns):
+                    self.discard(conn, force=True)
+
+    def stats(self):
+        with self.lock:
+            conns = [c for conns in self.connections.values() for c in conns]
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                connections=len(conns),
+                sessions=sum(c.sessions for c in conns),
+            )
+
+class Connection:
+    """
+    An unpooled upstream SSHClient used for a single session
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def open_session(self, forward=None):
+        return open_channel(self.client.get_transport(), forward)
+
+    def close(self):
+        self.client.close()
+
+class PendingConnection:
+    """
+    Runs @connect(**kwargs) in a background thread so connecting to the
+    remote can overlap other work, such as the client's SSH handshake
+    """
+
+    def __init__(self, connect, **kwargs):
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.connection = None
+        self.error = None
+        self.claimed = False
+        self.cancelled = False
+        self.started = monotonic()
+        self.finished = None
+        # seconds of connecting that overlapped with other work
+        self.saved = 0
+
+        self.thread = threading.Thread(target=self.run, args=(connect,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, connect):
+        connection = error = None
+        try:
+            connection = connect(**self.kwargs)
+        except Exception as e:
+            error = e
+
+        with self.lock:
+            self.connection = connection
+            self.error = error
+            self.finished = monotonic()
+            close = self.cancelled and connection
+        if close:
+            connection.close()
+        self.done.set()
+
+    def result(self, timeout=None):
+        """
+        waits for and returns the connection, raising any error from connecting
+        """
+
+        requested = monotonic()
+        self.done.wait(timeout)
+        with self.lock:
+            if not self.done.is_set():
+                raise RuntimeError('Timed out waiting for remote connection')
+            self.claimed = True
+            self.saved = min(self.finished, requested) - self.started
+
+        logging.info('Remote connection took %.3fs, %.3fs of it overlapped with the client session setup',
+                     self.finished - self.started, self.saved)
+        if self.error:
+            raise self.error
+        return self.connection
+
+    def cancel(self):
+        """
+        gives up on the connection, closing it if it has been made
+        """
+
+        with self.lock:
+            if self.claimed:
+                return
+            self.cancelled = True
+            connection = self.connection
+        if connection:
+            connection.close()
@@ -1,10 +1,18 @@
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 SSH_PORT = 22
 
 #   splits the string @host into into its components
 #   given it's in the format user@host:port (where user and port components are optional)
 #   port is converted to an integer or None
+#   host may be a comma separated list of mirrors each with their own port (see split_mirrors)
 def parse_host_string(host):
     user, _, host = host.rpartition('@')
+    if ',' in host:
+        return (user or None), host, SSH_PORT
     host2, _, port = host.partition(':')
     if port.isdigit():
         port = int(port)
@@ -12,3 +20,35 @@ def parse_host_string(host):
     else:
         port = SSH_PORT
     return (user or None), host, port
+
+#   reads bytes from the socket @sock up to and excluding the next newline
+#   one byte at a time so that nothing after the newline is consumed
+def read_line(sock, max_length=1024):
+    line = b''
+    while len(line) < max_length:
+        char = sock.recv(1)
+        if not char or char == b'\n':
+            return line
+        line += char
+    raise ValueError('Line too long')
+
+#   splits @host, a comma separated list of mirrors in the format host:port,
+#   into a list of (host, port), using @port for mirrors without one
+def split_mirrors(host, port=SSH_PORT):
+    mirrors = []
+    for mirror in host.split(','):
+        name, _, mirror_port = mirror.strip().partition(':')
+        mirrors.append((name, int(mirror_port) if mirror_port.isdigit() else port))
+    return mirrors
+
+#   converts the size @text, in bytes with an optional K, M or G suffix
+#   (powers of 1024), to an integer
+def parse_size(text):
+    number = text.strip().upper()
+    multiplier = 1
+    if number[-1:] in ('K', 'M', 'G'):
+        multiplier = 1024 ** ('KMG'.index(number[-1]) + 1)
+        number = number[:-1]
+    if not number.isdigit():
+        raise ValueError('Invalid size: {!r}'.format(text))
+    return int(number) * multiplier
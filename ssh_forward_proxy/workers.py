@@ -0,0 +1,242 @@
+import os
+import time
+import array
+import errno
+import select
+import signal
+import socket
+import logging
+from multiprocessing.sharedctypes import RawArray
+
+from .limiter import SessionLimiter
+
+STATS = ('active', 'queued', 'rejected', 'total')
+
+def send_fd(channel, fd):
+    """
+    passes the file descriptor @fd over the unix socket @channel
+    """
+
+    fds = array.array('i', [fd])
+    channel.sendmsg([b'c'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+def recv_fd(channel):
+    """
+    receives a file descriptor sent with send_fd()
+    returns None once @channel is closed
+    """
+
+    fds = array.array('i')
+    msg, ancdata, flags, addr = channel.recvmsg(1, socket.CMSG_LEN(fds.itemsize))
+    if not msg:
+        return None
+    for level, type, data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:fds.itemsize])
+            return fds[0]
+    raise IOError('No file descriptor received')
+
+class SharedSessionLimiter(SessionLimiter):
+    """
+    SessionLimiter which publishes its counts to slot @slot of the shared
+    array @stats so the supervisor can see them
+    """
+
+    def __init__(self, stats, slot, *args, **kwargs):
+        SessionLimiter.__init__(self, *args, **kwargs)
+        self.shared = stats
+        self.slot = slot
+        self.offset = slot * len(STATS)
+        self.publish()
+
+    def publish(self):
+        for i, name in enumerate(STATS):
+            self.shared[self.offset + i] = getattr(self, name)
+
+    def admit(self):
+        result = SessionLimiter.admit(self)
+        self.publish()
+        return result
+
+    def start(self):
+        result = SessionLimiter.start(self)
+        self.publish()
+        return result
+
+    def finish(self):
+        SessionLimiter.finish(self)
+        self.publish()
+
+class Supervisor:
+    """
+    Accepts connections on @sock and hands each one to the least loaded of
+    @workers worker processes by passing the file descriptor over a unix socket.
+    Each worker runs @serve(channel, limiter) in its own process; crashed
+    workers are restarted and their stats are aggregated here.
+    """
+
+    restart_delay = 1
+    stats_interval = 60
+
+    def __init__(self, sock, workers, serve, limiter=None):
+        self.sock = sock
+        self.serve = serve
+        self.limiter = limiter or SessionLimiter()
+        self.stats_array = RawArray('l', workers * len(STATS))
+        self.workers = [None] * workers
+        self.channels = [None] * workers
+        # when to restart each crashed worker
+        self.restart_at = [None] * workers
+        self.restarts = 0
+        self.running = True
+
+    def start_worker(self, slot):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            # worker process
+            status = 1
+            try:
+                # drop the supervisor's signal handlers
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                parent.close()
+                self.sock.close()
+                for channel in self.channels:
+                    if channel:
+                        channel.close()
+                limiter = SharedSessionLimiter(
+                    self.stats_array, slot,
+                    self.limiter.max_sessions, self.limiter.max_queued, self.limiter.queue_timeout,
+                )
+                self.serve(child, limiter)
+                status = 0
+            except KeyboardInterrupt:
+                status = 0
+            except Exception:
+                logging.exception('Worker %d failed', slot)
+            finally:
+                os._exit(status)
+
+        child.close()
+        self.workers[slot] = pid
+        self.channels[slot] = parent
+        self.restart_at[slot] = None
+        logging.info('Started worker %d (pid %d)', slot, pid)
+
+    def reap_workers(self):
+        """
+        restarts any workers that have exited, after restart_delay
+        without holding up the accept loop in the meantime
+        """
+
+        now = time.time()
+        for slot, pid in enumerate(self.workers):
+            if pid is None:
+                if self.running and self.restart_at[slot] is not None and now >= self.restart_at[slot]:
+                    self.start_worker(slot)
+                continue
+
+            try:
+                result, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                result, status = pid, 0
+            if result == 0:
+                continue
+
+            self.workers[slot] = None
+            self.channels[slot].close()
+            self.channels[slot] = None
+            for i in range(len(STATS)):
+                self.stats_array[slot * len(STATS) + i] = 0
+            if self.running:
+                logging.error('Worker %d (pid %d) exited with status %d, restarting', slot, pid, status)
+                self.restarts += 1
+                self.restart_at[slot] = now + self.restart_delay
+
+    def load(self, slot):
+        offset = slot * len(STATS)
+        return self.stats_array[offset + STATS.index('active')] + self.stats_array[offset + STATS.index('queued')]
+
+    def dispatch(self, client):
+        """
+        sends @client to the least loaded worker
+        """
+
+        try:
+            slots = [slot for slot, channel in enumerate(self.channels) if channel]
+            for slot in sorted(slots, key=self.load):
+                try:
+                    send_fd(self.channels[slot], client.fileno())
+                    return True
+                except (OSError, IOError) as e:
+                    logging.error('Failed to pass connection to worker %d: %s', slot, e)
+            return False
+        finally:
+            client.close()
+
+    def stats(self):
+        """
+        returns the stats summed over all workers and for each worker
+        """
+
+        workers = []
+        for slot in range(len(self.workers)):
+            offset = slot * len(STATS)
+            workers.append(dict((name, self.stats_array[offset + i]) for i, name in enumerate(STATS)))
+        total = dict((name, sum(w[name] for w in workers)) for name in STATS)
+        total.update(workers=workers, restarts=self.restarts)
+        return total
+
+    def forward_signal(self, signum, frame=None):
+        for pid in self.workers:
+            if pid is None:
+                continue
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        for slot in range(len(self.workers)):
+            self.start_worker(slot)
+
+        last_stats = time.time()
+        try:
+            while self.running:
+                try:
+                    r, w, x = select.select([self.sock], [], [], 0.5)
+                except select.error as e:
+                    # interrupted by a signal
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    r = []
+
+                if r:
+                    client, address = self.sock.accept()
+                    if not self.dispatch(client):
+                        logging.error('No worker available, rejected connection')
+
+                self.reap_workers()
+                if time.time() - last_stats >= self.stats_interval:
+                    last_stats = time.time()
+                    logging.info('Worker stats: active=%(active)d queued=%(queued)d rejected=%(rejected)d '
+                                 'total=%(total)d restarts=%(restarts)d', self.stats())
+        finally:
+            self.running = False
+            self.forward_signal(signal.SIGTERM)
+            for pid in self.workers:
+                if pid is None:
+                    continue
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            for channel in self.channels:
+                if channel:
+                    channel.close()
@@ -36,11 +36,15 @@ def FakeInputChannel(file='stdin.txt', cmd=None):
     m.recv = stdin.read
     m.sendall = m.stdout.write
     m.sendall_stderr = m.stderr.write
+    m.send = m.stdout.write
+    m.send_stderr = m.stderr.write
+    m.send_ready.return_value = True
+    m.closed = False
     return m
 
-def FakeOutputChannel():
-    m = FakeInputChannel(file='stdout.txt')
-    m.inputs.append( open_file('stderr.txt') )
+def FakeOutputChannel(stdout='stdout.txt', stderr='stderr.txt'):
+    m = FakeInputChannel(file=stdout)
+    m.inputs.append( open_file(stderr) )
     m.recv_stderr = m.inputs[-1].read
     return m
 
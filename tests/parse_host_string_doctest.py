@@ -24,6 +24,14 @@ With an invalid port
 With both user and port
     >>> parse_host_string('user@host:1234')
     ('user', 'host', 1234)
+
+With mirrors
+    >>> parse_host_string('user@first:1234,second')
+    ('user', 'first:1234,second', 22)
+    >>> split_mirrors('first:1234,second', 22)
+    [('first', 1234), ('second', 22)]
+    >>> split_mirrors('host', 1234)
+    [('host', 1234)]
 """
 
-from ssh_forward_proxy import parse_host_string
\ No newline at end of file
+from ssh_forward_proxy import parse_host_string, split_mirrors
\ No newline at end of file
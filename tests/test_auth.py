@@ -0,0 +1,137 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import os
+import shutil
+import tempfile
+
+import paramiko
+
+from ssh_forward_proxy import Identities, load_key
+
+ROOT_DIR = os.path.abspath(os.path.join(__file__, '..', '..'))
+RSA_KEY = os.path.join(ROOT_DIR, 'tests', 'test-server-key')
+
+class IdentitiesTest(unittest.TestCase):
+    """
+    tests for Identities
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.identities = Identities()
+        self.agent_keys = [paramiko.ECDSAKey.generate() for i in range(3)]
+        patcher = patch('paramiko.Agent')
+        self.agent = patcher.start()
+        self.agent.return_value.get_keys.return_value = self.agent_keys
+        self.addCleanup(patcher.stop)
+
+        self.client = mock.Mock()
+        self.auth = self.client.get_transport.return_value.auth_publickey
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_key(self, name):
+        path = os.path.join(self.dir, name)
+        shutil.copy(RSA_KEY, path)
+        return path
+
+    def get(self, remote=sentinel.remote, **kwargs):
+        kwargs.setdefault('look_for_keys', False)
+        return self.identities.get(remote, **kwargs)
+
+    def test_order(self):
+        """
+        identity files should be tried before agent keys, which are tried once each
+        """
+
+        path = self.write_key('id')
+        self.agent_keys.append(load_key(path))
+        self.assertEqual( self.get(key_filename=path), [load_key(path)] + self.agent_keys[:3] )
+        self.assertEqual( self.get(key_filename=path, allow_agent=False), [load_key(path)] )
+
+    def test_file_cached(self):
+        """
+        identity files should only be loaded again when they change
+        """
+
+        path = self.write_key('id')
+        with patch('ssh_forward_proxy.auth.load_key', wraps=load_key) as load:
+            self.get(key_filename=path)
+            self.get(key_filename=[path])
+            self.assertEqual( load.call_count, 1 )
+
+            os.utime(path, (0, 0))
+            self.get(key_filename=path)
+            self.assertEqual( load.call_count, 2 )
+
+    def test_missing_file(self):
+        self.assertEqual( self.get(key_filename=os.path.join(self.dir, 'missing'), allow_agent=False), [] )
+
+    def test_agent_cached(self):
+        self.get()
+        self.get()
+        self.assertEqual( self.agent.call_count, 1 )
+
+        self.identities.reset_agent()
+        self.get()
+        self.assertEqual( self.agent.call_count, 2 )
+
+    def test_connect(self):
+        self.assertEqual( self.identities.connect(self.client, 'host', 22, 'user', look_for_keys=False), 1 )
+        self.client.connect.assert_called_once_with('host', 22, username='user', pkey=self.agent_keys[0],
+                                                    allow_agent=False, look_for_keys=False)
+        self.assertFalse( self.auth.called )
+
+    def test_remembers_key(self):
+        """
+        the key that worked should be tried first next time
+        """
+
+        self.client.connect.side_effect = paramiko.AuthenticationException
+        self.auth.side_effect = [paramiko.AuthenticationException, None]
+        self.assertEqual( self.identities.connect(self.client, 'host', 22, 'user', look_for_keys=False), 3 )
+        self.auth.assert_called_with('user', self.agent_keys[2])
+
+        self.assertEqual( self.get(('user', 'host', 22))[0], self.agent_keys[2] )
+        self.assertEqual( self.get(('user', 'other', 22))[0], self.agent_keys[0] )
+
+        self.client.connect.side_effect = None
+        self.identities.connect(self.client, 'host', 22, 'user', look_for_keys=False)
+        self.assertIs( self.client.connect.call_args[1]['pkey'], self.agent_keys[2] )
+        self.assertEqual( self.identities.stats(), dict(connects=2, attempts=4, remotes=1) )
+
+    def test_all_rejected(self):
+        self.client.connect.side_effect = paramiko.AuthenticationException
+        self.auth.side_effect = paramiko.AuthenticationException
+        with self.assertRaises(paramiko.AuthenticationException):
+            self.identities.connect(self.client, 'host', 22, 'user', look_for_keys=False)
+        self.assertEqual( self.identities.stats()['attempts'], 3 )
+
+    def test_agent_failure(self):
+        """
+        the agent should be reconnected if it fails
+        """
+
+        self.client.connect.side_effect = paramiko.SSHException('agent is gone')
+        self.agent_keys[:] = [mock.Mock(spec=paramiko.AgentKey)]
+        with self.assertRaises(paramiko.SSHException):
+            self.identities.connect(self.client, 'host', 22, 'user', look_for_keys=False)
+        self.get()
+        self.assertEqual( self.agent.call_count, 2 )
+
+    def test_no_keys(self):
+        """
+        without any keys SSHClient should be left to authenticate, e.g. with a password
+        """
+
+        self.agent_keys[:] = []
+        self.assertEqual( self.identities.connect(self.client, 'host', 22, 'user', look_for_keys=False, password='x'), 0 )
+        self.client.connect.assert_called_once_with('host', 22, username='user', key_filename=None,
+                                                    allow_agent=True, look_for_keys=False, password='x')
@@ -0,0 +1,89 @@
+import unittest
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from . import helper
+
+class ClientScriptTest(helper.TestCase):
+    """
+    tests for bin/ssh-forward-proxy-client.py
+    """
+
+    def setUp(self):
+        super(ClientScriptTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'relay.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+
+    def tearDown(self):
+        super(ClientScriptTest, self).tearDown()
+        self.sock.close()
+        shutil.rmtree(self.dir)
+
+    def run_client(self, input, *args):
+        script = os.path.join(self.ROOT_DIR, 'bin', 'ssh-forward-proxy-client.py')
+        process = subprocess.Popen([sys.executable, script] + list(args),
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process.communicate(input)[0], process.returncode
+
+    def test_relays_to_daemon(self):
+        """
+        the client should send the header then copy stdin to the daemon and the daemon's output to stdout
+        """
+
+        received = []
+        def daemon():
+            conn, address = self.sock.accept()
+            data = b''
+            # read until the client half-closes, then reply
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            received.append(data)
+            conn.sendall(b'output')
+            conn.close()
+
+        thread = threading.Thread(target=daemon)
+        thread.start()
+        output, status = self.run_client(b'input', self.path, '1234', 'host', 'user')
+        thread.join()
+
+        self.assertEqual( received, [b'1234 host user\ninput'] )
+        self.assertEqual( output, b'output' )
+        self.assertEqual( status, 0 )
+
+    def test_no_daemon(self):
+        output, status = self.run_client(b'', os.path.join(self.dir, 'missing.sock'), '1234', 'host', 'user')
+        self.assertEqual( status, 255 )
+
+    def test_fallback(self):
+        """
+        without a daemon the client should run the fallback command, which gets all of stdin
+        """
+
+        fallback = [sys.executable, '-c',
+                    'import os, sys; sys.stdout.write(os.environ["SSH_FORWARD_PROXY_NO_DAEMON"] + sys.stdin.read())']
+        output, status = self.run_client(b'input', os.path.join(self.dir, 'missing.sock'), '1234', 'host', 'user',
+                                         *fallback)
+        self.assertEqual( output, b'1input' )
+        self.assertEqual( status, 0 )
+
+    def test_fallback_stale_socket(self):
+        """
+        a socket left behind by a daemon that has stopped should fall back too
+        """
+
+        self.sock.close()
+        output, status = self.run_client(b'', self.path, '1234', 'host', 'user',
+                                         sys.executable, '-c', 'print("relayed")')
+        self.assertEqual( output.strip(), b'relayed' )
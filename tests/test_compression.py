@@ -0,0 +1,140 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import os
+import zlib
+import socket
+import threading
+
+import paramiko
+
+from ssh_forward_proxy import Compression, Compressor, Decompressor, stored_blocks, Server
+
+TEXT = b''.join(b'line %d of some text\n' % i for i in range(100000))
+
+class StoredBlocksTest(unittest.TestCase):
+
+    def test_between_compressed_packets(self):
+        """
+        stored blocks should decompress as part of the zlib stream
+        """
+
+        z = zlib.compressobj()
+        random = os.urandom(100000)
+        stream = (z.compress(TEXT[:5000]) + z.flush(zlib.Z_FULL_FLUSH) +
+                  stored_blocks(random) +
+                  z.compress(TEXT[:5000]) + z.flush(zlib.Z_FULL_FLUSH))
+        self.assertEqual( zlib.decompressobj().decompress(stream), TEXT[:5000] + random + TEXT[:5000] )
+
+    def test_empty(self):
+        self.assertEqual( stored_blocks(b''), b'' )
+
+class CompressorTest(unittest.TestCase):
+    """
+    tests for Compressor and Decompressor
+    """
+
+    def setUp(self):
+        self.compression = Compression('adaptive')
+        self.compression.sample_size = 64 * 1024
+        self.compression.retry_bytes = 256 * 1024
+
+    def send(self, data, packet_size=32 * 1024):
+        compressor = Compressor(self.compression)
+        decompressor = Decompressor(self.compression)
+        received = b''.join(decompressor(compressor(data[i:i + packet_size]))
+                            for i in range(0, len(data), packet_size))
+        self.assertEqual( received, data )
+        return compressor
+
+    def test_compresses(self):
+        compressor = self.send(TEXT)
+        self.assertTrue( compressor.enabled )
+        stats = self.compression.stats()
+        self.assertEqual( stats['raw_out'], len(TEXT) )
+        self.assertLess( stats['compressed_out'], len(TEXT) / 4 )
+        self.assertEqual( (stats['compressed_in'], stats['raw_in']), (stats['compressed_out'], stats['raw_out']) )
+        self.assertEqual( stats['paused'], 0 )
+
+    def test_pauses(self):
+        """
+        compression should pause for data it does not shrink
+        """
+
+        compressor = self.send(os.urandom(128 * 1024))
+        self.assertFalse( compressor.enabled )
+        self.assertEqual( self.compression.stats()['paused'], 1 )
+
+    def test_retries(self):
+        """
+        compression should be tried again after retry_bytes
+        """
+
+        self.send(os.urandom(64 * 1024) + TEXT)
+        stats = self.compression.stats()
+        self.assertEqual( stats['paused'], 1 )
+        self.assertLess( stats['compressed_out'], len(TEXT) / 2 )
+
+    def test_not_adaptive(self):
+        self.compression.mode = 'on'
+        compressor = self.send(os.urandom(128 * 1024))
+        self.assertTrue( compressor.enabled )
+
+class CompressionTest(unittest.TestCase):
+    """
+    tests for Compression
+    """
+
+    def make_transport(self):
+        transport = paramiko.Transport(mock.Mock())
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, Compression, 'fast')
+
+    def test_apply(self):
+        compression = Compression('on', level=1)
+        transport = compression.apply(self.make_transport())
+        self.assertIn( 'zlib@openssh.com', transport.get_security_options().compression )
+        compressor = transport._compression_info['zlib'][0]()
+        self.assertIs( compressor.compression, compression )
+        # not for other transports
+        self.assertIs( self.make_transport()._compression_info['zlib'][0], paramiko.compress.ZlibCompressor )
+
+    def test_off(self):
+        transport = Compression('off').apply(self.make_transport())
+        self.assertEqual( transport.get_security_options().compression, ('none',) )
+
+    def test_session(self):
+        """
+        a session on a compressed transport should be counted on both ends
+        """
+
+        server_compression = Compression('on')
+        client_compression = Compression('on')
+        a, b = socket.socketpair()
+        thread = threading.Thread(target=Server, args=(a,), kwargs=dict(client_compression=server_compression))
+        thread.daemon = True
+        thread.start()
+
+        client = client_compression.apply(paramiko.Transport(b))
+        try:
+            client.start_client(timeout=10)
+            client.auth_none('user')
+            channel = client.open_session()
+            channel.exec_command('seq 1 100000')
+            output = channel.makefile('rb').read()
+        finally:
+            client.close()
+        self.assertEqual( output.count(b'\n'), 100000 )
+
+        stats = server_compression.stats()
+        self.assertGreaterEqual( stats['raw_out'], len(output) )
+        self.assertLess( stats['compressed_out'], stats['raw_out'] / 2 )
+        self.assertGreaterEqual( client_compression.stats()['raw_in'], len(output) )
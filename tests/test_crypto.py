@@ -0,0 +1,112 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import socket
+import threading
+
+import paramiko
+
+from ssh_forward_proxy import CryptoProfile, CRYPTO_PROFILES, get_crypto_profile, ServerInterface
+
+class CryptoProfileTest(unittest.TestCase):
+    """
+    tests for CryptoProfile
+    """
+
+    def make_transport(self):
+        transport = paramiko.Transport(mock.Mock())
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_apply(self):
+        transport = CRYPTO_PROFILES['fast'].apply(self.make_transport())
+        options = transport.get_security_options()
+        self.assertEqual( options.ciphers, ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com') )
+        self.assertEqual( options.kex, ('curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256') )
+        # left alone
+        self.assertEqual( options.key_types, paramiko.Transport._preferred_keys )
+
+    def test_compat(self):
+        transport = CRYPTO_PROFILES['compat'].apply(self.make_transport())
+        self.assertEqual( transport.get_security_options().ciphers, paramiko.Transport._preferred_ciphers )
+
+    def test_unsupported(self):
+        """
+        algorithms paramiko does not support should be left out
+        """
+
+        profile = CryptoProfile('test', ciphers=['chacha20-poly1305@openssh.com', 'aes256-ctr'])
+        transport = profile.apply(self.make_transport())
+        self.assertEqual( transport.get_security_options().ciphers, ('aes256-ctr',) )
+
+    def test_none_supported(self):
+        profile = CryptoProfile('test', macs=['umac-128@openssh.com'])
+        self.assertRaises(ValueError, profile.apply, self.make_transport())
+
+    def test_transport_factory(self):
+        factory = mock.Mock()
+        profile = CryptoProfile('test')
+        with patch.object(profile, 'apply') as apply:
+            transport = profile.transport_factory(factory)(sentinel.sock, disabled_algorithms=None)
+        factory.assert_called_once_with(sentinel.sock, disabled_algorithms=None)
+        apply.assert_called_once_with(factory.return_value)
+        self.assertIs( transport, apply.return_value )
+
+    def test_get(self):
+        self.assertIs( get_crypto_profile('strict'), CRYPTO_PROFILES['strict'] )
+        self.assertIs( get_crypto_profile(CRYPTO_PROFILES['fast']), CRYPTO_PROFILES['fast'] )
+        self.assertIsNone( get_crypto_profile(None) )
+        self.assertRaises(ValueError, get_crypto_profile, 'quick')
+
+class NegotiationTest(unittest.TestCase):
+    """
+    tests that ServerInterface negotiates with its client_profile
+    """
+
+    def handshake(self, profile, client_profile=None):
+        a, b = socket.socketpair()
+        server = []
+        def run():
+            try:
+                server.append(ServerInterface(a, client_profile=profile))
+            except paramiko.SSHException:
+                a.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        client = paramiko.Transport(b)
+        if client_profile:
+            CRYPTO_PROFILES[client_profile].apply(client)
+        self.addCleanup(client.close)
+        try:
+            client.start_client(timeout=10)
+        finally:
+            thread.join()
+        self.addCleanup(server[0].transport.close)
+        return server[0].transport
+
+    def test_fast(self):
+        transport = self.handshake('fast')
+        self.assertEqual( transport.remote_cipher, 'aes128-gcm@openssh.com' )
+
+    def test_strict(self):
+        """
+        the client's preferences should be used within the profile
+        """
+
+        transport = self.handshake('strict')
+        self.assertEqual( transport.remote_cipher, 'aes128-ctr' )
+        self.assertEqual( transport.remote_mac, 'hmac-sha2-256-etm@openssh.com' )
+
+    def test_no_common_algorithm(self):
+        """
+        a client offering none of the profile's algorithms should be refused
+        """
+
+        profile = CryptoProfile('test', ciphers=['aes128-cbc'])
+        self.assertRaises(paramiko.SSHException, self.handshake, profile, 'strict')
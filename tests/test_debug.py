@@ -0,0 +1,117 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from ssh_forward_proxy import (label_thread, dump_threads, SamplingProfiler, collapsed_stacks,
+                               admin_command, get_profiler, AdminServer)
+
+def wait_for(event):
+    event.wait(5)
+
+class ThreadDumpTest(unittest.TestCase):
+    def setUp(self):
+        self.started = threading.Event()
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+
+    def labelled(self):
+        label_thread(session='abc')
+        label_thread(host='example.com:22')
+        self.started.set()
+        self.stop.wait(5)
+
+    def test_dump(self):
+        """each thread's stack is headed by its name and labels"""
+
+        thread = threading.Thread(target=self.labelled, name='session-thread')
+        thread.start()
+        wait_for(self.started)
+        dump = dump_threads()
+        self.assertIn( 'Thread session-thread host=example.com:22 session=abc', dump )
+        self.assertIn( 'in labelled', dump )
+
+    def test_profile(self):
+        """the profiler counts the collapsed stacks of the other threads"""
+
+        thread = threading.Thread(target=self.labelled, name='session-thread')
+        thread.start()
+        wait_for(self.started)
+        counts = SamplingProfiler(0.001).run(0.05)
+        stacks = [stack for stack in counts if stack.startswith('session-thread;')]
+        self.assertEqual( len(stacks), 1 )
+        self.assertIn( ';labelled (test_debug.py:', stacks[0] )
+        self.assertTrue( collapsed_stacks(counts).endswith(' {}\n'.format(counts[sorted(counts)[-1]])) )
+
+    def test_one_profile(self):
+        """only one profile runs at a time"""
+
+        profiler = SamplingProfiler()
+        profiler.lock.acquire()
+        self.assertRaises( RuntimeError, profiler.run, 0.01 )
+
+class AdminCommandTest(unittest.TestCase):
+    def test_help(self):
+        self.assertIn( 'profile [SECONDS]', admin_command('help\n') )
+
+    def test_unknown(self):
+        self.assertEqual( admin_command('nope\n'), 'Unknown command: nope (try help)\n' )
+
+    def test_profile(self):
+        with patch.object(get_profiler(), 'run', return_value={'main;f (x.py:1)': 3}) as run:
+            self.assertEqual( admin_command('profile 2.5\n'), 'main;f (x.py:1) 3\n' )
+        run.assert_called_once_with(2.5)
+
+    def test_profile_invalid(self):
+        self.assertEqual( admin_command('profile soon\n'), 'Invalid number of seconds: soon\n' )
+
+class AdminServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'admin.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def command(self, path, line):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(line)
+        reply = b''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            reply += data
+        sock.close()
+        return reply.decode('utf-8')
+
+    def test_threads(self):
+        """the admin socket answers commands and is only usable by its owner"""
+
+        server = AdminServer(self.path)
+        server.start()
+        try:
+            self.assertIn( 'Thread admin', self.command(self.path, b'threads\n') )
+            self.assertEqual( os.stat(self.path).st_mode & 0o777, 0o600 )
+        finally:
+            server.close()
+        self.assertFalse( os.path.exists(self.path) )
+
+    def test_worker_slot(self):
+        server = AdminServer(self.path)
+        server.start(1)
+        try:
+            self.assertEqual( server.server_address, self.path + '.1' )
+        finally:
+            server.close()
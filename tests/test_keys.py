@@ -0,0 +1,277 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+
+import os
+import shutil
+import tempfile
+import threading
+
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from ssh_forward_proxy import load_key, ServerKeys, get_server_keys, reload_server_keys, \
+    KnownHosts, KnownHostsPolicy, known_host_name
+
+ROOT_DIR = os.path.abspath(os.path.join(__file__, '..', '..'))
+RSA_KEY = os.path.join(ROOT_DIR, 'tests', 'test-server-key')
+DEFAULT_KEY = os.path.join(ROOT_DIR, 'tests', 'default-server-key')
+
+class KeyFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_key(self, name, key):
+        path = os.path.join(self.dir, name)
+        if isinstance(key, paramiko.PKey):
+            key.write_private_key_file(path)
+        else:
+            data = key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.OpenSSH,
+                serialization.NoEncryption(),
+            )
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+class LoadKeyTest(KeyFileTestCase):
+    """
+    tests for load_key
+    """
+
+    def test_rsa(self):
+        self.assertEqual( load_key(RSA_KEY), paramiko.RSAKey(filename=RSA_KEY) )
+
+    def test_ecdsa(self):
+        key = paramiko.ECDSAKey.generate()
+        path = self.write_key('ecdsa', key)
+        self.assertEqual( load_key(path).get_name(), key.get_name() )
+
+    def test_ed25519(self):
+        path = self.write_key('ed25519', ed25519.Ed25519PrivateKey.generate())
+        self.assertEqual( load_key(path).get_name(), 'ssh-ed25519' )
+
+    def test_invalid(self):
+        path = os.path.join(self.dir, 'invalid')
+        with open(path, 'w') as f:
+            f.write('not a key')
+        with self.assertRaises(paramiko.SSHException):
+            load_key(path)
+
+class ServerKeysTest(KeyFileTestCase):
+    """
+    tests for ServerKeys and get_server_keys
+    """
+
+    def test_default_key(self):
+        """
+        the key bundled in the package should be used by default
+        """
+
+        keys = ServerKeys()
+        self.assertEqual( keys.get(), [paramiko.RSAKey(filename=DEFAULT_KEY)] )
+
+    def test_multiple_keys(self):
+        ecdsa = self.write_key('ecdsa', paramiko.ECDSAKey.generate())
+        keys = ServerKeys([RSA_KEY, ecdsa])
+        self.assertEqual( [k.get_name() for k in keys.get()], ['ssh-rsa', 'ecdsa-sha2-nistp256'] )
+
+    def test_cached(self):
+        """
+        keys should only be loaded once per set of files
+        """
+
+        with patch('ssh_forward_proxy.keys.load_key', wraps=load_key) as load:
+            path = self.write_key('rsa', paramiko.RSAKey(filename=RSA_KEY))
+            keys = get_server_keys(path)
+            self.assertIs( get_server_keys(path), keys )
+            self.assertIs( get_server_keys([path]), keys )
+            self.assertIs( get_server_keys(keys), keys )
+            keys.get()
+            load.assert_called_once_with(path)
+
+    def test_reload_on_change(self):
+        """
+        keys should be reloaded when the file changes
+        """
+
+        path = self.write_key('key', paramiko.RSAKey(filename=RSA_KEY))
+        keys = ServerKeys([path])
+        keys.check_interval = 0
+
+        self.write_key('key', paramiko.ECDSAKey.generate())
+        os.utime(path, (0, 0))
+        self.assertEqual( keys.get()[0].get_name(), 'ecdsa-sha2-nistp256' )
+
+    def test_bad_reload_keeps_keys(self):
+        """
+        a broken key file should not replace the loaded keys
+        """
+
+        path = self.write_key('key', paramiko.RSAKey(filename=RSA_KEY))
+        keys = ServerKeys([path])
+        keys.check_interval = 0
+
+        with open(path, 'w') as f:
+            f.write('not a key')
+        os.utime(path, (0, 0))
+        self.assertEqual( keys.get(), [paramiko.RSAKey(filename=RSA_KEY)] )
+
+    def test_reload_server_keys(self):
+        """
+        reload_server_keys() should reload all shared keys
+        """
+
+        path = self.write_key('rsa', paramiko.RSAKey(filename=RSA_KEY))
+        keys = get_server_keys(path)
+        with patch.object(keys, 'reload') as reload:
+            reload_server_keys()
+            reload.assert_called_once_with()
+
+class KnownHostsTest(KeyFileTestCase):
+    """
+    tests for KnownHosts
+    """
+
+    def setUp(self):
+        super(KnownHostsTest, self).setUp()
+        self.key = paramiko.RSAKey(filename=RSA_KEY)
+        self.other_key = paramiko.ECDSAKey.generate()
+        self.path = os.path.join(self.dir, 'known_hosts')
+
+    def write(self, *lines):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def line(self, names, key):
+        return '{} {} {}'.format(names, key.get_name(), key.get_base64())
+
+    def test_known_host_name(self):
+        self.assertEqual( known_host_name('host', 22), 'host' )
+        self.assertEqual( known_host_name('host', 2222), '[host]:2222' )
+
+    def test_lookup(self):
+        self.write(
+            '# comment',
+            self.line('host,1.2.3.4', self.key),
+            self.line('[other]:2222', self.other_key),
+            '@revoked * ' + self.key.get_name() + ' ' + self.key.get_base64(),
+        )
+        known_hosts = KnownHosts(self.path)
+        self.assertEqual( known_hosts.lookup('1.2.3.4'), [self.key] )
+        self.assertEqual( known_hosts.lookup('[other]:2222'), [self.other_key] )
+        self.assertEqual( known_hosts.lookup('other'), [] )
+
+    def test_hashed(self):
+        """
+        hashed hostnames should be matched, and only hashed once per host
+        """
+
+        self.write(
+            self.line(paramiko.HostKeys.hash_host('host'), self.key),
+            self.line(paramiko.HostKeys.hash_host('other'), self.other_key),
+        )
+        known_hosts = KnownHosts(self.path)
+        with patch.object(paramiko.HostKeys, 'hash_host', wraps=paramiko.HostKeys.hash_host) as hash_host:
+            self.assertEqual( known_hosts.lookup('host'), [self.key] )
+            self.assertEqual( known_hosts.lookup('host'), [self.key] )
+            self.assertEqual( hash_host.call_count, 2 )
+
+    def test_reload_on_change(self):
+        self.write(self.line('host', self.key))
+        known_hosts = KnownHosts(self.path)
+        known_hosts.check_interval = 0
+        self.assertEqual( known_hosts.lookup('host'), [self.key] )
+
+        self.write(self.line('host', self.other_key))
+        os.utime(self.path, (0, 0))
+        self.assertEqual( known_hosts.lookup('host'), [self.other_key] )
+
+    def test_missing_file(self):
+        known_hosts = KnownHosts(self.path)
+        self.assertEqual( known_hosts.lookup('host'), [] )
+
+    def test_add(self):
+        """
+        new keys should be trusted straight away and saved in one batch
+        """
+
+        self.write(self.line('host', self.key))
+        known_hosts = KnownHosts(self.path)
+        known_hosts.check_interval = 0
+        known_hosts.flush_interval = 60
+        self.assertEqual( known_hosts.lookup('new'), [] )
+
+        known_hosts.add('new', self.other_key)
+        known_hosts.add('[new]:2222', self.key)
+        self.assertEqual( known_hosts.lookup('new'), [self.other_key] )
+        with open(self.path) as f:
+            self.assertEqual( len(f.readlines()), 1 )
+
+        known_hosts.flush()
+        self.assertIsNone( known_hosts.flush_timer )
+        with open(self.path) as f:
+            self.assertEqual( f.read().splitlines(), [
+                self.line('host', self.key),
+                self.line('new', self.other_key),
+                self.line('[new]:2222', self.key),
+            ])
+
+        # our own write is not reloaded
+        with patch.object(known_hosts, 'reload') as reload:
+            known_hosts.lookup('new')
+            self.assertFalse( reload.called )
+
+    def test_reload_keeps_pending(self):
+        """
+        keys not saved yet should survive a reload
+        """
+
+        self.write(self.line('host', self.key))
+        known_hosts = KnownHosts(self.path)
+        known_hosts.flush_interval = 60
+        known_hosts.add('new', self.other_key)
+        known_hosts.reload()
+        self.assertEqual( known_hosts.lookup('new'), [self.other_key] )
+        known_hosts.flush()
+
+    def test_reload_during_flush(self):
+        """
+        a reload racing a flush should not lose the keys being saved
+        """
+
+        self.write(self.line('host', self.key))
+        known_hosts = KnownHosts(self.path)
+        known_hosts.flush_interval = 60
+        known_hosts.add('new', self.other_key)
+        threads = []
+
+        def open_file(filename, mode='r'):
+            if mode == 'a' and not threads:
+                # reload from another thread just before the keys are written
+                threads.append(threading.Thread(target=known_hosts.reload))
+                threads[0].start()
+                threads[0].join(0.2)
+            return open(filename, mode)
+
+        with patch('ssh_forward_proxy.keys.open', open_file, create=True):
+            known_hosts.flush()
+        threads[0].join()
+        self.assertEqual( known_hosts.lookup('new'), [self.other_key] )
+
+    def test_policy(self):
+        known_hosts = KnownHosts(self.path)
+        known_hosts.flush_interval = 60
+        client = paramiko.SSHClient()
+        KnownHostsPolicy(known_hosts).missing_host_key(client, '[host]:2222', self.key)
+        self.assertEqual( client.get_host_keys().lookup('[host]:2222')['ssh-rsa'], self.key )
+        self.assertEqual( known_hosts.lookup('[host]:2222'), [self.key] )
+        known_hosts.flush()
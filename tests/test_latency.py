@@ -0,0 +1,61 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+
+from ssh_forward_proxy import LatencyHistogram, RelayLatency
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        """values should fall in a bucket within 1/sub_buckets of them"""
+
+        histogram = LatencyHistogram()
+        for value in (1e-6, 3.3e-5, 0.0123, 0.5, 7.0):
+            bound = histogram.upper_bound(histogram.index(value))
+            self.assertGreater( bound, value )
+            self.assertLessEqual( bound, value * (1 + 1.0 / histogram.sub_buckets) )
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000000.0)
+        self.assertEqual( histogram.count, 1000 )
+        self.assertAlmostEqual( histogram.percentile(50), 0.0005, delta=0.0005 / 16 )
+        self.assertAlmostEqual( histogram.percentile(99), 0.00099, delta=0.00099 / 16 )
+        self.assertEqual( histogram.percentile(100), 0.001 )
+
+    def test_empty(self):
+        stats = LatencyHistogram().stats()
+        self.assertEqual( stats['count'], 0 )
+        self.assertEqual( stats['p99'], 0 )
+        self.assertEqual( stats['p99_9'], 0 )
+
+class RelayLatencyTest(unittest.TestCase):
+    def test_off(self):
+        """nothing should be sampled by default"""
+
+        latency = RelayLatency()
+        self.assertFalse( any(latency.sample() for i in range(100)) )
+
+    def test_sample_every(self):
+        latency = RelayLatency(4)
+        self.assertEqual( [latency.sample() for i in range(8)], [False, False, False, True] * 2 )
+
+    def test_stats(self):
+        latency = RelayLatency(1)
+        latency.record('upstream', 0.002)
+        stats = latency.stats()
+        self.assertEqual( stats['upstream_count'], 1 )
+        self.assertEqual( stats['upstream_max'], 0.002 )
+        self.assertEqual( stats['downstream_count'], 0 )
+
+    def test_log(self):
+        """the percentiles should be logged every log_interval seconds"""
+
+        latency = RelayLatency(1)
+        latency.log_interval = 0
+        with patch('logging.info') as info:
+            latency.record('downstream', 0.001)
+        self.assertIn( 'downstream n=1', info.call_args[0][1] )
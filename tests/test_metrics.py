@@ -0,0 +1,168 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+
+import os
+import shutil
+import socket
+import tempfile
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from ssh_forward_proxy import Counter, Gauge, Histogram, Metrics, MetricsServer, get_metrics
+
+class FakeRelay:
+    def __init__(self, stdin=0, stdout=0, stderr=0):
+        self.stdin = mock.Mock(total=stdin)
+        self.stdout = mock.Mock(total=stdout)
+        self.stderr = mock.Mock(total=stderr)
+
+class MetricTest(unittest.TestCase):
+    """
+    tests for Counter, Gauge and Histogram
+    """
+
+    def test_counter(self):
+        counter = Counter('things_total', 'Things', ['host'])
+        counter.inc(host='a')
+        counter.inc(2, host='a')
+        counter.inc(host='b"')
+        self.assertEqual( counter.get(host='a'), 3 )
+        self.assertEqual( counter.render(), [
+            '# HELP ssh_forward_proxy_things_total Things',
+            '# TYPE ssh_forward_proxy_things_total counter',
+            'ssh_forward_proxy_things_total{host="a"} 3',
+            'ssh_forward_proxy_things_total{host="b\\""} 1',
+        ])
+
+    def test_gauge(self):
+        gauge = Gauge('things', 'Things')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual( gauge.render()[1:], ['# TYPE ssh_forward_proxy_things gauge', 'ssh_forward_proxy_things 1'] )
+
+    def test_histogram(self):
+        histogram = Histogram('wait_seconds', 'Waits', ['host'], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, host='a')
+        self.assertEqual( histogram.render()[2:], [
+            'ssh_forward_proxy_wait_seconds_bucket{host="a",le="0.1"} 2',
+            'ssh_forward_proxy_wait_seconds_bucket{host="a",le="1"} 3',
+            'ssh_forward_proxy_wait_seconds_bucket{host="a",le="+Inf"} 4',
+            'ssh_forward_proxy_wait_seconds_sum{host="a"} 2.65',
+            'ssh_forward_proxy_wait_seconds_count{host="a"} 4',
+        ])
+        self.assertEqual( histogram.count(host='a'), 4 )
+        self.assertEqual( histogram.count(host='b'), 0 )
+
+class MetricsTest(unittest.TestCase):
+    """
+    tests for Metrics
+    """
+
+    def test_sessions(self):
+        metrics = Metrics()
+        metrics.session_started()
+        metrics.session_started()
+        metrics.session_finished()
+        self.assertEqual( metrics.sessions.get(), 2 )
+        self.assertEqual( metrics.active_sessions.get(), 1 )
+
+    def test_live_relays(self):
+        """
+        bytes of relays in progress should be counted without waiting for them to finish
+        """
+
+        metrics = Metrics()
+        relay = FakeRelay(stdin=10, stdout=100)
+        metrics.relay_started(relay, 'remote:22')
+        self.assertIn( 'ssh_forward_proxy_relayed_bytes_total{stream="stdout",direction="downstream",host="remote:22"} 100',
+                       metrics.render() )
+
+        relay.stdout.total = 150
+        metrics.relay_finished(relay)
+        relay.stdout.total = 1000
+        self.assertEqual( metrics.relayed_bytes.get(stream='stdout', direction='downstream', host='remote:22'), 150 )
+        self.assertEqual( metrics.relayed_bytes.get(stream='stdin', direction='upstream', host='remote:22'), 10 )
+        self.assertIn( 'host="remote:22"} 150', metrics.render() )
+
+        # finishing twice counts once
+        metrics.relay_finished(relay)
+        self.assertEqual( metrics.relayed_bytes.get(stream='stdout', direction='downstream', host='remote:22'), 150 )
+
+    def test_stats(self):
+        metrics = Metrics()
+        metrics.add_stats('pool', lambda: dict(hits=3, connections=1, name='x'), counters=['hits'])
+        text = metrics.render()
+        self.assertIn( '# TYPE ssh_forward_proxy_pool_hits_total counter\nssh_forward_proxy_pool_hits_total 3\n', text )
+        self.assertIn( '# TYPE ssh_forward_proxy_pool_connections gauge\nssh_forward_proxy_pool_connections 1\n', text )
+        self.assertNotIn( 'pool_name', text )
+
+    def test_stats_of_other_processes(self):
+        """
+        stats added before a fork should not be read in the child
+        """
+
+        metrics = Metrics()
+        metrics.add_stats('pool', lambda: dict(hits=3))
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertNotIn( 'pool', metrics.render() )
+
+    def test_failing_stats(self):
+        metrics = Metrics()
+        metrics.add_stats('broken', mock.Mock(side_effect=RuntimeError))
+        metrics.add_stats('pool', lambda: dict(hits=3))
+        self.assertIn( 'ssh_forward_proxy_pool_hits 3', metrics.render() )
+
+class MetricsServerTest(unittest.TestCase):
+    """
+    tests for MetricsServer
+    """
+
+    def test_addresses(self):
+        self.assertEqual( MetricsServer('9100').parse_address(), (socket.AF_INET, ('127.0.0.1', 9100)) )
+        self.assertEqual( MetricsServer('0.0.0.0:9100').parse_address(1), (socket.AF_INET, ('0.0.0.0', 9102)) )
+        self.assertEqual( MetricsServer('/run/metrics').parse_address(0), (socket.AF_UNIX, '/run/metrics.0') )
+
+    def test_http(self):
+        server = MetricsServer('0')
+        server.start()
+        self.addCleanup(server.close)
+        get_metrics().sessions.inc()
+
+        response = urlopen('http://{}:{}/metrics'.format(*server.server_address))
+        self.assertTrue( response.headers['Content-Type'].startswith('text/plain; version=0.0.4') )
+        self.assertIn( b'\nssh_forward_proxy_sessions_total ', response.read() )
+
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'metrics')
+
+        server = MetricsServer(path)
+        server.start()
+        # started once per process
+        server.start()
+        self.assertEqual( os.stat(path).st_mode & 0o777, 0o600 )
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+        sock.close()
+        self.assertTrue( response.startswith(b'HTTP/1.0 200') )
+        self.assertIn( b'# TYPE ssh_forward_proxy_sessions_active gauge', response )
+
+        server.close()
+        self.assertFalse( os.path.exists(path) )
@@ -11,13 +11,16 @@ from .test_server import PatchedServer, TransportTest
 
 import os
 import sys
+import time
+import socket
+import threading
 try:
     import queue
 except ImportError:
     import Queue as queue
 
 import paramiko
-from ssh_forward_proxy import Proxy, StdSocket
+from ssh_forward_proxy import Proxy, StdSocket, UpstreamPool, ServerInterface, Forward, CRYPTO_PROFILES, get_metrics
 
 class SimpleProxyTestCase(helper.TestCase):
     """
@@ -59,27 +62,143 @@ class ExecTest(SimpleProxyTestCase):
         queued_items = proxy.queue.get(0)
         self.assertEqual(queued_items, (sentinel.channel, sentinel.command))
 
+class RelayFinishedTest(SimpleProxyTestCase):
+    """
+    tests for Proxy.relay_finished
+    """
+
+    def test_records_transfer(self):
+        """
+        the bytes received from the remote should be passed to the upstream tuning
+        """
+
+        proxy = Proxy()
+        proxy.connect_kwargs = dict(upstream_tuning=mock.Mock())
+        relay = mock.Mock()
+        relay.stats.return_value = dict(stdout_bytes=1000, stderr_bytes=24, seconds=2)
+        proxy.relay_finished(relay)
+
+        proxy.connect_kwargs['upstream_tuning'].record.assert_called_once_with(
+            relay.output.channel.get_transport(), 1024, 2)
+
+    def test_no_tuning(self):
+        proxy = Proxy()
+        proxy.connect_kwargs = {}
+        relay = mock.Mock()
+        proxy.relay_finished(relay)
+        self.assertFalse( relay.stats.called )
+
 class RemoteConnectionTest(unittest.TestCase):
     """
     tests for Proxy.connect_to_remote
     """
 
+    def setUp(self):
+        patcher = patch('ssh_forward_proxy.server.open_connection',
+                        side_effect=lambda host, port, timeout: (host, port, sentinel.sock))
+        self.open_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('paramiko.SSHClient')
-    def test_connects_to_remote(self, client):
+    @patch('ssh_forward_proxy.server.get_identities')
+    def test_connects_to_remote(self, get_identities, client):
         """
-        it should connect to the remote
+        it should connect to the remote with the shared identities
         """
 
         host = 'abcdef'
         port = 12345
-        kwargs = {'username': 'user', 'key': 'value'}
-        Proxy.connect_to_remote(host=host, port=port, **kwargs)
+        Proxy.connect_to_remote(host=host, port=port, username='user', key='value')
 
         client.assert_called_once_with()
-        client.return_value.connect.assert_called_once_with(host, port, **kwargs)
+        self.open_connection.assert_called_once_with(host, port, timeout=None)
+        get_identities.return_value.connect.assert_called_once_with(client.return_value, host, port, 'user',
+                                                                    sock=sentinel.sock, key='value')
+
+    @patch('paramiko.SSHClient')
+    @patch('ssh_forward_proxy.server.get_identities')
+    @patch('ssh_forward_proxy.server.get_known_hosts')
+    def test_known_hosts(self, get_known_hosts, get_identities, client):
+        """
+        known keys for the remote should come from the shared known_hosts
+        """
+
+        key = mock.Mock()
+        get_known_hosts.return_value.lookup.return_value = [key]
+        self.open_connection.side_effect = lambda host, port, timeout: ('mirror', 2222, sentinel.sock)
+        Proxy.connect_to_remote('abcdef', 12345, 'user', known_hosts='file')
+
+        get_known_hosts.assert_called_once_with('file')
+        # the host key of the mirror connected to
+        get_known_hosts.return_value.lookup.assert_called_once_with('[mirror]:2222')
+        client.return_value.get_host_keys().add.assert_called_once_with('[mirror]:2222', key.get_name(), key)
+        policy = client.return_value.set_missing_host_key_policy.call_args[0][0]
+        self.assertIs( policy.known_hosts, get_known_hosts.return_value )
 
     @patch('paramiko.SSHClient')
-    def test_client_is_returned(self, client):
+    @patch('ssh_forward_proxy.server.get_identities')
+    def test_upstream_tuning(self, get_identities, client):
+        """
+        the transport should be tuned for the mirror connected to
+        """
+
+        tuning = mock.Mock()
+        self.open_connection.side_effect = lambda host, port, timeout: ('mirror', 2222, sentinel.sock)
+        Proxy.connect_to_remote('abcdef', 12345, 'user', upstream_tuning=tuning)
+
+        tuning.transport_factory.assert_called_once_with('mirror', 2222)
+        kwargs = get_identities.return_value.connect.call_args[1]
+        self.assertIs( kwargs['transport_factory'], tuning.transport_factory.return_value )
+
+    @patch('paramiko.SSHClient')
+    @patch('ssh_forward_proxy.server.get_identities')
+    def test_upstream_profile(self, get_identities, client):
+        """
+        the profile should be applied to the tuned transport
+        """
+
+        tuning = mock.Mock()
+        Proxy.connect_to_remote('abcdef', 12345, 'user', upstream_tuning=tuning, upstream_profile='fast')
+
+        factory = get_identities.return_value.connect.call_args[1]['transport_factory']
+        with patch.object(CRYPTO_PROFILES['fast'], 'apply') as apply:
+            transport = factory(sentinel.sock)
+        tuning.transport_factory.return_value.assert_called_once_with(sentinel.sock)
+        apply.assert_called_once_with(tuning.transport_factory.return_value.return_value)
+        self.assertIs( transport, apply.return_value )
+
+    @patch('paramiko.SSHClient')
+    @patch('ssh_forward_proxy.server.get_identities')
+    def test_upstream_compression(self, get_identities, client):
+        compression = mock.Mock(enabled=True)
+        Proxy.connect_to_remote('abcdef', 12345, 'user', upstream_compression=compression)
+
+        kwargs = get_identities.return_value.connect.call_args[1]
+        self.assertTrue( kwargs['compress'] )
+        compression.transport_factory.assert_called_once_with(paramiko.Transport)
+        self.assertIs( kwargs['transport_factory'], compression.transport_factory.return_value )
+
+    @patch('paramiko.SSHClient')
+    @patch('ssh_forward_proxy.server.get_identities')
+    def test_metrics(self, get_identities, client):
+        """
+        connect times and authentication failures should be counted for the remote
+        """
+
+        metrics = get_metrics()
+        count = metrics.upstream_connect_seconds.count(host='metrics:22')
+        failures = metrics.upstream_auth_failures.get(host='metrics:22')
+        Proxy.connect_to_remote('metrics', 22, 'user')
+        self.assertEqual( metrics.upstream_connect_seconds.count(host='metrics:22'), count + 1 )
+
+        get_identities.return_value.connect.side_effect = paramiko.AuthenticationException
+        with self.assertRaises(paramiko.AuthenticationException):
+            Proxy.connect_to_remote('metrics', 22, 'user')
+        self.assertEqual( metrics.upstream_auth_failures.get(host='metrics:22'), failures + 1 )
+
+    @patch('paramiko.SSHClient')
+    @patch('ssh_forward_proxy.server.get_identities')
+    def test_client_is_returned(self, get_identities, client):
         result = Proxy.connect_to_remote('abcdef', 12345, 'user')
         self.assertIs(result, client.return_value)
 
@@ -96,7 +215,7 @@ class TransportTest(TransportTest):
         """
 
         self.patch_get_command()
-        with patch('ssh_forward_proxy.StdSocket') as sock:
+        with patch('ssh_forward_proxy.server.StdSocket') as sock:
             proxy = self.SERVER()
             self.assertIs(proxy.transport.sock, sock())
 
@@ -172,3 +291,235 @@ class IOTest(PatchedServer):
         self.make_proxy()
         self.client.close.assert_called_once_with()
         self.remote.close.assert_called_once_with()
+
+class PooledIOTest(IOTest):
+    """
+    tests that the proxy relays over a pooled remote connection
+    """
+
+    def make_proxy(self):
+        self.pool = UpstreamPool()
+        return Proxy(host='host', port=1234, pool=self.pool)
+
+    def test_channels_closed(self):
+        """
+        the remote connection is returned to the pool rather than closed
+        """
+
+        self.make_proxy()
+        self.client.close.assert_called_once_with()
+        self.remote_channel.close.assert_called_once_with()
+        self.assertFalse( self.remote.close.called )
+        self.assertEqual( self.pool.stats()['connections'], 1 )
+        self.assertEqual( self.pool.stats()['sessions'], 0 )
+
+class PrefetchTest(PatchedServer):
+    """
+    tests that the proxy connects to the remote during the client handshake
+    """
+
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.add_patch( patch.object(Proxy, 'connect_to_remote') )
+        self.remote = Proxy.connect_to_remote()
+        self.remote_channel = fake_io.FakeOutputChannel()
+        self.remote.get_transport().open_session.return_value = self.remote_channel
+        self.client = fake_io.FakeInputChannel()
+
+    def tearDown(self):
+        super(PrefetchTest, self).tearDown()
+        fake_io.close_fake_io(self.remote_channel)
+        fake_io.close_fake_io(self.client)
+
+    def test_connects_before_command(self):
+        """
+        the remote connection should be started before the client sends a command
+        """
+
+        connect_to_remote = Proxy.connect_to_remote
+        def start_server(server):
+            # the connection is made in the background during the handshake
+            for i in range(50):
+                if connect_to_remote.called:
+                    break
+                time.sleep(0.01)
+            self.assertTrue( connect_to_remote.called )
+            self.queue.put((self.client, sentinel.command))
+
+        with patch('paramiko.Transport.start_server', side_effect=start_server):
+            proxy = Proxy(username='user', host='host', port=1234)
+        connect_to_remote.assert_called_with(username='user', host='host', port=1234)
+        self.assertEqual( connect_to_remote.call_count, 2 )
+        self.remote_channel.exec_command.assert_called_once_with(sentinel.command)
+
+    def test_cancelled_without_command(self):
+        """
+        the prefetched connection should be closed if the client sends no command
+        """
+
+        with patch.object(ServerInterface, 'get_command', return_value=(None, None)):
+            proxy = Proxy(username='user', host='host', port=1234)
+        self.wait_for_close()
+        Proxy.connect_to_remote.return_value.close.assert_called_once_with()
+
+    def wait_for_close(self):
+        # a cancelled connection is closed by its connecting thread
+        close = Proxy.connect_to_remote.return_value.close
+        for i in range(100):
+            if close.called:
+                break
+            time.sleep(0.01)
+
+class PrefetchedSessionTest(SimpleProxyTestCase):
+    """
+    tests for Proxy.open_remote_session with a prefetched connection
+    """
+
+    def make_proxy(self, channel=None, **kwargs):
+        proxy = Proxy()
+        proxy.pool = None
+        proxy.lock = threading.Lock()
+        proxy.pending = {channel: mock.Mock(kwargs=kwargs)}
+        return proxy
+
+    def test_uses_prefetched(self):
+        proxy = self.make_proxy(username='user', host='host', port=22)
+        pending = proxy.pending[None]
+        connection, channel = proxy.open_remote_session(sentinel.channel, username='user', host='host', port=22)
+        self.assertIs( connection, pending.result.return_value )
+        self.assertIs( channel, connection.open_session.return_value )
+        self.assertEqual( proxy.pending, {} )
+
+    def test_prefetched_for_channel(self):
+        """
+        a connection prefetched for a channel should only be used by that channel
+        """
+
+        proxy = self.make_proxy(sentinel.channel, username='user', host='host', port=22)
+        pending = proxy.pending[sentinel.channel]
+        with patch.object(Proxy, 'connect_to_remote') as connect_to_remote:
+            proxy.open_remote_session(sentinel.other, username='user', host='host', port=22)
+            self.assertTrue( connect_to_remote.called )
+        self.assertIn( sentinel.channel, proxy.pending )
+
+        connection, channel = proxy.open_remote_session(sentinel.channel, username='user', host='host', port=22)
+        self.assertIs( connection, pending.result.return_value )
+
+    @patch.object(Proxy, 'connect_to_remote')
+    def test_different_username(self, connect_to_remote):
+        """
+        the prefetched connection should not be used if the client logged in as someone else
+        """
+
+        proxy = self.make_proxy(username='user', host='host', port=22)
+        pending = proxy.pending[None]
+        proxy.open_remote_session(sentinel.channel, username='other', host='host', port=22)
+        pending.cancel.assert_called_once_with()
+        connect_to_remote.assert_called_once_with(username='other', host='host', port=22)
+
+    @patch.object(Proxy, 'connect_to_remote')
+    def test_prefetched_failed(self, connect_to_remote):
+        """
+        a new connection should be made if the prefetched one cannot open a session
+        """
+
+        proxy = self.make_proxy(username='user', host='host', port=22)
+        connection = proxy.pending[None].result.return_value
+        connection.open_session.side_effect = EOFError
+        proxy.open_remote_session(sentinel.channel, username='user', host='host', port=22)
+        connection.close.assert_called_once_with()
+        connect_to_remote.assert_called_once_with(username='user', host='host', port=22)
+
+class EchoUpstream(ServerInterface):
+    """
+    an upstream which answers each forwarded connection
+    with what it was sent, upper-cased, once the client sends EOF
+    """
+
+    def __init__(self, socket, destinations):
+        self.destinations = destinations
+        ServerInterface.__init__(self, socket)
+        self.serve()
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations.append(destination)
+        self.queue.put((None, Forward(chanid, origin, destination)))
+        return paramiko.OPEN_SUCCEEDED
+
+    def handle_command(self, channel, forward):
+        try:
+            channel.sendall(channel.makefile('rb').read().upper())
+        finally:
+            channel.close()
+            self.end_session()
+
+class ForwardTest(unittest.TestCase):
+    """
+    tests that direct-tcpip channels are forwarded through the remote
+    """
+
+    def start_client(self, sock):
+        transport = paramiko.Transport(sock)
+        transport.start_client()
+        transport.auth_none('user')
+        return transport
+
+    def start(self, target):
+        thread = threading.Thread(target=target)
+        thread.start()
+        self.threads.append(thread)
+
+    def setUp(self):
+        self.threads = []
+        self.destinations = []
+        upstream_sock, remote_sock = socket.socketpair()
+        self.start(lambda: EchoUpstream(upstream_sock, self.destinations))
+        self.remote = self.start_client(remote_sock)
+
+        remote = mock.Mock()
+        remote.get_transport.return_value = self.remote
+        patcher = patch.object(Proxy, 'connect_to_remote', return_value=remote)
+        self.connect_to_remote = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_proxy(self, **kwargs):
+        proxy_sock, client_sock = socket.socketpair()
+        self.start(lambda: Proxy(proxy_sock, username='user', host='remote', port=22, **kwargs))
+        self.client = self.start_client(client_sock)
+
+    def tearDown(self):
+        self.client.close()
+        self.remote.close()
+        for thread in self.threads:
+            thread.join(5)
+
+    def forward(self, data):
+        channel = self.client.open_channel('direct-tcpip', ('db', 5432), ('127.0.0.1', 1234))
+        channel.sendall(data)
+        channel.shutdown_write()
+        return channel
+
+    def test_forward(self):
+        """
+        a forwarded connection should be relayed both ways, passing on the client's EOF
+        """
+
+        self.start_proxy()
+        self.assertEqual( self.forward(b'hello').makefile('rb').read(), b'HELLO' )
+        self.assertEqual( self.destinations, [('db', 5432)] )
+
+    def test_forwards_share_connection(self):
+        """
+        concurrent forwards should share one pooled remote connection
+        """
+
+        self.start_proxy(pool=UpstreamPool(), prefetch=False)
+        channels = [self.forward(b'x' * (i + 1)) for i in range(3)]
+        self.assertEqual( [c.makefile('rb').read() for c in channels], [b'X', b'XX', b'XXX'] )
+        self.assertEqual( self.connect_to_remote.call_count, 1 )
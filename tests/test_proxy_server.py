@@ -6,7 +6,7 @@ except ImportError:
 patch = mock.patch
 sentinel = mock.sentinel
 
-from .test_proxy import IOTest, SimpleProxyTestCase, TransportTest
+from .test_proxy import IOTest, SimpleProxyTestCase, TransportTest, PrefetchTest
 
 import os
 import shlex
@@ -15,12 +15,14 @@ import shutil
 import time
 import sys
 
+import paramiko
+
 try:
     import queue
 except ImportError:
     import Queue as queue
 
-from ssh_forward_proxy import run_server, ProxyServer, Proxy
+from ssh_forward_proxy import run_server, ProxyServer, Proxy, ServerInterface
 
 class RemoteConnectionTest(SimpleProxyTestCase):
     """
@@ -38,7 +40,9 @@ class RemoteConnectionTest(SimpleProxyTestCase):
         host_string = '{}@{}:{}'.format(user, host, port).encode('utf-8')
 
         server = ProxyServer(sentinel.socket)
-        server.check_channel_env_request(sentinel.channel, ProxyServer.HOST, host_string)
+        server.connect_kwargs = {}
+        with patch.object(ProxyServer, 'prefetch_remote'):
+            server.check_channel_env_request(sentinel.client, ProxyServer.HOST, host_string)
 
         kwargs = {'username': 'string', 'key': 'value'}
         with patch.object(Proxy, 'relay_to_remote') as relay_to_remote:
@@ -53,6 +57,138 @@ class RemoteConnectionTest(SimpleProxyTestCase):
                 key='value',
             )
 
+    @patch.object(ProxyServer, 'prefetch_remote')
+    def test_prefetch_on_host(self, prefetch_remote):
+        """
+        it should start connecting to the remote as soon as it gets the HOST variable
+        """
+
+        server = ProxyServer(sentinel.socket)
+        server.connect_kwargs = {'username': None, 'key': 'value'}
+        server.check_channel_env_request(sentinel.channel, b'OTHER', b'value')
+        self.assertFalse( prefetch_remote.called )
+        server.check_channel_env_request(sentinel.channel, ProxyServer.HOST, b'user@abcdef:12345')
+        prefetch_remote.assert_called_once_with(sentinel.channel, username='user', host='abcdef', port=12345, key='value')
+
+    def test_env_per_channel(self):
+        """
+        each session channel should relay to the remote in its own HOST variable
+        """
+
+        server = ProxyServer(sentinel.socket)
+        server.connect_kwargs = {}
+        with patch.object(ProxyServer, 'prefetch_remote'):
+            server.check_channel_env_request(sentinel.first, ProxyServer.HOST, b'a@first:1')
+            server.check_channel_env_request(sentinel.second, ProxyServer.HOST, b'b@second:2')
+
+        with patch.object(Proxy, 'relay_to_remote') as relay_to_remote:
+            server.relay_to_remote(sentinel.second, sentinel.command)
+            server.relay_to_remote(sentinel.first, sentinel.command)
+        self.assertEqual( relay_to_remote.call_args_list, [
+            mock.call(sentinel.second, sentinel.command, username='b', host='second', port=2),
+            mock.call(sentinel.first, sentinel.command, username='a', host='first', port=1),
+        ])
+        # forgotten once used
+        self.assertEqual( server.env, {} )
+
+    @patch.object(Proxy, 'relay_to_remote')
+    @patch.object(Proxy, 'finish_relay')
+    def test_no_host(self, finish_relay, relay_to_remote):
+        """
+        a session without the HOST variable should be ended
+        """
+
+        server = ProxyServer(sentinel.socket)
+        server.relay_to_remote(sentinel.client, sentinel.command)
+        finish_relay.assert_called_once_with(sentinel.client, None, None, False)
+        self.assertFalse( relay_to_remote.called )
+
+class ForwardTest(SimpleProxyTestCase):
+    """
+    tests that ProxyServer forwards to the remote named in the login
+    """
+
+    def make_server(self, username):
+        server = ProxyServer(sentinel.socket)
+        server.connect_kwargs = {'username': username, 'key': 'value'}
+        server.username = username
+        server.queue = queue.Queue()
+        return server
+
+    def test_remote_in_username(self):
+        server = self.make_server('user@abcdef:12345')
+        self.assertEqual( server.forward_kwargs(), dict(username='user', host='abcdef', port=12345, key='value') )
+
+        result = server.check_channel_direct_tcpip_request(3, ('127.0.0.1', 1234), ('db', 5432))
+        self.assertEqual( result, paramiko.OPEN_SUCCEEDED )
+        channel, forward = server.queue.get_nowait()
+        self.assertEqual( (forward.chanid, forward.destination), (3, ('db', 5432)) )
+
+    def test_no_remote(self):
+        """
+        a forward should be refused if the login does not name a remote
+        """
+
+        server = self.make_server('user')
+        self.assertIsNone( server.forward_kwargs() )
+        result = server.check_channel_direct_tcpip_request(3, ('127.0.0.1', 1234), ('db', 5432))
+        self.assertEqual( result, paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED )
+        self.assertTrue( server.queue.empty() )
+
+class PrefetchTest(PrefetchTest):
+    """
+    tests that ProxyServer connects to the remote before the exec request
+    """
+
+    def start_server(self, server):
+        server.check_channel_env_request(self.client, ProxyServer.HOST, b'user@host:1234')
+
+    def test_connects_before_command(self):
+        """
+        the remote connection should be started once the HOST variable arrives
+        """
+
+        def start_server(server):
+            self.start_server(server)
+            self.assertIn( self.client, server.pending )
+            server.pending[self.client].done.wait(5)
+            self.queue.put((self.client, sentinel.command))
+
+        with patch('paramiko.Transport.start_server', side_effect=start_server):
+            ProxyServer()
+        Proxy.connect_to_remote.assert_called_with(username='user', host='host', port=1234)
+        self.assertEqual( Proxy.connect_to_remote.call_count, 2 )
+        self.remote_channel.exec_command.assert_called_once_with(sentinel.command)
+
+    def test_cancelled_without_command(self):
+        """
+        the prefetched connection should be closed if the client sends no exec request
+        """
+
+        with patch('paramiko.Transport.start_server', side_effect=self.start_server), \
+                patch.object(ServerInterface, 'get_command', return_value=(None, None)):
+            ProxyServer()
+        self.wait_for_close()
+        Proxy.connect_to_remote.return_value.close.assert_called_once_with()
+
+    def test_cancelled_when_channel_closes(self):
+        """
+        the prefetched connection should be closed once its channel closes without an exec request
+        """
+
+        def start_server(server):
+            self.start_server(server)
+            server.pending[self.client].done.wait(5)
+            self.client.closed = True
+            server.poll()
+            self.assertNotIn( self.client, server.pending )
+            self.assertNotIn( self.client, server.env )
+            self.queue.put((None, None))
+
+        with patch('paramiko.Transport.start_server', side_effect=start_server):
+            ProxyServer()
+        Proxy.connect_to_remote.return_value.close.assert_called_once_with()
+
 class TransportTest(TransportTest):
     """
     tests for the paramiko.Transport
@@ -66,7 +202,7 @@ class TransportTest(TransportTest):
         """
 
         self.patch_get_command()
-        with patch('ssh_forward_proxy.StdSocket') as sock:
+        with patch('ssh_forward_proxy.server.StdSocket') as sock:
             proxy = self.SERVER()
             self.assertIs(proxy.transport.sock, sock())
 
@@ -84,5 +220,5 @@ class IOTest(IOTest):
         self.add_patch( patch.object(Proxy, '__init__', side_effect=self.proxy_init) )
 
     def proxy_init(self, proxy, *args, **kwargs):
-        proxy.env[ProxyServer.HOST] = b'user@host:1234'
+        proxy.env[self.client] = {ProxyServer.HOST: b'user@host:1234'}
         self.old_proxy_init(proxy, *args, **kwargs)
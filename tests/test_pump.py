@@ -0,0 +1,120 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import threading
+import selectors
+import subprocess
+PIPE = subprocess.PIPE
+
+from . import fake_io
+from .test_proxy import IOTest
+
+from ssh_forward_proxy import Pump, Relay, ChannelStream, ProcessStream, Proxy
+
+class PumpTest(unittest.TestCase):
+    """
+    tests for Pump
+    """
+
+    def setUp(self):
+        self.pump = Pump(threads=2)
+        self.clients = []
+        self.processes = []
+
+    def tearDown(self):
+        self.pump.close()
+        for client in self.clients:
+            fake_io.close_fake_io(client)
+        for process in self.processes:
+            process.stdin.close()
+            process.stdout.close()
+            process.stderr.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def start_relay(self, cmd):
+        # the client sends nothing but keeps its side open
+        client = fake_io.FakeInputChannel(cmd=['cat'])
+        process = subprocess.Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
+        self.clients.append(client)
+        self.processes.append(process)
+
+        done = threading.Event()
+        result = []
+        def callback(completed):
+            result.append(completed)
+            done.set()
+
+        self.pump.add(Relay(ChannelStream(client), ProcessStream(process)), callback)
+        return client, done, result
+
+    def test_relays_many_sessions(self):
+        """
+        the pump should relay all of its sessions
+        """
+
+        sessions = [self.start_relay('echo {}; echo {} >&2'.format(i, i * 2)) for i in range(10)]
+        for i, (client, done, result) in enumerate(sessions):
+            self.assertTrue( done.wait(5) )
+            self.assertEqual( result, [True] )
+            self.assertEqual( client.stdout.getvalue(), '{}\n'.format(i).encode('utf-8') )
+            self.assertEqual( client.stderr.getvalue(), '{}\n'.format(i * 2).encode('utf-8') )
+        self.assertEqual( self.pump.stats(), dict(threads=2, relays=0) )
+
+    def test_blocked_client(self):
+        """
+        a client with a full window should not hold up the other sessions on its thread
+        """
+
+        self.pump = Pump(threads=1)
+        window = threading.Event()
+        blocked, blocked_done, blocked_result = self.start_relay('seq 100000')
+        blocked.send_ready.side_effect = window.is_set
+
+        client, done, result = self.start_relay('echo hello')
+        self.assertTrue( done.wait(5) )
+        self.assertEqual( client.stdout.getvalue(), b'hello\n' )
+        self.assertFalse( blocked_done.is_set() )
+
+        window.set()
+        self.assertTrue( blocked_done.wait(5) )
+        self.assertEqual( blocked_result, [True] )
+        self.assertEqual( blocked.stdout.getvalue(), subprocess.check_output(['seq', '100000']) )
+
+    def test_error(self):
+        """
+        the callback should be told when relaying failed
+        """
+
+        with patch.object(Relay, 'handle', side_effect=IOError):
+            client, done, result = self.start_relay('echo hello')
+            self.assertTrue( done.wait(5) )
+        self.assertEqual( result, [False] )
+
+class PumpIOTest(IOTest):
+    """
+    tests that the proxy relays through a pump
+    """
+
+    def make_proxy(self):
+        done = threading.Event()
+        finish_relay = Proxy.finish_relay
+        def finish(*args):
+            finish_relay(*args)
+            done.set()
+
+        # the fake channels are regular files, which epoll refuses
+        pump = Pump(threads=1, selector=selectors.SelectSelector)
+        try:
+            with patch.object(Proxy, 'finish_relay', autospec=True, side_effect=finish):
+                proxy = Proxy(host='host', port=1234, pump=pump)
+                self.assertTrue( done.wait(5) )
+        finally:
+            pump.close()
+        return proxy
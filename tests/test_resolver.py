@@ -0,0 +1,165 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import os
+import socket
+import threading
+import time
+
+from ssh_forward_proxy import Resolver, Mirrors, interleave, connect_fastest, open_connection
+
+def address(family, host, port):
+    return (family, socket.SOCK_STREAM, 0, '', (host, port))
+
+class ResolverTest(unittest.TestCase):
+    """
+    tests for Resolver
+    """
+
+    def setUp(self):
+        self.resolver = Resolver(ttl=60, negative_ttl=60)
+
+    @patch('socket.getaddrinfo', return_value=[sentinel.address])
+    def test_cached(self, getaddrinfo):
+        self.assertEqual( self.resolver.resolve('host', 22), [sentinel.address] )
+        self.assertEqual( self.resolver.resolve('host', 22), [sentinel.address] )
+        self.resolver.resolve('host', 2222)
+        self.assertEqual( getaddrinfo.call_count, 2 )
+        self.assertEqual( self.resolver.stats(), dict(hits=1, misses=2, entries=2) )
+
+    @patch('socket.getaddrinfo', return_value=[sentinel.address])
+    def test_expires(self, getaddrinfo):
+        self.resolver.ttl = 0
+        self.resolver.resolve('host', 22)
+        self.resolver.resolve('host', 22)
+        self.assertEqual( getaddrinfo.call_count, 2 )
+
+    @patch('socket.getaddrinfo', side_effect=socket.gaierror('no such host'))
+    def test_negative(self, getaddrinfo):
+        """
+        failures should be cached too
+        """
+
+        for i in range(2):
+            with self.assertRaises(socket.gaierror):
+                self.resolver.resolve('host', 22)
+        self.assertEqual( getaddrinfo.call_count, 1 )
+
+class ConnectTest(unittest.TestCase):
+    """
+    tests for interleave and connect_fastest
+    """
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+        # nothing listening here
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_interleave(self):
+        addresses = [
+            address(socket.AF_INET6, '::1', 22),
+            address(socket.AF_INET6, '::2', 22),
+            address(socket.AF_INET, '1.1.1.1', 22),
+            address(socket.AF_INET, '2.2.2.2', 22),
+            address(socket.AF_INET6, '::3', 22),
+        ]
+        self.assertEqual( [a[4][0] for a in interleave(addresses)], ['::1', '1.1.1.1', '::2', '2.2.2.2', '::3'] )
+
+    def test_connects(self):
+        sock = connect_fastest([address(socket.AF_INET, '127.0.0.1', self.port)])
+        self.assertEqual( sock.getpeername(), ('127.0.0.1', self.port) )
+        sock.close()
+
+    def test_skips_failed(self):
+        """
+        a refused address should move straight on to the next one
+        """
+
+        start = time.time()
+        sock = connect_fastest([
+            address(socket.AF_INET, '127.0.0.1', self.closed_port),
+            address(socket.AF_INET, '127.0.0.1', self.port),
+        ], delay=5)
+        self.assertLess( time.time() - start, 1 )
+        self.assertEqual( sock.getpeername()[1], self.port )
+        sock.close()
+
+    def test_high_fd(self):
+        """
+        sockets with fds above select()'s limit of 1024 should work too
+        """
+
+        fds = []
+        try:
+            try:
+                # use up the fds below 1024
+                while len(fds) < 1024:
+                    fds.append(os.dup(self.server.fileno()))
+            except OSError:
+                self.skipTest('Not enough file descriptors')
+            sock = connect_fastest([address(socket.AF_INET, '127.0.0.1', self.port)], timeout=5)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.assertGreaterEqual( sock.fileno(), 1024 )
+        sock.close()
+
+    def test_all_failed(self):
+        with self.assertRaises(socket.error):
+            connect_fastest([address(socket.AF_INET, '127.0.0.1', self.closed_port)])
+
+class MirrorsTest(unittest.TestCase):
+    """
+    tests for Mirrors and open_connection
+    """
+
+    def setUp(self):
+        self.mirrors = Mirrors()
+        self.resolver = Resolver()
+
+    def test_order(self):
+        """
+        unmeasured mirrors should be tried first, then the fastest, then those that failed
+        """
+
+        self.mirrors.record('slow', 0.5)
+        self.mirrors.record('fast', 0.1)
+        self.mirrors.failed('down')
+        self.assertEqual( self.mirrors.order(['down', 'slow', 'fast', 'new']), ['new', 'fast', 'slow', 'down'] )
+
+    def test_moving_average(self):
+        self.mirrors.record('host', 1.0)
+        self.mirrors.record('host', 0.0)
+        self.assertAlmostEqual( self.mirrors.stats()['host'], 1.0 - self.mirrors.alpha )
+
+    @patch('ssh_forward_proxy.resolver.connect_fastest')
+    @patch.object(Resolver, 'resolve', side_effect=lambda host, port: [(host, port)])
+    def test_open_connection(self, resolve, connect_fastest):
+        """
+        the next mirror should be used if one cannot be connected to
+        """
+
+        connect_fastest.side_effect = [socket.error('refused'), sentinel.sock]
+        result = open_connection('first,second:2222', 22, resolver=self.resolver, mirrors=self.mirrors)
+        self.assertEqual( result, ('second', 2222, sentinel.sock) )
+        self.assertEqual( self.mirrors.order([('first', 22), ('second', 2222)]), [('second', 2222), ('first', 22)] )
+
+    @patch.object(Resolver, 'resolve', side_effect=socket.gaierror('no such host'))
+    def test_open_connection_fails(self, resolve):
+        with self.assertRaises(socket.gaierror):
+            open_connection('host', 22, resolver=self.resolver, mirrors=self.mirrors)
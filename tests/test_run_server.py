@@ -7,9 +7,14 @@ patch = mock.patch
 sentinel = mock.sentinel
 
 import os
+import stat
+import socket
 import signal
+import shutil
+import tempfile
+import threading
 
-from ssh_forward_proxy import run_server
+from ssh_forward_proxy import run_server, run_daemon, run_session, relay_session, SessionLimiter, ServerInterface
 
 class RunServerTest(unittest.TestCase):
 
@@ -46,9 +51,37 @@ class RunServerTest(unittest.TestCase):
             run_server('host', 1234, key='value', worker=sentinel.worker)
         except self.Error:
             pass
-        Thread.assert_called_once_with(target=sentinel.worker, args=(sentinel.socket,), kwargs={'key': 'value'})
+        Thread.assert_called_once_with(target=run_session, args=(sentinel.worker, sentinel.socket, mock.ANY), kwargs={'key': 'value'})
         thread.start.assert_called_once_with()
 
+    @patch('socket.socket')
+    def test_backlog(self, socket):
+        """
+        the server should listen with the given backlog
+        """
+
+        socket().accept.side_effect = self.Error
+        with self.assertRaises(self.Error):
+            run_server('host', 1234, backlog=5)
+        socket().listen.assert_called_once_with(5)
+
+    @patch('threading.Thread')
+    @patch('socket.socket')
+    def test_rejected(self, socket, Thread):
+        """
+        connections over the limit should be closed without starting a session
+        """
+
+        client = mock.Mock()
+        socket().accept.side_effect = [(client, sentinel.address), self.Error]
+        limiter = SessionLimiter(max_sessions=0)
+
+        with self.assertRaises(self.Error):
+            run_server('host', 1234, limiter=limiter, worker=sentinel.worker)
+        client.close.assert_called_once_with()
+        self.assertFalse( Thread.called )
+        self.assertEqual( limiter.rejected, 1 )
+
     @patch('socket.socket')
     def test_keyboard_interrupt(self, socket):
         """
@@ -74,3 +107,205 @@ class RunServerTest(unittest.TestCase):
         with self.assertRaises(self.Error):
             run_server('host', 1234, key='value', worker=sentinel.worker)
         socket().close.assert_called_once_with()
+
+class RunDaemonTest(unittest.TestCase):
+    """
+    tests for run_daemon
+    """
+
+    class Error(Exception):
+        pass
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'relay.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_daemon(self):
+        # raise an error to stop the daemon going into the accept loop
+        with patch('socket.socket.accept', side_effect=self.Error):
+            with self.assertRaises(self.Error):
+                run_daemon(self.path)
+
+    def test_socket_private(self):
+        """
+        only the user running the daemon should be able to connect to it
+        """
+
+        modes = []
+        serve_forever = lambda *args, **kwargs: modes.append(os.stat(self.path).st_mode)
+        with patch('ssh_forward_proxy.server.serve_forever', side_effect=serve_forever):
+            run_daemon(self.path)
+        self.assertTrue( stat.S_ISSOCK(modes[0]) )
+        self.assertEqual( stat.S_IMODE(modes[0]), 0o600 )
+        # removed once the daemon stops
+        self.assertFalse( os.path.exists(self.path) )
+
+    def test_stale_socket(self):
+        """
+        a socket left behind by a daemon that is not running should be replaced
+        """
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        self.run_daemon()
+
+    def test_sigterm(self):
+        """
+        the socket should be removed when the daemon is killed
+        """
+
+        def serve_forever(*args, **kwargs):
+            os.kill(os.getpid(), signal.SIGTERM)
+        with patch('ssh_forward_proxy.server.serve_forever', side_effect=serve_forever):
+            with self.assertRaises(KeyboardInterrupt):
+                run_daemon(self.path)
+        self.assertFalse( os.path.exists(self.path) )
+
+    def test_already_running(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(1)
+        try:
+            with self.assertRaises(RuntimeError):
+                run_daemon(self.path)
+            self.assertTrue( os.path.exists(self.path) )
+        finally:
+            sock.close()
+
+class RelaySessionTest(unittest.TestCase):
+    """
+    tests for relay_session
+    """
+
+    def setUp(self):
+        self.client, self.sock = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.sock.close()
+
+    @patch('ssh_forward_proxy.server.Proxy')
+    def test_header(self, Proxy):
+        """
+        the proxy should relay to the port, host and user sent by the client
+        without consuming the SSH traffic that follows
+        """
+
+        self.sock.sendall(b'1234 host user\nSSH-2.0-client')
+        self.assertIs( relay_session(self.client, key='value'), Proxy.return_value )
+        Proxy.assert_called_once_with(self.client, username='user', host='host', port=1234, key='value')
+        self.assertEqual( self.client.recv(100), b'SSH-2.0-client' )
+
+    @patch('ssh_forward_proxy.server.Proxy')
+    def test_invalid_header(self, Proxy):
+        self.sock.sendall(b'host user\n')
+        self.assertIsNone( relay_session(self.client) )
+        self.assertFalse( Proxy.called )
+        self.assertEqual( self.sock.recv(100), b'' )
+
+    @patch('ssh_forward_proxy.server.Proxy')
+    def test_header_timeout(self, Proxy):
+        """
+        a client that sends no header should not hold the session forever
+        """
+
+        with patch.object(ServerInterface, 'timeout', 0.1):
+            self.assertIsNone( relay_session(self.client) )
+        self.assertFalse( Proxy.called )
+        self.assertEqual( self.sock.recv(100), b'' )
+
+class RunSessionTest(unittest.TestCase):
+    """
+    tests for run_session
+    """
+
+    def test_runs_worker(self):
+        limiter = SessionLimiter()
+        limiter.admit()
+        worker = mock.Mock(return_value=None)
+        run_session(worker, sentinel.socket, limiter, key='value')
+        worker.assert_called_once_with(sentinel.socket, key='value')
+        self.assertEqual( limiter.stats(), dict(active=0, queued=0, rejected=0, total=1) )
+
+    def test_waits_for_session(self):
+        """
+        the slot should only be freed once the session is done
+        """
+
+        limiter = SessionLimiter()
+        limiter.admit()
+        worker = mock.Mock()
+        run_session(worker, sentinel.socket, limiter)
+        self.assertEqual( limiter.active, 1 )
+
+        callback = worker.return_value.add_done_callback.call_args[0][0]
+        callback()
+        self.assertEqual( limiter.active, 0 )
+
+    def test_worker_error(self):
+        limiter = SessionLimiter()
+        limiter.admit()
+        with self.assertRaises(ValueError):
+            run_session(mock.Mock(side_effect=ValueError), sentinel.socket, limiter)
+        self.assertEqual( limiter.active, 0 )
+
+    def test_queue_timeout(self):
+        """
+        the connection should be closed if no slot frees up in time
+        """
+
+        limiter = SessionLimiter(max_sessions=1, max_queued=1, queue_timeout=0.1)
+        limiter.admit()
+        limiter.start()
+        limiter.admit()
+
+        client = mock.Mock()
+        worker = mock.Mock()
+        run_session(worker, client, limiter)
+        client.close.assert_called_once_with()
+        self.assertFalse( worker.called )
+
+class SessionLimiterTest(unittest.TestCase):
+    """
+    tests for SessionLimiter
+    """
+
+    def test_unlimited(self):
+        limiter = SessionLimiter()
+        for i in range(100):
+            self.assertTrue( limiter.admit() )
+            self.assertTrue( limiter.start() )
+        self.assertEqual( limiter.active, 100 )
+
+    def test_queue(self):
+        """
+        connections should queue once max_sessions are running
+        and be rejected once the queue is full
+        """
+
+        limiter = SessionLimiter(max_sessions=1, max_queued=1)
+        self.assertTrue( limiter.admit() )
+        self.assertTrue( limiter.start() )
+        self.assertTrue( limiter.admit() )
+        self.assertFalse( limiter.admit() )
+        self.assertEqual( limiter.stats(), dict(active=1, queued=1, rejected=1, total=1) )
+
+    def test_queued_session_starts(self):
+        """
+        a queued connection should start when a session finishes
+        """
+
+        limiter = SessionLimiter(max_sessions=1, max_queued=1)
+        limiter.admit()
+        limiter.start()
+        limiter.admit()
+
+        timer = threading.Timer(0.1, limiter.finish)
+        timer.start()
+        self.assertTrue( limiter.start() )
+        timer.join()
+        self.assertEqual( limiter.stats(), dict(active=1, queued=0, rejected=0, total=2) )
@@ -14,6 +14,8 @@ import subprocess
 import shutil
 import time
 import sys
+import socket
+import threading
 
 try:
     import queue
@@ -21,7 +23,7 @@ except ImportError:
     import Queue as queue
 
 import paramiko
-from ssh_forward_proxy import run_server, Server, ServerInterface
+from ssh_forward_proxy import run_server, Server, ServerInterface, Pump
 
 ROOT_DIR = os.path.abspath(os.path.join(__file__, '..', '..'))
 
@@ -198,3 +200,81 @@ class ServerProcessTest(PatchedServer):
         self.queue.put((self.client, 'true'))
         server = Server(sentinel.socket)
         self.assertIsNone( self.client.inputs[0].poll() )
+
+class MultiSessionTest(unittest.TestCase):
+    """
+    tests that one client connection can run many sessions
+    """
+
+    pump = None
+
+    def setUp(self):
+        server_sock, client_sock = socket.socketpair()
+        self.servers = []
+        self.thread = threading.Thread(target=lambda: self.servers.append(Server(server_sock, pump=self.pump)))
+        self.thread.start()
+
+        self.transport = paramiko.Transport(client_sock)
+        self.transport.start_client()
+        self.transport.auth_none('user')
+
+    def tearDown(self):
+        self.transport.close()
+        self.thread.join(5)
+
+    def start(self, command):
+        channel = self.transport.open_session()
+        channel.exec_command(command)
+        return channel
+
+    def result(self, channel):
+        return channel.makefile('rb').read(), channel.recv_exit_status()
+
+    def test_concurrent_sessions(self):
+        """
+        sessions should run at the same time and each get their own exit status
+        """
+
+        slow = self.start('sleep 0.5; echo slow; exit 2')
+        fast = self.start('echo fast; exit 1')
+        self.assertEqual( self.result(fast), (b'fast\n', 1) )
+        self.assertFalse( slow.exit_status_ready() )
+        self.assertEqual( self.result(slow), (b'slow\n', 2) )
+
+    def test_sequential_sessions(self):
+        for i in range(3):
+            self.assertEqual( self.result(self.start('echo {}'.format(i))), ('{}\n'.format(i).encode('utf-8'), 0) )
+
+    def test_stdin_eof(self):
+        """
+        EOF from the client should reach the command, whose output is still relayed
+        """
+
+        channel = self.start('cat; echo done')
+        channel.sendall(b'input\n')
+        channel.shutdown_write()
+        self.assertEqual( self.result(channel), (b'input\ndone\n', 0) )
+
+    def test_closed_with_client(self):
+        """
+        the server should finish once the client disconnects
+        """
+
+        self.result(self.start('true'))
+        self.transport.close()
+        self.thread.join(5)
+        self.assertFalse( self.thread.is_alive() )
+        self.assertFalse( self.servers[0].transport.is_active() )
+
+class PumpMultiSessionTest(MultiSessionTest):
+    """
+    tests that one client connection can run many sessions relayed by a pump
+    """
+
+    def setUp(self):
+        self.pump = Pump(threads=1)
+        super(PumpMultiSessionTest, self).setUp()
+
+    def tearDown(self):
+        super(PumpMultiSessionTest, self).tearDown()
+        self.pump.close()
@@ -0,0 +1,57 @@
+import unittest
+
+import os
+import sys
+import subprocess
+
+from . import helper
+
+import ssh_forward_proxy
+
+class ImportTest(helper.TestCase):
+    """
+    keeps `import ssh_forward_proxy` cheap for relays, which pay for it on every git operation
+    """
+
+    # seconds; about 30ms when measured, leaving plenty of room for slow machines
+    IMPORT_BUDGET = 0.15
+    # slow modules which should only be imported once they are needed
+    SLOW_MODULES = ['paramiko', 'pkg_resources']
+
+    def import_package(self):
+        env = dict(os.environ, PYTHONPATH=self.ROOT_DIR)
+        code = 'import sys, ssh_forward_proxy; print(" ".join(sys.modules))'
+        process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual( process.returncode, 0, stderr )
+
+        times = {}
+        for line in stderr.decode('utf-8').splitlines():
+            if line.startswith('import time:') and 'cumulative' not in line:
+                self_us, cumulative_us, name = line[len('import time:'):].split('|')
+                times[name.strip()] = int(cumulative_us) / 1e6
+        return stdout.decode('utf-8').split(), times
+
+    def test_slow_modules_not_imported(self):
+        modules, times = self.import_package()
+        for module in self.SLOW_MODULES:
+            self.assertNotIn( module, modules )
+
+    def test_import_budget(self):
+        # best of a few runs so one slow run on a busy machine does not fail it
+        best = min(self.import_package()[1]['ssh_forward_proxy'] for i in range(3))
+        self.assertLess( best, self.IMPORT_BUDGET )
+
+    def test_lazy_names(self):
+        """
+        every lazily imported name should exist in the module it is mapped to
+        """
+
+        for name in ssh_forward_proxy._LAZY_NAMES:
+            self.assertIn( name, ssh_forward_proxy.__all__ )
+            self.assertTrue( hasattr(ssh_forward_proxy, name), name )
+
+    def test_unknown_name(self):
+        with self.assertRaises(AttributeError):
+            ssh_forward_proxy.no_such_name
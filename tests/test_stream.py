@@ -13,7 +13,7 @@ import paramiko
 import subprocess
 PIPE = subprocess.PIPE
 
-from ssh_forward_proxy import StdSocket, ChannelStream, ProcessStream
+from ssh_forward_proxy import StdSocket, Stream, ChannelStream, ProcessStream, ChunkSize, Relay, TunnelRelay, RelayLatency
 
 DATA = b'abcdefgh'
 
@@ -136,6 +136,25 @@ class ProcessStreamTest(unittest.TestCase):
         self.process.stdin.close()
         self.assertEqual( self.process.stdout.read(), b'hemmo' )
 
+    def test_send_full(self):
+        """
+        send should write what fits in the pipe instead of blocking
+        """
+
+        stream = self.make_stream('sleep 5')
+        sent = stream.send(0, b'x' * (1024 * 1024))
+        self.assertTrue( 0 < sent < 1024 * 1024 )
+        self.assertEqual( stream.send(0, DATA), 0 )
+
+    def test_send_exited(self):
+        """
+        data for a process that has exited should be dropped
+        """
+
+        stream = self.make_stream('true')
+        self.process.wait()
+        self.assertEqual( stream.send(0, DATA), len(DATA) )
+
     def test_read_stdout(self):
         """
         reads from stdout
@@ -223,6 +242,8 @@ class ChannelStreamTest(unittest.TestCase):
 
     def make_channel(self):
         self.channel = mock.Mock(spec=paramiko.Channel)
+        # an instance attribute, so not in the spec
+        self.channel.closed = False
         return self.channel
 
     def test_api(self):
@@ -244,7 +265,349 @@ class ChannelStreamTest(unittest.TestCase):
         self.assertEqual( stream.write(stream.STDOUT, DATA), self.channel.sendall(DATA) )
         self.assertEqual( stream.write(stream.STDERR, DATA), self.channel.sendall_stderr(DATA) )
 
+    def test_send(self):
+        stream = ChannelStream(self.make_channel())
+        self.channel.send_ready.return_value = True
+        self.assertEqual( stream.send(stream.STDOUT, DATA), self.channel.send(DATA) )
+        self.assertEqual( stream.send(stream.STDERR, DATA), self.channel.send_stderr(DATA) )
+
+    def test_send_window_full(self):
+        """
+        nothing should be sent while the remote's window is full
+        """
+
+        stream = ChannelStream(self.make_channel())
+        self.channel.send_ready.return_value = False
+        self.assertEqual( stream.send(stream.STDOUT, DATA), 0 )
+        self.assertFalse( self.channel.send.called )
+
     def test_ready(self):
         stream = ChannelStream(self.make_channel())
         self.assertEqual( stream.ready(stream.STDOUT, sentinel.stream), self.channel.recv_ready() )
         self.assertEqual( stream.ready(stream.STDERR, sentinel.stream), self.channel.recv_stderr_ready() )
+
+class ChunkSizeTest(unittest.TestCase):
+    """
+    tests for ChunkSize
+    """
+
+    def test_grows_when_full(self):
+        chunk = ChunkSize(1024, 8192)
+        for size in (2048, 4096, 8192, 8192):
+            chunk.update(chunk.size)
+            self.assertEqual( chunk.size, size )
+
+    def test_shrinks_for_small_reads(self):
+        chunk = ChunkSize(1024, 8192)
+        chunk.size = 8192
+        chunk.update(1500)
+        self.assertEqual( chunk.size, 2048 )
+        chunk.update(10)
+        self.assertEqual( chunk.size, 1024 )
+
+    def test_keeps_size_for_partial_reads(self):
+        chunk = ChunkSize(1024, 8192)
+        chunk.size = 4096
+        chunk.update(3000)
+        self.assertEqual( chunk.size, 4096 )
+
+class DrainTest(unittest.TestCase):
+    """
+    tests for Stream.drain
+    """
+
+    def make_stream(self, reads):
+        channel = mock.Mock(spec=paramiko.Channel)
+        channel.recv.side_effect = reads
+        channel.recv_ready.side_effect = [True] * len(reads) + [False]
+        return ChannelStream(channel)
+
+    def test_drains_channel(self):
+        """
+        a channel should be read until nothing is ready
+        """
+
+        stream = self.make_stream([b'a' * 1024, b'b' * 2048, b'c'])
+        other = mock.Mock()
+        chunk = ChunkSize(1024, 8192)
+
+        self.assertEqual( stream.drain(stream.STDOUT, sentinel.stream, other, chunk), 3073 )
+        self.assertEqual( [c[0][0] for c in stream.channel.recv.call_args_list], [1024, 2048, 4096] )
+        self.assertEqual( other.write.call_count, 3 )
+
+    def test_drain_limit(self):
+        """
+        a channel should not be read more than max_drain_reads times
+        """
+
+        stream = self.make_stream([DATA] * 100)
+        stream.drain(stream.STDOUT, sentinel.stream, mock.Mock(), ChunkSize())
+        self.assertEqual( stream.channel.recv.call_count, stream.max_drain_reads )
+
+    def test_byte_limit(self):
+        """
+        no more than limit bytes should be read
+        """
+
+        stream = self.make_stream([b'a' * 1024, b'b' * 1024, b'c'])
+        self.assertEqual( stream.drain(stream.STDOUT, sentinel.stream, mock.Mock(), ChunkSize(1024, 8192), 1500), 2048 )
+        self.assertEqual( [c[0][0] for c in stream.channel.recv.call_args_list], [1024, 476] )
+
+    def test_nothing_ready(self):
+        stream = self.make_stream([])
+        self.assertFalse( stream.drain(stream.STDOUT, sentinel.stream, mock.Mock(), ChunkSize()) )
+
+    def test_process_read_once(self):
+        """
+        a process pipe should only be read once since another read may block
+        """
+
+        process = mock.Mock()
+        stream = ProcessStream(process)
+        with patch('os.read', return_value=DATA) as read:
+            stream.drain(stream.STDOUT, process.stdout, mock.Mock(), ChunkSize())
+            self.assertEqual( read.call_count, 1 )
+
+class RelayTest(unittest.TestCase):
+    """
+    tests for EOF handling in Relay and TunnelRelay
+    """
+
+    def make_stream(self, name):
+        stream = mock.Mock(streams=[getattr(sentinel, name)], write_stream=None)
+        stream.is_closed.return_value = False
+        stream.keys.return_value = [Stream.STDOUT]
+        return stream
+
+    def setUp(self):
+        self.input = self.make_stream('input')
+        self.output = self.make_stream('output')
+
+    def eof(self, relay, stream):
+        stream.drain.return_value = b''
+        return relay.handle(stream.streams[0])
+
+    def test_input_eof(self):
+        """
+        EOF from the client should be passed on while the output is still relayed
+        """
+
+        relay = Relay(self.input, self.output)
+        self.assertFalse( self.eof(relay, self.input) )
+        self.output.shutdown_write.assert_called_once_with()
+        self.assertEqual( relay.streams, [sentinel.output] )
+
+        # not read again
+        self.assertFalse( relay.handle(sentinel.input) )
+        self.assertEqual( self.input.drain.call_count, 1 )
+
+        self.assertTrue( self.eof(relay, self.output) )
+
+    def test_input_closed(self):
+        """
+        the relay should end if the client closes its channel
+        """
+
+        self.input.is_closed.return_value = True
+        relay = Relay(self.input, self.output)
+        self.assertTrue( self.eof(relay, self.input) )
+        self.assertFalse( self.output.shutdown_write.called )
+
+    def test_output_eof(self):
+        """
+        the relay should end once the output ends
+        """
+
+        relay = Relay(self.input, self.output)
+        self.assertTrue( self.eof(relay, self.output) )
+        self.assertFalse( self.input.shutdown_write.called )
+
+    def test_tunnel_half_close(self):
+        """
+        a tunnel should shut down each direction on its own
+        """
+
+        relay = TunnelRelay(self.input, self.output)
+        self.assertFalse( self.eof(relay, self.output) )
+        self.input.shutdown_write.assert_called_once_with()
+        self.assertEqual( relay.streams, [sentinel.input] )
+
+        self.assertTrue( self.eof(relay, self.input) )
+        self.output.shutdown_write.assert_called_once_with()
+
+    def test_tunnel_closed(self):
+        relay = TunnelRelay(self.input, self.output)
+        self.output.is_closed.return_value = True
+        self.assertTrue( self.eof(relay, self.output) )
+
+    def test_tunnel_chunk_size(self):
+        """
+        a tunnel should start with the largest reads
+        """
+
+        relay = TunnelRelay(self.input, self.output, 1024, 8192)
+        self.assertEqual( relay.stdin_chunk.size, 8192 )
+
+class FakeStream:
+    """
+    a stream whose reads and writes are controlled by the test
+    """
+
+    STDOUT = Stream.STDOUT
+    write_stream = None
+
+    def __init__(self, name):
+        self.streams = [name]
+        self.written = b''
+        self.accept = True
+        self.shutdown_write = mock.Mock()
+
+    def keys(self, stream):
+        return [self.STDOUT]
+
+    def is_closed(self):
+        return False
+
+    def drain(self, key, stream, other, chunk, limit=None):
+        data = b'x' * min(limit, 64 * 1024)
+        other.write(key, data)
+        return len(data)
+
+    def send(self, key, buf):
+        if not self.accept:
+            return 0
+        self.written += buf
+        return len(buf)
+
+class BufferingTest(unittest.TestCase):
+    """
+    tests for the per-direction buffers in Relay
+    """
+
+    def setUp(self):
+        self.input = FakeStream('input')
+        self.output = FakeStream('output')
+        self.relay = Relay(self.input, self.output)
+        self.relay.high_water = 256 * 1024
+        self.relay.low_water = 64 * 1024
+        self.relay.max_buffered = 1024 * 1024
+
+    def fill(self, stream):
+        while stream in self.relay.streams:
+            self.relay.handle(stream)
+
+    def test_pause_at_high_water(self):
+        """
+        a direction should stop being read once high_water bytes are waiting
+        """
+
+        self.input.accept = False
+        self.fill('output')
+        self.assertEqual( len(self.relay.stdout.data), 256 * 1024 )
+        self.assertEqual( self.relay.streams, ['input'] )
+        self.assertTrue( self.relay.polling )
+
+    def test_resume_at_low_water(self):
+        self.input.accept = False
+        self.fill('output')
+        self.input.accept = True
+        self.relay.flush()
+        self.assertEqual( self.relay.streams, ['input', 'output'] )
+        self.assertEqual( len(self.input.written), 256 * 1024 )
+
+    def test_directions_independent(self):
+        """
+        a client not reading stdout should not hold up stdin
+        """
+
+        self.input.accept = False
+        self.fill('output')
+        for i in range(10):
+            self.relay.handle('input')
+        self.assertEqual( len(self.output.written), 10 * 64 * 1024 )
+
+    def test_max_buffered(self):
+        """
+        a session should not buffer more than max_buffered bytes
+        """
+
+        self.relay.max_buffered = 300 * 1024
+        self.input.accept = self.output.accept = False
+        self.fill('output')
+        self.fill('input')
+        self.assertEqual( self.relay.buffered(), 300 * 1024 )
+        self.assertEqual( self.relay.streams, [] )
+
+    def test_stall_time(self):
+        self.input.accept = False
+        # the first call times the first byte
+        with patch('ssh_forward_proxy.stream.monotonic', side_effect=[0, 10, 12.5]):
+            self.relay.handle('output')
+            self.input.accept = True
+            self.relay.flush()
+        self.assertEqual( self.relay.stats()['stdout_stall'], 2.5 )
+        self.assertEqual( self.relay.stats()['stdin_stall'], 0 )
+
+    def test_latency(self):
+        """
+        sampled reads should be timed until their last byte is written to the other side
+        """
+
+        self.relay.latency = RelayLatency(1)
+        self.input.accept = False
+        # ready, first byte and stalled, then unstalled and sent
+        with patch('ssh_forward_proxy.stream.monotonic', side_effect=[10, 10, 10, 10.25, 10.25]):
+            self.relay.handle('output')
+            self.input.accept = True
+            self.relay.flush()
+        self.assertEqual( self.relay.latency.downstream.count, 1 )
+        self.assertEqual( self.relay.latency.downstream.max, 0.25 )
+        self.assertEqual( self.relay.latency.upstream.count, 0 )
+        self.assertIsNone( self.relay.stdout.sample )
+
+    def test_latency_off(self):
+        """
+        reads should not be timed unless sampling is enabled
+        """
+
+        self.relay.handle('input')
+        self.assertIsNone( self.relay.stdin.sample )
+        self.assertEqual( self.relay.latency.upstream.count, 0 )
+
+    def test_remote_closed(self):
+        """
+        stdin still buffered for a remote that has closed should be dropped rather than raise
+        """
+
+        channel = mock.Mock(closed=False)
+        channel.send_ready.return_value = False
+        channel.send.side_effect = socket.error('Socket is closed')
+        relay = Relay(self.input, ChannelStream(channel))
+        relay.handle('input')
+        self.assertEqual( len(relay.stdin.data), 64 * 1024 )
+
+        channel.closed = True
+        channel.send_ready.return_value = True
+        self.assertFalse( relay.flush() )
+        self.assertEqual( len(relay.stdin.data), 0 )
+
+        # its output ends, and the rest of stdin goes nowhere
+        channel.recv.return_value = channel.recv_stderr.return_value = b''
+        self.assertTrue( relay.handle(channel) )
+        self.assertTrue( relay.stdin.is_done() )
+        self.assertFalse( channel.shutdown_write.called )
+
+    def test_eof_after_flush(self):
+        """
+        EOF should only be passed on once the buffered data has been sent
+        """
+
+        self.output.accept = False
+        self.relay.handle('input')
+        self.relay.stream_eof('input')
+        self.relay.flush()
+        self.assertFalse( self.output.shutdown_write.called )
+
+        self.output.accept = True
+        self.relay.flush()
+        self.output.shutdown_write.assert_called_once_with()
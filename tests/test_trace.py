@@ -0,0 +1,161 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+from ssh_forward_proxy import ConnectionTrace, SessionTrace, Tracer, set_pending_phases, monotonic
+from ssh_forward_proxy.server import ServerInterface, Proxy
+
+class FakeRelay:
+    def __init__(self):
+        self.stdin = mock.Mock(total=10, first_at=101.0)
+        self.stdout = mock.Mock(total=20, first_at=102.0)
+        self.stderr = mock.Mock(total=0, first_at=None)
+        self.input_eof_at = 103.0
+        self.output_eof_at = None
+
+def make_trace():
+    with patch('ssh_forward_proxy.trace.monotonic', return_value=100.0):
+        connection = ConnectionTrace()
+    connection.phases.append(('handshake', 100.5))
+    trace = SessionTrace(connection)
+    trace.mark('exec', 100.75)
+    return trace
+
+class SessionTraceTest(unittest.TestCase):
+    def test_record(self):
+        """phases are recorded in seconds since the client connected"""
+
+        trace = make_trace()
+        trace.mark('exec', 200)
+        record = trace.record()
+        self.assertEqual( record['phases'], dict(accept=0, handshake=0.5, exec=0.75) )
+        self.assertEqual( record['connection'], trace.connection.id )
+        self.assertEqual( record['session'], trace.id )
+
+    def test_pending_phases(self):
+        """phases recorded before the connection trace is made are used by the next one in the thread"""
+
+        set_pending_phases([('accept', 1.0), ('admitted', 2.0)])
+        self.assertEqual( ConnectionTrace().phases, [('accept', 1.0), ('admitted', 2.0)] )
+        self.assertEqual( ConnectionTrace().phases[0][0], 'accept' )
+        self.assertNotEqual( ConnectionTrace().phases[0][1], 1.0 )
+
+    def test_pending_phases_thread(self):
+        """pending phases are not used by other threads"""
+
+        set_pending_phases([('accept', 1.0)])
+        traces = []
+        thread = threading.Thread(target=lambda: traces.append(ConnectionTrace()))
+        thread.start()
+        thread.join()
+        self.assertNotEqual( traces[0].phases[0][1], 1.0 )
+        set_pending_phases(None)
+
+    def test_upstream(self):
+        """the remote connection's phases are added if it was made for this session"""
+
+        trace = make_trace()
+        client = mock.Mock(trace_phases=[('upstream_start', 100.8), ('upstream_auth', 101.0)])
+        trace.add_upstream(client)
+        self.assertEqual( trace.phases['upstream_auth'], 101.0 )
+        self.assertNotIn( 'upstream_reused', trace.attributes )
+
+    def test_upstream_reused(self):
+        """only the first session on a remote connection gets its phases, the others reused it"""
+
+        client = mock.Mock(trace_phases=[('upstream_start', 50.0), ('upstream_auth', 51.0)])
+        first = make_trace()
+        first.add_upstream(client)
+        trace = make_trace()
+        trace.add_upstream(client)
+        self.assertNotIn( 'upstream_reused', first.attributes )
+        self.assertNotIn( 'upstream_start', trace.phases )
+        self.assertTrue( trace.attributes['upstream_reused'] )
+
+    def test_relay(self):
+        """the first byte each way, EOF and byte counts come from the relay"""
+
+        trace = make_trace()
+        trace.add_relay(FakeRelay())
+        self.assertEqual( trace.phases['first_stdin'], 101.0 )
+        self.assertEqual( trace.phases['first_stdout'], 102.0 )
+        self.assertEqual( trace.phases['input_eof'], 103.0 )
+        self.assertNotIn( 'first_stderr', trace.phases )
+        self.assertNotIn( 'output_eof', trace.phases )
+        self.assertIn( 'relay_done', trace.phases )
+        self.assertEqual( trace.attributes['stdout_bytes'], 20 )
+
+    def test_spans(self):
+        """the session span has an event per phase and a child span for each part it got to"""
+
+        trace = make_trace()
+        trace.attributes['host'] = 'example.com:22'
+        root, handshake = trace.spans()
+        self.assertEqual( root['traceId'], trace.connection.id )
+        self.assertEqual( [event['name'] for event in root['events']], ['accept', 'handshake', 'exec'] )
+        self.assertEqual( root['attributes'], [dict(key='host', value=dict(stringValue='example.com:22'))] )
+        self.assertEqual( handshake['name'], 'client_handshake' )
+        self.assertEqual( handshake['parentSpanId'], trace.id )
+        self.assertEqual( int(handshake['endTimeUnixNano']) - int(handshake['startTimeUnixNano']), 500000000 )
+
+class RelayPrefetchTest(unittest.TestCase):
+    def connect(self, **kwargs):
+        client = mock.Mock()
+        client.trace_phases = [('upstream_start', monotonic()), ('upstream_auth', monotonic())]
+        return client
+
+    @patch.object(Proxy, 'cancel_pending')
+    @patch.object(Proxy, 'serve')
+    @patch.object(ServerInterface, '__init__', return_value=None)
+    def test_prefetch(self, init, serve, cancel_pending):
+        """in relay mode the remote connection started before the handshake is the first session's own"""
+
+        with patch.object(Proxy, 'connect_upstream', side_effect=self.connect):
+            proxy = Proxy(host='example.com', username='git')
+            client = proxy.pending[None].result(5)
+
+        trace = SessionTrace(proxy.trace)
+        trace.add_upstream(client)
+        self.assertNotIn( 'upstream_reused', trace.attributes )
+        phases = trace.record()['phases']
+        self.assertEqual( phases['accept'], 0 )
+        self.assertGreaterEqual( phases['upstream_start'], 0 )
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traces.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        """each trace is appended to the file as a line of OTLP JSON"""
+
+        tracer = Tracer()
+        tracer.export_to(self.path)
+        tracer.emit(make_trace())
+        tracer.emit(make_trace())
+        with open(self.path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual( len(lines), 2 )
+        resource_spans = lines[0]['resourceSpans'][0]
+        self.assertEqual( resource_spans['resource']['attributes'][0]['value']['stringValue'], 'ssh-forward-proxy' )
+        self.assertEqual( resource_spans['scopeSpans'][0]['spans'][0]['name'], 'session' )
+
+    def test_no_export(self):
+        """traces are only logged without export_to()"""
+
+        with patch('logging.info') as info:
+            Tracer().emit(make_trace())
+        self.assertEqual( info.call_count, 1 )
+        self.assertFalse( os.path.exists(self.path) )
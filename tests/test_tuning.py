@@ -0,0 +1,132 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import paramiko
+
+from ssh_forward_proxy import Tuning, UpstreamTuning, Mirrors, parse_size
+
+class ParseSizeTest(unittest.TestCase):
+
+    def test_sizes(self):
+        self.assertEqual( parse_size('100'), 100 )
+        self.assertEqual( parse_size('32K'), 32 * 1024 )
+        self.assertEqual( parse_size('16m'), 16 * 1024 * 1024 )
+        self.assertEqual( parse_size('4G'), 4 * 1024 ** 3 )
+
+    def test_invalid(self):
+        for text in ('', 'M', '1.5M', '10T'):
+            self.assertRaises(ValueError, parse_size, text)
+
+class TuningTest(unittest.TestCase):
+    """
+    tests for Tuning
+    """
+
+    def test_parse(self):
+        tuning = Tuning.parse('window_size=16M,max-packet-size=32K,rekey_bytes=4G')
+        self.assertEqual( tuning.window_size, 16 * 1024 * 1024 )
+        self.assertEqual( tuning.max_packet_size, 32 * 1024 )
+        self.assertEqual( tuning.rekey_bytes, 4 * 1024 ** 3 )
+        self.assertIsNone( tuning.rekey_packets )
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Tuning.parse, 'window=16M')
+        self.assertRaises(ValueError, Tuning, window_size=1024)
+        self.assertRaises(ValueError, Tuning, max_packet_size=1024 * 1024)
+
+    def test_apply(self):
+        """
+        the limits should be used by the transport's channels and packetizer
+        """
+
+        transport = paramiko.Transport(mock.Mock())
+        Tuning(window_size=16 * 1024 * 1024, rekey_bytes=2 ** 32, rekey_packets=2 ** 31).apply(transport)
+
+        self.assertEqual( transport._sanitize_window_size(None), 16 * 1024 * 1024 )
+        self.assertEqual( transport.default_max_packet_size, paramiko.common.DEFAULT_MAX_PACKET_SIZE )
+        self.assertEqual( transport.packetizer.REKEY_BYTES, 2 ** 32 )
+        self.assertEqual( transport.packetizer.REKEY_PACKETS, 2 ** 31 )
+        # other transports keep the defaults
+        self.assertEqual( paramiko.Transport(mock.Mock()).packetizer.REKEY_BYTES, 2 ** 29 )
+
+    def test_defaults(self):
+        transport = paramiko.Transport(mock.Mock())
+        Tuning().apply(transport)
+        self.assertEqual( transport.default_window_size, paramiko.common.DEFAULT_WINDOW_SIZE )
+        self.assertEqual( transport.packetizer.REKEY_BYTES, 2 ** 29 )
+
+class UpstreamTuningTest(unittest.TestCase):
+    """
+    tests for UpstreamTuning
+    """
+
+    def setUp(self):
+        self.default = Tuning(window_size=4 * 1024 * 1024)
+        self.tuning = UpstreamTuning(self.default, {
+            'slow': Tuning(window_size=8 * 1024 * 1024),
+            'slow:2222': Tuning(window_size=16 * 1024 * 1024),
+        }, auto=True)
+
+        self.mirrors = Mirrors()
+        self.mirrors.record(('far', 22), 0.08)
+        patcher = patch('ssh_forward_proxy.tuning.get_mirrors', return_value=self.mirrors)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_transport(self, host, port):
+        return self.tuning.transport_factory(host, port)(mock.Mock())
+
+    def test_per_host(self):
+        self.assertIs( self.tuning.get('other', 22), self.default )
+        self.assertEqual( self.tuning.get('slow', 22).window_size, 8 * 1024 * 1024 )
+        self.assertEqual( self.tuning.get('slow', 2222).window_size, 16 * 1024 * 1024 )
+
+    def test_transport_factory(self):
+        transport = self.make_transport('slow', 22)
+        self.assertIsInstance( transport, paramiko.Transport )
+        self.assertEqual( transport.default_window_size, 8 * 1024 * 1024 )
+
+    def test_auto_tune(self):
+        """
+        the window should grow to twice the bandwidth-delay product
+        """
+
+        transport = self.make_transport('far', 22)
+        # 50MB/s over 80ms
+        self.tuning.record(transport, 100 * 1000 * 1000, 2)
+        self.assertEqual( transport.default_window_size, 8000000 )
+        self.assertEqual( self.tuning.get('far', 22).window_size, 8000000 )
+        self.assertEqual( self.make_transport('far', 22).default_window_size, 8000000 )
+        self.assertEqual( self.tuning.stats(), {'far:22': 8000000} )
+
+    def test_auto_tune_only_grows(self):
+        transport = self.make_transport('far', 22)
+        self.tuning.record(transport, 100 * 1000 * 1000, 2)
+        self.tuning.record(transport, 10 * 1000 * 1000, 2)
+        self.assertEqual( transport.default_window_size, 8000000 )
+
+    def test_auto_tune_max(self):
+        transport = self.make_transport('far', 22)
+        self.tuning.record(transport, 10 ** 10, 1)
+        self.assertEqual( transport.default_window_size, self.tuning.max_window_size )
+
+    def test_small_transfers_ignored(self):
+        transport = self.make_transport('far', 22)
+        self.tuning.record(transport, 1000, 0.001)
+        self.assertEqual( transport.default_window_size, 4 * 1024 * 1024 )
+
+    def test_no_auto_tune(self):
+        self.tuning.auto = False
+        transport = self.make_transport('far', 22)
+        self.tuning.record(transport, 100 * 1000 * 1000, 2)
+        self.assertEqual( transport.default_window_size, 4 * 1024 * 1024 )
+
+    def test_rtt_unknown(self):
+        transport = self.make_transport('near', 22)
+        self.tuning.record(transport, 100 * 1000 * 1000, 2)
+        self.assertEqual( transport.default_window_size, 4 * 1024 * 1024 )
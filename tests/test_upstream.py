@@ -0,0 +1,238 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+sentinel = mock.sentinel
+
+import time
+import threading
+
+import paramiko
+
+from ssh_forward_proxy import UpstreamPool, PendingConnection
+
+class PoolTest(unittest.TestCase):
+    """
+    tests for UpstreamPool
+    """
+
+    def setUp(self):
+        self.pool = UpstreamPool()
+        self.connect = mock.Mock(side_effect=lambda **kwargs: mock.MagicMock())
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_connection_reused(self):
+        """
+        a released connection should be reused for the same remote
+        """
+
+        conn = self.pool.acquire(self.connect, host='host', port=22, username='user')
+        conn.close()
+        self.assertIs( self.pool.acquire(self.connect, host='host', port=22, username='user'), conn )
+        self.connect.assert_called_once_with(host='host', port=22, username='user')
+        self.assertEqual( (self.pool.hits, self.pool.misses), (1, 1) )
+
+    def test_different_remotes(self):
+        """
+        each remote should get its own connection
+        """
+
+        a = self.pool.acquire(self.connect, host='a', port=22, username='user')
+        b = self.pool.acquire(self.connect, host='b', port=22, username='user')
+        c = self.pool.acquire(self.connect, host='a', port=22, username='user', key_filename='key')
+        self.assertEqual( len(set([a, b, c])), 3 )
+
+    def test_max_sessions(self):
+        """
+        a new connection should be made when existing ones are full
+        """
+
+        self.pool.max_sessions = 2
+        conns = [self.pool.acquire(self.connect, host='host', port=22) for i in range(3)]
+        self.assertIs( conns[0], conns[1] )
+        self.assertIsNot( conns[0], conns[2] )
+        self.assertEqual( self.connect.call_count, 2 )
+
+    def test_dead_connection_discarded(self):
+        """
+        connections whose transport is no longer active should not be reused
+        """
+
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        conn.client.get_transport().is_active.return_value = False
+        conn.close()
+        conn.client.close.assert_called_once_with()
+        self.assertIsNot( self.pool.acquire(self.connect, host='host', port=22), conn )
+
+    def test_idle_eviction(self):
+        """
+        idle connections should be closed after the idle timeout
+        """
+
+        self.pool.idle_timeout = -1
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        conn.close()
+        conn.client.close.assert_called_once_with()
+        self.assertEqual( self.pool.stats()['connections'], 0 )
+        self.assertEqual( self.pool.evictions, 1 )
+
+    def test_idle_eviction_timer(self):
+        """
+        idle connections should be closed after the idle timeout even without more sessions
+        """
+
+        self.pool.idle_timeout = 0.05
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        conn.close()
+        self.assertFalse( conn.client.close.called )
+        for i in range(50):
+            if conn.client.close.called:
+                break
+            time.sleep(0.02)
+        conn.client.close.assert_called_once_with()
+        self.assertEqual( self.pool.stats()['connections'], 0 )
+        self.assertEqual( self.pool.evictions, 1 )
+
+    def test_open_session_retries(self):
+        """
+        a failed pooled connection should be replaced with a fresh one
+        """
+
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        conn.close()
+        conn.client.get_transport().open_session.side_effect = EOFError
+
+        new_conn, channel = self.pool.open_session(self.connect, host='host', port=22)
+        self.assertIsNot( new_conn, conn )
+        self.assertIs( channel, new_conn.client.get_transport().open_session() )
+        conn.client.close.assert_called_once_with()
+
+    def test_open_forward(self):
+        """
+        a forward should open a direct-tcpip channel on the pooled connection
+        """
+
+        forward = (('db', 5432), ('127.0.0.1', 1234))
+        conn, channel = self.pool.open_session(self.connect, forward, host='host', port=22)
+        transport = conn.client.get_transport()
+        transport.open_channel.assert_called_once_with('direct-tcpip', ('db', 5432), ('127.0.0.1', 1234))
+        self.assertIs( channel, transport.open_channel() )
+        self.assertFalse( transport.open_session.called )
+
+    def test_forward_refused(self):
+        """
+        an unreachable forward destination should not limit or replace the connection
+        """
+
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        conn.client.get_transport().open_channel.side_effect = paramiko.ChannelException(2, 'connect failed')
+        conn.close()
+
+        forward = (('db', 5432), ('127.0.0.1', 1234))
+        with self.assertRaises(paramiko.ChannelException):
+            self.pool.open_session(self.connect, forward, host='host', port=22)
+        self.assertEqual( self.connect.call_count, 1 )
+        self.assertIsNone( conn.max_sessions )
+        self.assertIs( self.pool.acquire(self.connect, host='host', port=22), conn )
+
+    def test_session_refused(self):
+        """
+        a remote refusing a second session should not break the first one
+        """
+
+        first, channel = self.pool.open_session(self.connect, host='host', port=22)
+        first.client.get_transport().open_session.side_effect = paramiko.ChannelException(1, 'refused')
+
+        second, channel = self.pool.open_session(self.connect, host='host', port=22)
+        self.assertIsNot( second, first )
+        self.assertFalse( first.client.close.called )
+        self.assertEqual( first.max_sessions, 1 )
+
+        # the first connection is kept for one session at a time
+        first.close()
+        self.assertFalse( first.client.close.called )
+        self.assertIs( self.pool.acquire(self.connect, host='host', port=22), first )
+
+    def test_discard_busy_connection(self):
+        """
+        a discarded connection should only be closed once its sessions are done
+        """
+
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        self.pool.acquire(self.connect, host='host', port=22)
+        conn.client.get_transport().is_active.return_value = False
+        conn.close()
+        self.assertFalse( conn.client.close.called )
+        conn.close()
+        conn.client.close.assert_called_once_with()
+
+    def test_stats(self):
+        conn = self.pool.acquire(self.connect, host='host', port=22)
+        self.assertEqual( self.pool.stats(), dict(hits=0, misses=1, evictions=0, connections=1, sessions=1) )
+
+class PendingConnectionTest(unittest.TestCase):
+    """
+    tests for PendingConnection
+    """
+
+    def test_result(self):
+        connect = mock.Mock()
+        pending = PendingConnection(connect, host='host', port=22)
+        self.assertIs( pending.result(5), connect.return_value )
+        connect.assert_called_once_with(host='host', port=22)
+        self.assertGreaterEqual( pending.saved, 0 )
+
+    def test_error(self):
+        """
+        errors from connecting should be raised by result()
+        """
+
+        pending = PendingConnection(mock.Mock(side_effect=ValueError))
+        with self.assertRaises(ValueError):
+            pending.result(5)
+
+    def test_saved(self):
+        """
+        time spent connecting before result() is called should be counted as saved
+        """
+
+        pending = PendingConnection(lambda: time.sleep(0.1))
+        time.sleep(0.2)
+        pending.result(5)
+        self.assertGreaterEqual( pending.saved, 0.1 )
+
+    def test_cancel(self):
+        """
+        cancelling should close the connection
+        """
+
+        connect = mock.Mock()
+        pending = PendingConnection(connect)
+        pending.done.wait(5)
+        pending.cancel()
+        connect.return_value.close.assert_called_once_with()
+
+    def test_cancel_before_connected(self):
+        """
+        cancelling while still connecting should close the connection once made
+        """
+
+        event = threading.Event()
+        connection = mock.Mock()
+        pending = PendingConnection(lambda: event.wait(5) and connection)
+        pending.cancel()
+        self.assertFalse( connection.close.called )
+        event.set()
+        pending.done.wait(5)
+        connection.close.assert_called_once_with()
+
+    def test_cancel_after_claimed(self):
+        connect = mock.Mock()
+        pending = PendingConnection(connect)
+        pending.result(5)
+        pending.cancel()
+        self.assertFalse( connect.return_value.close.called )
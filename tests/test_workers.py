@@ -0,0 +1,139 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+patch = mock.patch
+
+import os
+import time
+import signal
+import socket
+import threading
+from multiprocessing.sharedctypes import RawArray
+
+from ssh_forward_proxy import send_fd, recv_fd, SharedSessionLimiter, Supervisor, STATS
+
+class FdPassingTest(unittest.TestCase):
+    """
+    tests for send_fd and recv_fd
+    """
+
+    def test_pass_fd(self):
+        a, b = socket.socketpair()
+        r, w = os.pipe()
+        try:
+            send_fd(a, w)
+            fd = recv_fd(b)
+            os.write(fd, b'hello')
+            os.close(fd)
+            self.assertEqual( os.read(r, 5), b'hello' )
+        finally:
+            for i in (a, b):
+                i.close()
+            os.close(r)
+            os.close(w)
+
+    def test_closed(self):
+        a, b = socket.socketpair()
+        a.close()
+        self.assertIsNone( recv_fd(b) )
+        b.close()
+
+class SharedSessionLimiterTest(unittest.TestCase):
+    def test_publishes_stats(self):
+        """
+        counts should be written to the limiter's slot in the shared array
+        """
+
+        stats = RawArray('l', 2 * len(STATS))
+        limiter = SharedSessionLimiter(stats, 1, max_sessions=1, max_queued=1)
+        limiter.admit()
+        limiter.start()
+        limiter.admit()
+        self.assertEqual( list(stats), [0, 0, 0, 0, 1, 1, 0, 1] )
+        limiter.finish()
+        self.assertEqual( list(stats), [0, 0, 0, 0, 0, 1, 0, 1] )
+
+def serve_pid(channel, limiter):
+    """
+    worker which replies to each connection with its pid
+    """
+
+    while True:
+        fd = recv_fd(channel)
+        if fd is None:
+            break
+        limiter.admit()
+        client = socket.socket(fileno=fd)
+        client.sendall(str(os.getpid()).encode('ascii'))
+        client.close()
+
+class SupervisorTest(unittest.TestCase):
+    """
+    tests for Supervisor
+    """
+
+    def setUp(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(10)
+        self.supervisor = Supervisor(self.sock, 2, serve_pid)
+        self.supervisor.restart_delay = 0
+        self.thread = threading.Thread(target=self.supervisor.run)
+        self.thread.start()
+        while not all(self.supervisor.workers):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.thread.join()
+        self.sock.close()
+
+    def request(self):
+        client = socket.create_connection(self.sock.getsockname())
+        try:
+            return int(client.recv(100))
+        finally:
+            client.close()
+
+    def test_dispatch(self):
+        """
+        connections should be spread over the worker processes
+        """
+
+        pids = set(self.request() for i in range(4))
+        self.assertEqual( pids, set(self.supervisor.workers) )
+        self.assertEqual( self.supervisor.stats()['queued'], 4 )
+
+    def test_restart(self):
+        """
+        crashed workers should be restarted
+        """
+
+        old_pid = self.supervisor.workers[0]
+        os.kill(old_pid, signal.SIGKILL)
+        for i in range(50):
+            if self.supervisor.workers[0] not in (None, old_pid):
+                break
+            time.sleep(0.1)
+
+        self.assertNotEqual( self.supervisor.workers[0], old_pid )
+        self.assertEqual( self.supervisor.restarts, 1 )
+        self.assertIn( self.request(), self.supervisor.workers )
+
+    def test_accepts_while_restarting(self):
+        """
+        connections should go to the other workers while a crashed one waits to restart
+        """
+
+        self.supervisor.restart_delay = 60
+        old_pid = self.supervisor.workers[0]
+        os.kill(old_pid, signal.SIGKILL)
+        for i in range(50):
+            if self.supervisor.workers[0] is None:
+                break
+            time.sleep(0.1)
+
+        self.assertIsNone( self.supervisor.workers[0] )
+        self.assertEqual( set(self.request() for i in range(2)), set([self.supervisor.workers[1]]) )